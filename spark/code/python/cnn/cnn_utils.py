@@ -14,6 +14,9 @@ import tensorflow as tf
 import numpy as np
 import h5py
 
+# LazyWeights opened in this process keyed by the HDF5 file path
+_lazy_weights = {}
+
 
 def conv(x, filter_height, filter_width, num_filters, stride_y, stride_x, name,
          padding='SAME', groups=1, data=None, retrain_layers=False):
@@ -132,3 +135,87 @@ def __recursively_load_dict_contents_from_group(h5file, path):
         elif isinstance(item, h5py._hl.group.Group):
             ans[key] = __recursively_load_dict_contents_from_group(h5file, path + key + '/')
     return ans
+
+
+def load_lazy_weights(filename):
+    """
+        Returns the LazyWeights of an HDF5 weights file, shared by all the models built in this process.
+    :param filename: HDF5 weights file path
+    :return: LazyWeights
+    """
+    if filename not in _lazy_weights:
+        _lazy_weights[filename] = LazyWeights(filename)
+    return _lazy_weights[filename]
+
+
+class LazyWeights(object):
+    """
+        Read-only view of an HDF5 weights file that behaves like the nested dict returned by load_dict_from_hdf5, but
+        reads a tensor from the file only when it is accessed. A graph starting at an upper layer therefore never reads
+        the weights of the lower layers. The tensors are not kept once read: tf.constant copies them into the graph, so
+        the NumPy arrays are freed once the graph is built instead of doubling the resident weights.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+
+        dataset_names = []
+        with h5py.File(filename, 'r') as h5file:
+            h5file.visititems(lambda name, item: dataset_names.append(name)
+                              if isinstance(item, h5py._hl.dataset.Dataset) else None)
+        self.dataset_names = set(dataset_names)
+        self.root = _LazyWeightsGroup(self, '')
+
+    def __getitem__(self, key):
+        return self.root[key]
+
+    def __iter__(self):
+        return iter(self.root)
+
+    def __contains__(self, key):
+        return key in self.root
+
+    def __len__(self):
+        return len(self.root)
+
+    def keys(self):
+        return self.root.keys()
+
+    def get_tensor(self, name):
+        with h5py.File(self.filename, 'r') as h5file:
+            return h5file[name][()]
+
+
+class _LazyWeightsGroup(object):
+    """
+        A group (e.g. a layer) of a LazyWeights file.
+    """
+
+    def __init__(self, weights, path):
+        self.weights = weights
+        self.path = path
+        children = set()
+        for name in weights.dataset_names:
+            if name.startswith(path):
+                children.add(name[len(path):].split('/')[0])
+        self.children = sorted(children)
+
+    def __getitem__(self, key):
+        name = self.path + key
+        if name in self.weights.dataset_names:
+            return self.weights.get_tensor(name)
+        elif key in self.children:
+            return _LazyWeightsGroup(self.weights, name + '/')
+        raise KeyError(key)
+
+    def __iter__(self):
+        return iter(self.children)
+
+    def __contains__(self, key):
+        return key in self.children
+
+    def __len__(self):
+        return len(self.children)
+
+    def keys(self):
+        return list(self.children)
@@ -0,0 +1,93 @@
+'''
+Copyright 2018 Supun Nakandala and Arun Kumar
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+    http://www.apache.org/licenses/LICENSE-2.0
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+'''
+import os
+
+import tensorflow as tf
+
+from alexnet import AlexNet
+from resnet50 import ResNet50
+from vgg16 import VGG16
+
+cnn_models = {'alexnet': AlexNet, 'resnet50': ResNet50, 'vgg16': VGG16}
+
+# CNNs built in this Python process keyed by (model, input layer index, output layer indices). Spark reuses Python
+# workers across tasks (spark.python.worker.reuse), so an entry is shared by all the tasks and stages that an executor
+# runs for the same truncated CNN.
+_cached_cnns = {}
+
+
+class CachedCNN(object):
+    """
+        A CNN truncated between an input layer and a set of output layers, together with an open session.
+    """
+
+    def __init__(self, model, input_layer_index, output_layer_indices, n_threads=None, weights_path=None):
+        model_class = cnn_models[model]
+        self.input_size = model_class.transfer_layer_flattened_sizes[input_layer_index]
+        self.output_sizes = [model_class.transfer_layer_flattened_sizes[i] for i in output_layer_indices]
+
+        self.graph = tf.Graph()
+        with self.graph.as_default():
+            self.input = tf.placeholder(tf.float32, [None, self.input_size], 'input_layer')
+            cnn = model_class(self.input, input_layer_name=model_class.get_transfer_learning_layer_names()[
+                input_layer_index], model_name=model, weights_path=get_weights_path(model, weights_path))
+            self.outputs = [tf.reshape(cnn.transfer_layers[i], [-1, size])
+                            for i, size in zip(output_layer_indices, self.output_sizes)]
+        self.graph.finalize()
+        if n_threads is None:
+            self.session = tf.Session(graph=self.graph)
+        else:
+            self.session = tf.Session(graph=self.graph, config=tf.ConfigProto(
+                intra_op_parallelism_threads=n_threads, inter_op_parallelism_threads=n_threads))
+
+    def run(self, inputs):
+        """
+            Runs a batch through the CNN
+        :param inputs: float32 array of shape [N, input size]
+        :return: List of float32 arrays of shape [N, output size], one per output layer
+        """
+        return self.session.run(self.outputs, feed_dict={self.input: inputs})
+
+
+def get_cached_cnn(model, input_layer_index, output_layer_indices, n_threads=None, weights_path=None):
+    """
+        Returns the CNN cached in this process, building it on first use.
+    :param model: CNN model name (alexnet, vgg16, resnet50)
+    :param input_layer_index: Starting layer index. Zero means raw images
+    :param output_layer_indices: Layer indices from the top of the CNN to be fetched
+    :param n_threads: Number of TensorFlow threads of the session. None uses all the cores
+    :param weights_path: HDF5 weights file. None uses the trained weights in the resources dir.
+    :return: CachedCNN
+    """
+    key = (model, input_layer_index, tuple(output_layer_indices), n_threads, weights_path)
+    if key not in _cached_cnns:
+        _cached_cnns[key] = CachedCNN(model, input_layer_index, output_layer_indices, n_threads, weights_path)
+    return _cached_cnns[key]
+
+
+def get_weights_path(model, weights_path=None):
+    """
+        Resolves the weights file of a model. Falls back to a copy shipped with SparkContext.addFile when the file is
+        not available on the executor.
+    :param model: CNN model name (alexnet, vgg16, resnet50)
+    :param weights_path: HDF5 weights file. None uses the trained weights in the resources dir.
+    :return: Path to the HDF5 weights file
+    """
+    if weights_path is None:
+        this_dir, _ = os.path.split(__file__)
+        weights_path = os.path.join(this_dir, 'resources', model + '_weights.h5')
+    if os.path.exists(weights_path):
+        return weights_path
+    # imported here so that the CNNs are built without Spark, e.g. by the local engine
+    from pyspark import SparkFiles
+    return SparkFiles.get(os.path.basename(weights_path))
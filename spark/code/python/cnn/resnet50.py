@@ -14,13 +14,15 @@ import os
 
 import tensorflow as tf
 
-from cnn_utils import conv, fc, max_pool, avg_pool, batch_norm_layer, load_dict_from_hdf5
+from cnn_utils import conv, fc, max_pool, avg_pool, batch_norm_layer, load_lazy_weights
 
 
 class ResNet50(object):
 
     transfer_layer_flattened_sizes = [227*227*3, 14 * 14 * 1024, 7 * 7 * 2048, 7 * 7 * 2048, 7 * 7 * 2048, 1000]
     transfer_layers_shapes = [(227, 227, 3), (14, 14, 1024), (7, 7, 2048), (7, 7, 2048), (7, 7, 2048), (1, 1, 1000)]
+    # GFLOPs per image to compute each transfer layer from the previous one
+    transfer_layer_gflops = [0, 5.8, 0.54, 0.54, 0.54, 0.004]
 
     def __init__(self, model_input, input_layer_name='image', model_name='resnet50', retrain_layers=False,
                  weights_path='DEFAULT'):
@@ -199,8 +201,8 @@ class ResNet50(object):
         return x
 
     def __get_weights_data(self):
-        # Load the weights and biases into memory
-        return load_dict_from_hdf5(self.weights_path)
+        # Weights and biases are read lazily, so only the layers above input_layer_name are loaded
+        return load_lazy_weights(self.weights_path)
 
     def load_initial_weights(self, session):
         if not self.retrain_layers:
@@ -226,4 +228,4 @@ class ResNet50(object):
 
     @staticmethod
     def get_transfer_learning_layer_names():
-        return ['image','conv4_6', 'conv5_1', 'conv5_2', 'conv5_2', 'fc6']
+        return ['image','conv4_6', 'conv5_1', 'conv5_2', 'conv5_3', 'fc6']
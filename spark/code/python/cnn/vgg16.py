@@ -14,13 +14,15 @@ import os
 
 import tensorflow as tf
 
-from cnn_utils import conv, fc, max_pool, load_dict_from_hdf5
+from cnn_utils import conv, fc, max_pool, load_lazy_weights
 
 
 class VGG16(object):
 
     transfer_layer_flattened_sizes = [227*227*3, 14 * 14 * 512, 4096, 4096, 1000]
     transfer_layers_shapes = [(227, 227, 3), (14, 14, 512), (1, 1, 4096), (1, 1, 4096), (1, 1, 1000)]
+    # GFLOPs per image to compute each transfer layer from the previous one
+    transfer_layer_gflops = [0, 30.6, 0.206, 0.034, 0.008]
 
     def __init__(self, model_input, input_layer_name='image', model_name='vgg16', retrain_layers=False,
                  weights_path='DEFAULT'):
@@ -143,8 +145,8 @@ class VGG16(object):
                                  retrain_layers=self.retrain_layers)
 
     def __get_weights_data(self):
-        # Load the weights and biases into memory
-        return load_dict_from_hdf5(self.weights_path)
+        # Weights and biases are read lazily, so only the layers above input_layer_name are loaded
+        return load_lazy_weights(self.weights_path)
 
     def load_initial_weights(self, session):
         if not self.retrain_layers:
@@ -0,0 +1,299 @@
+# coding=utf-8
+'''
+Copyright 2018 Supun Nakandala and Arun Kumar
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+    http://www.apache.org/licenses/LICENSE-2.0
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+'''
+from collections import namedtuple
+from itertools import combinations
+
+"""Cost model of the Vista logical plans. A plan is an (inference type, operator placement, join) triple. Sizes are
+estimated from the per-layer feature sizes of the CNN and converted into seconds with the rough hardware throughputs
+below. Only the relative cost of the plans matters."""
+core_gflops = 10.0
+network_gb_per_sec = 1.0
+memory_gb_per_sec = 5.0
+# A shuffle join also writes the shuffled data to the local disks of the map side and reads it back on the reduce
+# side, while a broadcast table is sent from memory to memory. Without this term a small structured table is shuffled
+# as soon as its broadcast to every node moves a few more bytes than the shuffle.
+disk_gb_per_sec = 0.5
+job_overhead_sec = 2.0
+# Size of a JPEG image relative to its raw 8-bit pixels
+jpeg_compression_ratio = 0.1
+
+inference_types = ['bulk', 'staged']
+# after-join first so that it wins ties, e.g. with broadcast joins
+operator_placements = ['after-join', 'before-join']
+join_types = ['b', 's']
+
+# PCA solves a d*d covariance matrix in the driver, so wider layers are reduced with random projection instead
+max_pca_dims = 8192
+# Fraction of the records the PCA feature reduction is fitted on
+pca_sample_fraction = 0.1
+# Seed of the random projection matrices (and of the PCA sample), shared by all executors
+reduction_seed = 42
+
+Plan = namedtuple('Plan', ['inf', 'operator', 'join', 'gflops', 'storage_gb', 'shuffle_gb', 'scan_gb', 'cost',
+                           'fits'])
+
+GB = 1024.0 * 1024 * 1024
+
+
+def get_input_layer_index(layer_sizes, start_layer):
+    """
+        Index of the CNN input layer in the transfer layer tables
+    :param layer_sizes: Flattened sizes of the transfer layers of the CNN
+    :param start_layer: Layer index of the CNN input. Zero means input is raw images
+    :return: Non-negative layer index
+    """
+    if start_layer < 0:
+        return len(layer_sizes) + start_layer
+    return 0
+
+
+def get_compute_gflops(layer_gflops, start_layer, n_records):
+    """
+        CNN inference work. Both bulk and staged inference run every layer above the input once per record.
+    :param layer_gflops: GFLOPs per image of each transfer layer computed from the previous one
+    :param start_layer: Layer index of the CNN input. Zero means input is raw images
+    :param n_records: Number of records in the dataset
+    :return: GFLOPs
+    """
+    return sum(layer_gflops[get_input_layer_index(layer_gflops, start_layer) + 1:]) * n_records
+
+
+def get_storage_footprint(inf, layer_sizes, n_layers, dS, n_records, alpha_2=2.0, feature_width=4, split_width=0):
+    """
+        Largest amount of data persisted at the same time. Bulk inference persists every explored layer in one table.
+        Staged inference persists a layer until the next one is computed, i.e. two adjacent layers. The train/test
+        splits of the downstream model of a layer are persisted next to them, as vectors of doubles.
+    :param inf: Inference type ('bulk' or 'staged')
+    :param layer_sizes: Flattened sizes of the transfer layers of the CNN
+    :param n_layers: Number of layers in the CNN to be explored
+    :param dS: Number of structured features
+    :param n_records: Number of records in the dataset
+    :param alpha_2: Deserialized memory blowup
+    :param feature_width: Bytes per persisted CNN feature (see vista_utils.feature_codecs)
+    :param split_width: Number of merged features of the widest layer evaluated at a time. Zero ignores the splits
+    :return: Size in GB
+    """
+    explored_sizes = layer_sizes[-n_layers:]
+    if inf == 'bulk' or len(explored_sizes) == 1:
+        size = sum(explored_sizes) * feature_width + dS * 4
+    else:
+        size = max([explored_sizes[i] + explored_sizes[i + 1] for i in range(len(explored_sizes) - 1)]) * \
+               feature_width + 2 * dS * 4
+    return alpha_2 * (size + split_width * 8) * n_records / GB
+
+
+def get_shuffle_volume(inf, operator, join, layer_sizes, n_layers, dS, n_records, n_nodes, alpha_1=1.2):
+    """
+        Data moved over the network by the join. A broadcast join ships the structured table to every node. A shuffle
+        join moves both sides, where the image side is the JPEG images (after-join) or the first CNN features computed
+        (before-join).
+    :param inf: Inference type ('bulk' or 'staged')
+    :param operator: Operator placement ('before-join' or 'after-join')
+    :param join: Join type ('b' for broadcast, 's' for shuffle)
+    :param layer_sizes: Flattened sizes of the transfer layers of the CNN
+    :param n_layers: Number of layers in the CNN to be explored
+    :param dS: Number of structured features
+    :param n_records: Number of records in the dataset
+    :param n_nodes: Number of nodes in the Spark cluster
+    :param alpha_1: Structured table memory blowup
+    :return: Size in GB
+    """
+    struct_size = alpha_1 * dS * 4 * n_records / GB
+    if join == 'b':
+        return struct_size * n_nodes
+
+    explored_sizes = layer_sizes[-n_layers:]
+    if operator == 'after-join':
+        image_size = layer_sizes[0] * jpeg_compression_ratio
+    elif inf == 'bulk':
+        image_size = sum(explored_sizes) * 4
+    else:
+        image_size = explored_sizes[0] * 4
+    return struct_size + image_size * n_records / GB
+
+
+def get_scan_volume(inf, layer_sizes, n_layers, n_records, feature_width=4):
+    """
+        Persisted CNN features read back as the input of a later inference stage
+    :param inf: Inference type ('bulk' or 'staged')
+    :param layer_sizes: Flattened sizes of the transfer layers of the CNN
+    :param n_layers: Number of layers in the CNN to be explored
+    :param n_records: Number of records in the dataset
+    :param feature_width: Bytes per persisted CNN feature (see vista_utils.feature_codecs)
+    :return: Size in GB
+    """
+    if inf == 'bulk':
+        return 0.0
+    return sum(layer_sizes[-n_layers:-1]) * feature_width * n_records / GB
+
+
+def get_image_feature_size(shape, pooling, pooling_grid):
+    """
+        Number of CNN features of a layer fed to the downstream model, after the pooling of conv layers
+    :param shape: Layer shape
+    :param pooling: Pooling applied to conv layers ('max', 'avg' or 'none')
+    :param pooling_grid: (rows, columns) of the pooled conv features
+    :return: Number of features
+    """
+    if shape[0] > 1 and pooling != 'none':
+        return pooling_grid[0] * pooling_grid[1] * shape[2]
+    return shape[0] * shape[1] * shape[2]
+
+
+def get_reduction_method(reduction, image_feature_size, reduced_dim):
+    """
+        Dimensionality reduction applied to a layer. Layers that are already narrow are not reduced and PCA falls back
+        to random projection above max_pca_dims.
+    :param reduction: Requested reduction (None, 'random' or 'pca')
+    :param image_feature_size: Number of CNN features of the layer (see get_image_feature_size)
+    :param reduced_dim: Output dimensionality
+    :return: None, 'random' or 'pca'
+    """
+    if reduction is None or image_feature_size <= reduced_dim:
+        return None
+    if reduction == 'pca' and image_feature_size > max_pca_dims:
+        return 'random'
+    return reduction
+
+
+def get_reduction_gflops(method, image_feature_size, reduced_dim, n_records, sample_fraction):
+    """
+        Dimensionality reduction work of a layer. The sparse random projection matrix has sqrt(d) * k non-zeros. PCA
+        computes the covariance of a sample, its eigen decomposition, and a dense d*k projection of every record.
+    :param method: None, 'random' or 'pca' (see get_reduction_method)
+    :param image_feature_size: Number of CNN features of the layer
+    :param reduced_dim: Output dimensionality
+    :param n_records: Number of records in the dataset
+    :param sample_fraction: Fraction of the records PCA is fitted on
+    :return: GFLOPs
+    """
+    d = image_feature_size
+    if method == 'random':
+        return 2.0 * d ** 0.5 * reduced_dim * n_records / 1e9
+    if method == 'pca':
+        return (2.0 * d * d * sample_fraction * n_records + 1.0 * d ** 3 + 2.0 * d * reduced_dim * n_records) / 1e9
+    return 0.0
+
+
+def get_plans(layer_sizes, layer_gflops, n_layers, start_layer, n_records, dS, n_nodes, cpu, storage_memory,
+              max_broadcast, alpha_1=1.2, alpha_2=2.0, feature_width=4, reduction_gflops=0.0, split_width=0):
+    """
+        Enumerates and costs all the logical plans
+    :param layer_sizes: Flattened sizes of the transfer layers of the CNN
+    :param layer_gflops: GFLOPs per image of each transfer layer computed from the previous one
+    :param n_layers: Number of layers in the CNN to be explored
+    :param start_layer: Layer index of the CNN input. Zero means input is raw images
+    :param n_records: Number of records in the dataset
+    :param dS: Number of structured features
+    :param n_nodes: Number of nodes in the Spark cluster
+    :param cpu: Number of Spark cores per node
+    :param storage_memory: Spark storage memory of the cluster in GB
+    :param max_broadcast: Largest structured table in GB that can be broadcast
+    :param alpha_1: Structured table memory blowup
+    :param alpha_2: Deserialized memory blowup
+    :param feature_width: Bytes per persisted CNN feature (see vista_utils.feature_codecs)
+    :param reduction_gflops: Dimensionality reduction work of the explored layers (see get_reduction_gflops)
+    :param split_width: Number of merged features of the widest layer evaluated at a time (see get_storage_footprint)
+    :return: List of Plan
+    """
+    total_cores = cpu * n_nodes
+    gflops = get_compute_gflops(layer_gflops, start_layer, n_records) + reduction_gflops
+    broadcastable = alpha_1 * dS * 4 * n_records / GB < max_broadcast
+
+    plans = []
+    for inf in inference_types:
+        storage_gb = get_storage_footprint(inf, layer_sizes, n_layers, dS, n_records, alpha_2, feature_width,
+                                           split_width)
+        scan_gb = get_scan_volume(inf, layer_sizes, n_layers, n_records, feature_width)
+        n_jobs = 1 if inf == 'bulk' else n_layers
+        for operator in operator_placements:
+            for join in join_types:
+                if join == 'b' and not broadcastable:
+                    continue
+                shuffle_gb = get_shuffle_volume(inf, operator, join, layer_sizes, n_layers, dS, n_records, n_nodes,
+                                                alpha_1)
+                cost = gflops / (core_gflops * total_cores) + shuffle_gb / (network_gb_per_sec * n_nodes) + \
+                       scan_gb / (memory_gb_per_sec * total_cores) + job_overhead_sec * n_jobs
+                if join == 's':
+                    cost += 2 * shuffle_gb / (disk_gb_per_sec * n_nodes)
+                plans.append(Plan(inf, operator, join, gflops, storage_gb, shuffle_gb, scan_gb, cost,
+                                  storage_gb <= storage_memory))
+    return plans
+
+
+def get_best_plan(plans):
+    """
+        Picks the cheapest plan that fits in the storage memory. When none fits, the plan with the smallest storage
+        footprint is picked.
+    :param plans: List of Plan
+    :return: Plan
+    """
+    fitting_plans = [p for p in plans if p.fits]
+    if fitting_plans:
+        return min(fitting_plans, key=lambda p: p.cost)
+    return min(plans, key=lambda p: (p.storage_gb, p.cost))
+
+
+def get_run_gflops(layer_gflops, materialized_layers, n_layers, n_records):
+    """
+        CNN inference work of an exploration run when some layers are materialized. Inference starts from the
+        highest materialized layer at or below the explored ones (or the raw images) and only the layers that are not
+        materialized above it are computed.
+    :param layer_gflops: GFLOPs per image of each transfer layer computed from the previous one
+    :param materialized_layers: Materialized layer indices (negative, from the top)
+    :param n_layers: Number of layers from the top explored by the run
+    :param n_records: Number of records in the dataset
+    :return: GFLOPs
+    """
+    base_layers = [i for i in materialized_layers if i <= -1 * n_layers]
+    input_index = get_input_layer_index(layer_gflops, max(base_layers)) if len(base_layers) > 0 else 0
+    return sum(layer_gflops[j] for j in range(input_index + 1, len(layer_gflops))
+               if j - len(layer_gflops) not in materialized_layers) * n_records
+
+
+def plan_materialization(model_layers, runs, n_records, storage_budget_gb):
+    """
+        Picks the layers to materialize that minimize the expected inference work of a set of exploration runs while
+        fitting in a storage budget. Every subset of the transfer layers of the models is costed, which is cheap for
+        the handful of transfer layers per model.
+    :param model_layers: Dict of model name to (layer_sizes, layer_gflops) tables
+    :param runs: Expected exploration runs as a list of (model, n_layers, number of runs)
+    :param n_records: Number of images
+    :param storage_budget_gb: Storage budget in GB (materialized features are stored as float32)
+    :return: (Dict of model name to the sorted layer indices to materialize, expected GFLOPs, storage in GB)
+    """
+    candidates = []
+    for model in sorted(set(run[0] for run in runs)):
+        n_transfer_layers = len(model_layers[model][0])
+        candidates.extend((model, i) for i in range(-1 * (n_transfer_layers - 1), 0))
+
+    best = None
+    for n in range(len(candidates) + 1):
+        for subset in combinations(candidates, n):
+            storage_gb = sum(model_layers[model][0][i] * 4 for model, i in subset) * n_records / GB
+            if storage_gb > storage_budget_gb:
+                continue
+            gflops = sum(count * get_run_gflops(model_layers[model][1], [i for m, i in subset if m == model],
+                                                n_layers, n_records)
+                         for model, n_layers, count in runs)
+            if best is None or (gflops, storage_gb) < (best[1], best[2]):
+                best = (subset, gflops, storage_gb)
+
+    subset, gflops, storage_gb = best
+    plan = dict((run[0], []) for run in runs)
+    for model, i in subset:
+        plan[model].append(i)
+    for model in plan:
+        plan[model].sort()
+    return plan, gflops, storage_gb
@@ -0,0 +1,77 @@
+# coding=utf-8
+'''
+Copyright 2018 Supun Nakandala and Arun Kumar
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+    http://www.apache.org/licenses/LICENSE-2.0
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+'''
+import numpy as np
+
+"""NumPy implementation of the CNN feature codecs of VistaUDFs.encodeFeatures and VistaUDFs.decodeFeatures, byte
+compatible with them, so that the persisted feature tables can be read and the error of the codecs measured without
+Spark (see tests/test_feature_codecs.py)."""
+
+
+def encode_features(features, codec, channels):
+    """
+        Encodes the CNN features of a record
+    :param features: float32 array of the features in (height, width, channel) order
+    :param codec: 'float32', 'float16', 'int8' or 'sparse' (see vista_utils.feature_codecs)
+    :param channels: Number of channels the int8 codec keeps a scale for (see vista_utils.get_feature_channels)
+    :return: Encoded bytes
+    """
+    features = np.asarray(features, dtype=np.float32)
+    if codec == 'float32':
+        return features.astype('<f4').tobytes()
+    if codec == 'float16':
+        # rounded to nearest even, overflows become infinities, as VistaUDFs.floatToHalf
+        return features.astype('<f2').tobytes()
+    if codec == 'int8':
+        scales = (np.abs(features.reshape(-1, channels)).max(axis=0) / np.float32(127)).astype(np.float32)
+        values = features.reshape(-1, channels)
+        # Scala math.round rounds halves up
+        q = np.floor(np.divide(values, scales, out=np.zeros_like(values), where=scales > 0) + np.float32(0.5))
+        return scales.astype('<f4').tobytes() + np.clip(q, -127, 127).astype(np.int8).tobytes()
+    if codec == 'sparse':
+        non_zero = features != 0
+        bits = np.zeros(((len(features) + 7) // 8) * 8, dtype=np.uint8)
+        bits[:len(features)] = non_zero
+        bitmap = (bits.reshape(-1, 8) << np.arange(8, dtype=np.uint8)).sum(axis=1).astype(np.uint8)
+        return np.array([len(features)], dtype='<i4').tobytes() + bitmap.tobytes() + \
+            features[non_zero].astype('<f4').tobytes()
+    raise ValueError('unsupported feature codec: ' + codec)
+
+
+def decode_features(encoded, codec, channels):
+    """
+        Decodes the CNN features of a record encoded by encode_features (or VistaUDFs.encodeFeatures)
+    :param encoded: Encoded bytes
+    :param codec: 'float32', 'float16', 'int8' or 'sparse'
+    :param channels: Number of channels of the int8 scales
+    :return: float32 array of the features
+    """
+    if codec == 'float32':
+        return np.frombuffer(encoded, dtype='<f4').astype(np.float32)
+    if codec == 'float16':
+        return np.frombuffer(encoded, dtype='<f2').astype(np.float32)
+    if codec == 'int8':
+        if len(encoded) < 4 * channels:
+            raise ValueError('int8 features of ' + str(len(encoded)) + ' bytes have no scales for ' + str(channels) +
+                             ' channels')
+        scales = np.frombuffer(encoded[:4 * channels], dtype='<f4')
+        q = np.frombuffer(encoded[4 * channels:], dtype=np.int8).astype(np.float32)
+        return (q.reshape(-1, channels) * scales).reshape(-1).astype(np.float32)
+    if codec == 'sparse':
+        n = int(np.frombuffer(encoded[:4], dtype='<i4')[0])
+        bitmap = np.frombuffer(encoded[4:4 + (n + 7) // 8], dtype=np.uint8)
+        non_zero = ((bitmap[:, None] >> np.arange(8, dtype=np.uint8)) & 1).reshape(-1)[:n].astype(bool)
+        features = np.zeros(n, dtype=np.float32)
+        features[non_zero] = np.frombuffer(encoded[4 + (n + 7) // 8:], dtype='<f4')
+        return features
+    raise ValueError('unsupported feature codec: ' + codec)
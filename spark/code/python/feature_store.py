@@ -0,0 +1,134 @@
+# coding=utf-8
+'''
+Copyright 2018 Supun Nakandala and Arun Kumar
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+    http://www.apache.org/licenses/LICENSE-2.0
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+'''
+import hashlib
+import json
+import time
+
+from input_stats import get_file_system, get_image_dir_stats, get_file_checksum
+
+GB = 1024.0 * 1024 * 1024
+
+
+def get_layer_key(model, layer_name, weights_path, image_dir_path, codec='float32'):
+    """
+        Content address of the CNN features of a layer computed over an image dataset
+    :param model: CNN model name (alexnet, vgg16, resnet50)
+    :param layer_name: Transfer layer name (e.g. 'fc6')
+    :param weights_path: Path to the weights file the features were computed with
+    :param image_dir_path: Images dir. path
+    :param codec: Encoding the features are stored with (see vista_utils.feature_codecs)
+    :return: Key
+    """
+    parts = [model, layer_name, get_file_checksum(weights_path), get_dataset_fingerprint(image_dir_path)]
+    # float32 keys are the ones of the tables written before the codec was recorded
+    if codec != 'float32':
+        parts.append(codec)
+    return hashlib.sha1('|'.join(parts).encode('utf-8')).hexdigest()
+
+
+def get_dataset_fingerprint(image_dir_path):
+    """
+        Fingerprint of an image dataset made of its path, total size, file count and modification time. Adding,
+        removing or replacing (renaming over) an image changes it, an image rewritten in place does not (see
+        input_stats).
+    :param image_dir_path: Images dir. path
+    :return: Fingerprint
+    """
+    stats = get_image_dir_stats(image_dir_path)
+    mtime = get_file_system(image_dir_path).get_modification_time(image_dir_path)
+    return hashlib.sha1('|'.join([image_dir_path, str(stats['size']), str(stats['count']),
+                                  str(mtime)]).encode('utf-8')).hexdigest()
+
+
+class FeatureStore(object):
+    """
+        Parquet tables of (id, image_features) CNN features, one per (model, layer, weights, dataset) key, stored under
+        a root dir. (HDFS or local) with an index.json that records their size and last access. The least recently
+        used tables are evicted when the store grows over max_size_gb.
+    """
+
+    def __init__(self, root, max_size_gb=100.0):
+        """
+        :param root: Root dir. of the store
+        :param max_size_gb: Size cap of the store in GB
+        """
+        self.root = root.rstrip('/')
+        self.max_size_gb = max_size_gb
+        self.fs = get_file_system(self.root)
+        self.index_path = self.root + '/index.json'
+
+    def get(self, key):
+        """
+            Path of the table stored for a key. Marks the table as used
+        :param key: Key (see get_layer_key)
+        :return: Table path or None
+        """
+        index = self.__read_index()
+        if key not in index or not self.fs.exists(index[key]['path']):
+            return None
+        index[key]['last_access'] = time.time()
+        self.__write_index(index)
+        return index[key]['path']
+
+    def put(self, key, features_df, description=None, keep=(), codec='float32', shape=None):
+        """
+            Writes the (id, image_features) table of a key and evicts the least recently used tables that do not fit
+        :param key: Key (see get_layer_key, given the same codec)
+        :param features_df: DataFrame with the 'id' and float32 'image_features' columns
+        :param description: Dictionary stored with the index entry (e.g. model and layer name)
+        :param keep: Keys that must not be evicted (e.g. the tables used by the current run)
+        :param codec: Encoding the features are stored with (see vista_utils.feature_codecs)
+        :param shape: Layer shape, required by the codecs other than float32
+        :return: Table path
+        """
+        features_df = features_df.select('id', 'image_features')
+        if codec != 'float32':
+            from vista_utils import encode_layer_features
+
+            features_df = encode_layer_features(features_df.sql_ctx._sc, features_df, ['image_features'], [shape],
+                                                codec)
+        path = self.root + '/' + key + '.parquet'
+        features_df.write.mode('overwrite').parquet(path)
+
+        index = self.__read_index()
+        index[key] = {'path': path, 'size': self.fs.get_content_summary(path)['size'], 'last_access': time.time(),
+                      'codec': codec, 'description': description or {}}
+        self.__evict(index, set(keep) | {key})
+        self.__write_index(index)
+        return path
+
+    def get_size(self):
+        """
+        :return: Total size of the stored tables in GB
+        """
+        return sum(entry['size'] for entry in self.__read_index().values()) / GB
+
+    def __evict(self, index, keep):
+        size = sum(entry['size'] for entry in index.values())
+        for key in sorted(index, key=lambda k: index[k]['last_access']):
+            if size <= self.max_size_gb * GB:
+                break
+            if key in keep:
+                continue
+            self.fs.delete(index[key]['path'])
+            size -= index[key]['size']
+            del index[key]
+
+    def __read_index(self):
+        if not self.fs.exists(self.index_path):
+            return {}
+        return json.loads(self.fs.read_text(self.index_path))
+
+    def __write_index(self, index):
+        self.fs.write_text(self.index_path, json.dumps(index, indent=2, sort_keys=True))
@@ -0,0 +1,127 @@
+# coding=utf-8
+'''
+Copyright 2018 Supun Nakandala and Arun Kumar
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+    http://www.apache.org/licenses/LICENSE-2.0
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+'''
+from pyspark import SQLContext, StorageLevel
+from pyspark.sql.functions import col, regexp_extract
+
+from input_stats import get_file_system
+from vista_utils import get_struct_df, get_image_features_for_layer, get_joined_features, image_to_byte_arr_udf, \
+    encode_layer_features, check_spark_version
+
+"""Structured Streaming extraction of the CNN features of the images arriving in a dir. (requires Spark 3.0+ for the
+binaryFile source, which also brings the foreachBatch sink of 2.4). Images have to be moved (renamed) into the watched
+dir. once fully written, as the file source picks up every new file it lists."""
+# Oldest Spark (major, minor) version with the binaryFile source
+min_spark_version = (3, 0)
+
+# Upper bound of the images processed per micro-batch, which bounds the per-batch latency
+default_max_files_per_trigger = 1000
+default_trigger_interval = '30 seconds'
+
+
+def start_feature_stream(sc, model, layer_index, images_input, struct_input, output_path, checkpoint_path,
+                         max_files_per_trigger=default_max_files_per_trigger,
+                         trigger_interval=default_trigger_interval, batch_size=1, backend='python', codec='float32',
+                         broadcast_hash_join=True):
+    """
+        Starts a streaming query that extracts the features of a layer for the new images of a dir. Every micro-batch
+        decodes its images, runs the CNN, joins the features with the structured table and writes the
+        (id, image_features, features, label) rows into the batch_id=<micro-batch id> partition of a Parquet table.
+        Images without a structured row (e.g. one not yet appended to the csv) are not dropped: their
+        (id, image_features) rows are written into the same partition of the <output_path>_unmatched table. The
+        structured table is read again whenever the csv is modified, and every micro-batch also joins the unmatched
+        rows of the earlier micro-batches that are not in the output yet, writing the ones that now match into its
+        own output partition. A micro-batch only reads the partitions of the earlier micro-batches and overwrites its
+        own, so a micro-batch replayed after a failure writes the same rows and the output holds every image once.
+        The offsets of the file source are checkpointed in checkpoint_path. Requires Spark 3.0+.
+    :param sc: SparkContext
+    :param model: CNN model name (alexnet, vgg16, resnet50)
+    :param layer_index: Layer index from the top of the CNN
+    :param images_input: Watched images dir. path
+    :param struct_input: Structured data csv path
+    :param output_path: Parquet table path of the features
+    :param checkpoint_path: Checkpoint dir. path of the query
+    :param max_files_per_trigger: Maximum number of images per micro-batch
+    :param trigger_interval: Processing time trigger interval (e.g. '30 seconds')
+    :param batch_size: Number of images fed to the CNN per session run
+    :param backend: CNN inference backend ('python' or 'arrow'; TensorFrames has no Spark 3 release)
+    :param codec: Encoding of the features (see vista_utils.feature_codecs)
+    :param broadcast_hash_join: Whether to broadcast the structured table in the join
+    :return: StreamingQuery
+    """
+    check_spark_version(sc, min_spark_version, 'the feature stream (binaryFile source)')
+    spark = SQLContext(sc).sparkSession
+    fs = get_file_system(output_path)
+    unmatched_path = output_path.rstrip('/') + '_unmatched'
+    # structured table of the last read, with the csv mtime it was read at
+    struct = {'mtime': None, 'df': None}
+
+    def get_struct():
+        mtime = get_file_system(struct_input).get_modification_time(struct_input)
+        if mtime != struct['mtime']:
+            if struct['df'] is not None:
+                struct['df'].unpersist()
+            struct['df'] = get_struct_df(sc, struct_input).persist(StorageLevel.MEMORY_AND_DISK)
+            struct['mtime'] = mtime
+        return struct['df']
+
+    images_stream_df = spark.readStream.format('binaryFile') \
+        .option('maxFilesPerTrigger', max_files_per_trigger) \
+        .load(images_input) \
+        .select(regexp_extract(col('path'), '([^/.]*)[^/]*$', 1).alias('id'), col('content').alias('image_buffer'))
+
+    def process_batch(images_df, batch_id):
+        struct_df = get_struct()
+        input_df = images_df.select('id', image_to_byte_arr_udf(sc, col('image_buffer')).alias('input_layer'))
+        features_df, shape = get_image_features_for_layer(model, layer_index, input_df, 0, False, batch_size,
+                                                          backend)
+        features_df = encode_layer_features(sc, features_df, ['image_features'], [shape], codec)
+        # read by both joins, so that the CNN runs once per micro-batch
+        features_df.persist(StorageLevel.MEMORY_AND_DISK)
+        try:
+            matched_df = get_joined_features(features_df, struct_df, broadcast_hash_join) \
+                .select('id', 'image_features', 'features', 'label')
+            pending_df = get_pending_unmatched(spark, fs, output_path, unmatched_path, batch_id)
+            if pending_df is not None:
+                matched_df = matched_df.union(get_joined_features(pending_df, struct_df, broadcast_hash_join)
+                                              .select('id', 'image_features', 'features', 'label'))
+            matched_df.write.mode('overwrite').parquet(output_path.rstrip('/') + '/batch_id=' + str(batch_id))
+            features_df.join(struct_df.select('id'), 'id', 'left_anti').select('id', 'image_features') \
+                .write.mode('overwrite').parquet(unmatched_path + '/batch_id=' + str(batch_id))
+        finally:
+            features_df.unpersist()
+
+    return images_stream_df.writeStream \
+        .foreachBatch(process_batch) \
+        .option('checkpointLocation', checkpoint_path) \
+        .trigger(processingTime=trigger_interval) \
+        .start()
+
+
+def get_pending_unmatched(spark, fs, output_path, unmatched_path, batch_id):
+    """
+        Unmatched rows of the micro-batches before batch_id that no earlier micro-batch has written into the output
+    :param spark: SparkSession
+    :param fs: File system helper of the tables (see input_stats.get_file_system)
+    :param output_path: Parquet table path of the features
+    :param unmatched_path: Parquet table path of the unmatched rows
+    :param batch_id: Current micro-batch id
+    :return: DataFrame of (id, image_features), None when no earlier micro-batch had unmatched rows
+    """
+    if not fs.exists(unmatched_path):
+        return None
+    pending_df = spark.read.parquet(unmatched_path).filter(col('batch_id') < batch_id).select('id', 'image_features')
+    if fs.exists(output_path):
+        output_ids_df = spark.read.parquet(output_path).filter(col('batch_id') < batch_id).select('id')
+        pending_df = pending_df.join(output_ids_df, 'id', 'left_anti')
+    return pending_df
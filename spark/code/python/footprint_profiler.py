@@ -0,0 +1,115 @@
+# coding=utf-8
+'''
+Copyright 2018 Supun Nakandala and Arun Kumar
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+    http://www.apache.org/licenses/LICENSE-2.0
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+'''
+from __future__ import print_function
+
+import argparse
+import json
+import os
+import resource
+import subprocess
+import sys
+
+"""Measures the memory footprints of the CNNs on this machine and TF build. Every model is profiled in its own Python
+process so that the peak RSS of one model does not leak into the next one. Usage (on a machine of the cluster):
+
+    $ python footprint_profiler.py --models alexnet vgg16 resnet50 --batch-size 1
+
+The profile is written to default_profile_path, where Vista picks it up in place of its built-in footprints."""
+this_dir, _ = os.path.split(__file__)
+default_profile_path = os.path.join(this_dir, 'cnn', 'resources', 'model_footprints.json')
+
+GB = 1024.0 * 1024 * 1024
+
+
+def load_model_footprints(default_footprints, profile_path=default_profile_path):
+    """
+        Loads the profiled model footprints, falling back to the given ones for models that were not profiled
+    :param default_footprints: Dict of model name to {'ser': GB, 'runtime': GB}
+    :param profile_path: Path to the profile written by this script
+    :return: Dict of model name to footprint dict
+    """
+    footprints = dict((model, dict(footprint)) for model, footprint in default_footprints.items())
+    if profile_path is not None and os.path.exists(profile_path):
+        with open(profile_path) as f:
+            for model, profile in json.load(f).items():
+                footprints.setdefault(model, {}).update(profile)
+    return footprints
+
+
+def profile_model(model, batch_size):
+    """
+        Builds the whole CNN with its weights and runs a synthetic batch through it
+    :param model: CNN model name (alexnet, vgg16, resnet50)
+    :param batch_size: Number of images per session run
+    :return: Dict with the serialized graph size ('ser') and the peak RSS ('runtime') in GB, and the output bytes per
+             image of every transfer layer ('layer_bytes')
+    """
+    import numpy as np
+    import tensorflow as tf
+
+    from cnn.model_cache import CachedCNN, cnn_models
+
+    base_rss = _get_peak_rss()
+    layer_sizes = cnn_models[model].transfer_layer_flattened_sizes
+    output_layer_indices = [-1 * i for i in range(1, len(layer_sizes))]
+    cnn = CachedCNN(model, 0, output_layer_indices)
+    inputs = np.random.uniform(0, 255, (batch_size, cnn.input_size)).astype(np.float32)
+    outputs = cnn.run(inputs)
+
+    return {
+        'ser': cnn.graph.as_graph_def().ByteSize() / GB,
+        'runtime': _get_peak_rss() / GB,
+        'tf_base': base_rss / GB,
+        # same order as transfer_layer_flattened_sizes, the image layer first
+        'layer_bytes': [inputs.nbytes // batch_size] + [o.nbytes // batch_size for o in reversed(outputs)],
+        'batch_size': batch_size,
+        'tf_version': tf.__version__
+    }
+
+
+def _get_peak_rss():
+    # ru_maxrss is in KB on Linux and in bytes on macOS
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        return peak_rss
+    return peak_rss * 1024
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Profiles the memory footprints of the CNN models')
+    parser.add_argument('--models', nargs='+', default=['alexnet', 'vgg16', 'resnet50'])
+    parser.add_argument('--batch-size', type=int, default=1)
+    parser.add_argument('--output', default=default_profile_path)
+    parser.add_argument('--child', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        print(json.dumps(profile_model(args.models[0], args.batch_size)))
+        sys.exit(0)
+
+    profiles = {}
+    if os.path.exists(args.output):
+        with open(args.output) as f:
+            profiles = json.load(f)
+
+    for model in args.models:
+        output = subprocess.check_output([sys.executable, os.path.abspath(__file__), '--child', '--models', model,
+                                          '--batch-size', str(args.batch_size)], cwd=os.path.abspath(this_dir))
+        # TF may log to stdout before the profile
+        profiles[model] = json.loads(output.decode('utf-8').strip().split('\n')[-1])
+        print(model + ': ' + json.dumps(profiles[model]))
+
+    with open(args.output, 'w') as f:
+        json.dump(profiles, f, indent=2, sort_keys=True)
+    print('Footprint profile written to ' + args.output)
@@ -0,0 +1,91 @@
+# coding=utf-8
+'''
+Copyright 2018 Supun Nakandala and Arun Kumar
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+    http://www.apache.org/licenses/LICENSE-2.0
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+'''
+from __future__ import print_function
+
+import argparse
+import json
+import math
+
+from input_stats import get_file_system, get_image_dir_stats
+
+"""Packs a dir. of one JPEG file per ID into a few large Parquet shards of (id, image_buffer, size, mtime), where size
+and mtime are the ones of the source files. The shards are read with large sequential reads instead of one listing
+entry and one open per image. The Vista image readers (vista_utils.get_images_df and friends) detect a shard table by
+its shard_marker file, so a shard table path can be given wherever an image dir. path is expected. Usage:
+
+    $ spark-submit --jars vista-udfs_2.11-1.0.jar image_shards.py hdfs://.../images hdfs://.../images_shards
+"""
+shard_marker = '_vista_image_shards'
+
+# Size of the shard files, and of their Parquet row groups, the unit Spark splits the shards into tasks at
+target_shard_size = 256 * 1024 * 1024
+row_group_size = 16 * 1024 * 1024
+
+
+def pack_images(sc, image_dir_path, output_path, shard_size=target_shard_size):
+    """
+        Packs the images of a dir. into Parquet shards. The JPEG bytes are stored uncompressed and the rows of every
+        shard are sorted by id.
+    :param sc: SparkContext
+    :param image_dir_path: Images dir. path
+    :param output_path: Shard table path
+    :param shard_size: Target size of a shard file in Bytes
+    :return: Number of shards
+    """
+    from vista_utils import get_images_df, get_image_files_df
+
+    n_shards = max(1, int(math.ceil(1.0 * get_image_dir_stats(image_dir_path)['size'] / shard_size)))
+    images_df = get_images_df(sc, image_dir_path) \
+        .join(get_image_files_df(sc, image_dir_path).select('id', 'size', 'mtime'), 'id')
+    images_df.repartition(n_shards).sortWithinPartitions('id').write.mode('overwrite') \
+        .option('compression', 'uncompressed').option('parquet.block.size', row_group_size).parquet(output_path)
+    # read from the Parquet footers, so that Vista does not count the rows (or the files) of the table again
+    n_images = images_df.sql_ctx.read.parquet(output_path).count()
+    get_file_system(output_path).write_text(output_path.rstrip('/') + '/' + shard_marker,
+                                            json.dumps({'source': image_dir_path, 'shards': n_shards,
+                                                        'count': n_images}))
+    return n_shards
+
+
+def is_image_shards(path):
+    """
+        Whether a path is a shard table written by pack_images
+    :param path: Images dir. or shard table path
+    :return: Boolean
+    """
+    return ',' not in path and get_file_system(path).exists(path.rstrip('/') + '/' + shard_marker)
+
+
+def get_image_shards_count(path):
+    """
+        Number of images of a shard table, recorded by pack_images
+    :param path: Shard table path
+    :return: Number of images. None for a table written before the count was recorded
+    """
+    return json.loads(get_file_system(path).read_text(path.rstrip('/') + '/' + shard_marker)).get('count')
+
+
+if __name__ == '__main__':
+    from pyspark import SparkConf, SparkContext
+
+    parser = argparse.ArgumentParser(description='Packs a dir. of JPEG images into Parquet shards')
+    parser.add_argument('image_dir_path')
+    parser.add_argument('output_path')
+    parser.add_argument('--shard-size-mb', type=int, default=target_shard_size // (1024 * 1024))
+    args = parser.parse_args()
+
+    sc = SparkContext.getOrCreate(conf=SparkConf().setAppName('vista-image-shards'))
+    n = pack_images(sc, args.image_dir_path, args.output_path, args.shard_size_mb * 1024 * 1024)
+    sc.stop()
+    print('Packed ' + args.image_dir_path + ' into ' + str(n) + ' shards at ' + args.output_path)
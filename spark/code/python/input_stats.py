@@ -0,0 +1,258 @@
+# coding=utf-8
+'''
+Copyright 2018 Supun Nakandala and Arun Kumar
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+    http://www.apache.org/licenses/LICENSE-2.0
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+'''
+import hashlib
+import json
+import os
+import shutil
+
+"""Statistics of the Vista inputs (image dir. size and file count, number of structured features and records). HDFS
+paths are read through the Hadoop FileSystem API of the Spark JVM, local paths (file:// or no scheme) directly. The
+statistics are cached per path and modification time in default_cache_path. The modification time of a dir. is its
+own, which changes when a file is added, removed or renamed into it, but not when a file of the dir. is rewritten in
+place: images have to be replaced by writing a new file and renaming it over the old one."""
+default_cache_path = os.path.join(os.path.expanduser('~'), '.vista', 'input_stats.json')
+
+# Number of lines of the structured file read to estimate the record size
+sample_lines = 1000
+
+
+def get_image_dir_stats(dir_path, cache_path=default_cache_path):
+    """
+        Total size and number of files of the image dir.
+    :param dir_path: Images dir. path (hdfs:// or local)
+    :param cache_path: Path to the statistics cache. None disables caching
+    :return: Dict with 'size' in Bytes and 'count'
+    """
+    fs = get_file_system(dir_path)
+    return _get_cached_stats('images', dir_path, fs, cache_path, lambda: fs.get_content_summary(dir_path))
+
+
+def get_struct_file_stats(file_path, cache_path=default_cache_path):
+    """
+        Number of structured features and an estimate of the number of records of the {ID, X_str, y} csv input.
+        The record count is the file size divided by the average size of the first sample_lines lines.
+    :param file_path: Structured csv file (or dir. of csv part files) path (hdfs:// or local)
+    :param cache_path: Path to the statistics cache. None disables caching
+    :return: Dict with 'dS', 'n_records' and 'size' in Bytes
+    """
+    fs = get_file_system(file_path)
+
+    def compute():
+        size = fs.get_content_summary(file_path)['size']
+        lines = fs.read_lines(file_path, sample_lines)
+        if len(lines) == 0:
+            return {'dS': 0, 'n_records': 0, 'size': size}
+        record_size = 1.0 * sum(len(line) + 1 for line in lines) / len(lines)
+        return {'dS': len(lines[0].split(',')) - 2, 'n_records': int(round(size / record_size)), 'size': size}
+
+    return _get_cached_stats('struct', file_path, fs, cache_path, compute)
+
+
+def _get_cached_stats(kind, path, fs, cache_path, compute):
+    key = kind + ':' + path
+    mtime = fs.get_modification_time(path)
+
+    cache = {}
+    if cache_path is not None and os.path.exists(cache_path):
+        try:
+            with open(cache_path) as f:
+                cache = json.load(f)
+        except ValueError:
+            cache = {}
+        if key in cache and cache[key]['mtime'] == mtime:
+            return cache[key]['stats']
+
+    stats = compute()
+    if cache_path is not None:
+        cache[key] = {'mtime': mtime, 'stats': stats}
+        cache_dir = os.path.dirname(cache_path)
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+        tmp_path = cache_path + '.' + str(os.getpid())
+        with open(tmp_path, 'w') as f:
+            json.dump(cache, f)
+        os.rename(tmp_path, cache_path)
+    return stats
+
+
+def get_file_checksum(file_path, cache_path=default_cache_path):
+    """
+        MD5 checksum of a local file (e.g. the CNN weights)
+    :param file_path: Local file path
+    :param cache_path: Path to the statistics cache. None disables caching
+    :return: Hex digest
+    """
+    def compute():
+        md5 = hashlib.md5()
+        with open(file_path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                md5.update(chunk)
+        return md5.hexdigest()
+
+    return _get_cached_stats('checksum', file_path, _LocalFileSystem(), cache_path, compute)
+
+
+def get_file_system(path):
+    """
+        File system helper of a path. HDFS (or any Hadoop supported scheme) paths go through the Spark JVM, file:// and
+        paths without a scheme through the local file system.
+    :param path: File or dir. path
+    :return: File system helper
+    """
+    if is_local_path(path):
+        return _LocalFileSystem()
+    return _HadoopFileSystem()
+
+
+def is_local_path(path):
+    """
+        Whether a path is on the local file system (file:// or no scheme)
+    :param path: File or dir. path
+    :return: Boolean
+    """
+    return path.startswith('file://') or '://' not in path
+
+
+class _HadoopFileSystem(object):
+    """
+        Hadoop FileSystem API accessed through the py4j gateway of the active SparkContext, launching the gateway when
+        no SparkContext exists yet.
+    """
+
+    def __init__(self):
+        from pyspark import SparkContext
+
+        SparkContext._ensure_initialized()
+        self.jvm = SparkContext._jvm
+        if SparkContext._active_spark_context is not None:
+            self.conf = SparkContext._active_spark_context._jsc.hadoopConfiguration()
+        else:
+            self.conf = self.jvm.org.apache.hadoop.conf.Configuration()
+
+    def __get_fs_and_path(self, path):
+        hadoop_path = self.jvm.org.apache.hadoop.fs.Path(path)
+        return hadoop_path.getFileSystem(self.conf), hadoop_path
+
+    def get_content_summary(self, path):
+        fs, hadoop_path = self.__get_fs_and_path(path)
+        summary = fs.getContentSummary(hadoop_path)
+        return {'size': summary.getLength(), 'count': summary.getFileCount()}
+
+    def get_modification_time(self, path):
+        fs, hadoop_path = self.__get_fs_and_path(path)
+        return fs.getFileStatus(hadoop_path).getModificationTime()
+
+    def exists(self, path):
+        fs, hadoop_path = self.__get_fs_and_path(path)
+        return fs.exists(hadoop_path)
+
+    def delete(self, path):
+        fs, hadoop_path = self.__get_fs_and_path(path)
+        fs.delete(hadoop_path, True)
+
+    def rename(self, src_path, dst_path):
+        fs, hadoop_path = self.__get_fs_and_path(src_path)
+        fs.rename(hadoop_path, self.jvm.org.apache.hadoop.fs.Path(dst_path))
+
+    def read_text(self, path):
+        return '\n'.join(self.read_lines(path, float('inf')))
+
+    def write_text(self, path, text):
+        fs, hadoop_path = self.__get_fs_and_path(path)
+        out = fs.create(hadoop_path, True)
+        try:
+            out.write(bytearray(text.encode('utf-8')))
+        finally:
+            out.close()
+
+    def read_lines(self, path, n):
+        fs, hadoop_path = self.__get_fs_and_path(path)
+        if fs.getFileStatus(hadoop_path).isDirectory():
+            files = [s.getPath() for s in fs.listStatus(hadoop_path)
+                     if s.isFile() and not s.getPath().getName().startswith(('.', '_'))]
+            if len(files) == 0:
+                return []
+            hadoop_path = sorted(files, key=lambda p: p.getName())[0]
+
+        reader = self.jvm.java.io.BufferedReader(self.jvm.java.io.InputStreamReader(fs.open(hadoop_path)))
+        try:
+            lines = []
+            line = reader.readLine()
+            while line is not None and len(lines) < n:
+                lines.append(line)
+                line = reader.readLine()
+            return lines
+        finally:
+            reader.close()
+
+
+class _LocalFileSystem(object):
+
+    @staticmethod
+    def __get_files(path):
+        path = path.replace('file://', '')
+        if os.path.isfile(path):
+            return [path]
+        files = []
+        for root, _, names in os.walk(path):
+            files.extend(os.path.join(root, name) for name in names)
+        return sorted(files)
+
+    def get_content_summary(self, path):
+        files = self.__get_files(path)
+        return {'size': sum(os.path.getsize(f) for f in files), 'count': len(files)}
+
+    def get_modification_time(self, path):
+        # milliseconds, of the path itself as with the Hadoop FileSystem API, so that a cache hit does not list the
+        # files of a dir. A dir. mtime changes when a file is added, removed or renamed into it, not when a file is
+        # rewritten in place
+        return int(os.path.getmtime(path.replace('file://', '')) * 1000)
+
+    def exists(self, path):
+        return os.path.exists(path.replace('file://', ''))
+
+    def delete(self, path):
+        path = path.replace('file://', '')
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+        elif os.path.exists(path):
+            os.remove(path)
+
+    def rename(self, src_path, dst_path):
+        os.rename(src_path.replace('file://', ''), dst_path.replace('file://', ''))
+
+    def read_text(self, path):
+        with open(path.replace('file://', '')) as f:
+            return f.read()
+
+    def write_text(self, path, text):
+        path = path.replace('file://', '')
+        if not os.path.exists(os.path.dirname(os.path.abspath(path))):
+            os.makedirs(os.path.dirname(os.path.abspath(path)))
+        tmp_path = path + '.' + str(os.getpid())
+        with open(tmp_path, 'w') as f:
+            f.write(text)
+        os.rename(tmp_path, path)
+
+    def read_lines(self, path, n):
+        files = [f for f in self.__get_files(path) if not os.path.basename(f).startswith(('.', '_'))]
+        if len(files) == 0:
+            return []
+        lines = []
+        with open(files[0]) as f:
+            for line in f:
+                if len(lines) == n:
+                    break
+                lines.append(line.rstrip('\n'))
+        return lines
@@ -0,0 +1,272 @@
+# coding=utf-8
+'''
+Copyright 2018 Supun Nakandala and Arun Kumar
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+    http://www.apache.org/licenses/LICENSE-2.0
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+'''
+from __future__ import division
+
+import math
+import os
+from multiprocessing import Pool
+
+import numpy as np
+
+from cost_model import pca_sample_fraction, reduction_seed
+from scorer import decode_image, pool_features
+
+"""Runs the Vista workload in one process without Spark, for datasets that fit on one machine: the structured csv is
+joined with the image dir., the CNN features of the explored layers are transferred with staged or bulk inference,
+pooled as mergeFeatures does, optionally reduced, and a logistic regression is fitted and evaluated per layer. The
+images are decoded and transferred in chunks by a pool of worker processes, each with its own cached CNN, and the
+features are kept as NumPy arrays. Vista runs it with engine='local', or with engine='auto' for small local datasets
+(see the engine parameter of Vista). It imports neither PySpark nor vista_utils."""
+
+# Maximum number of inference batches decoded and transferred per worker task, and minimum number of tasks per worker
+chunk_batches = 8
+tasks_per_worker = 4
+
+# Gradient descent iterations of the downstream logistic regression
+max_iter = 100
+
+# Seed of the train/test split (as the randomSplit of vista.downstream_ml_func)
+split_seed = 2019
+
+
+def run_local(model, n_layers, struct_input, image_input, inf='staged', n_workers=1, n_threads=None, batch_size=32,
+              pooling='max', pooling_grid=(2, 2), reductions=None, reduced_dim=256, reg_param=0.1, weights_path=None):
+    """
+        Runs the CNN feature transfer workload and returns the downstream accuracy of every explored layer
+    :param model: CNN model name (alexnet, vgg16, resnet50)
+    :param n_layers: Number of layers from the top of the CNN to explore
+    :param struct_input: Local structured data csv path
+    :param image_input: Local images dir. path
+    :param inf: 'staged' transfers every layer from the one below it, 'bulk' all the layers in one CNN pass
+    :param n_workers: Number of worker processes
+    :param n_threads: Number of TensorFlow threads per worker. None uses all the cores
+    :param batch_size: Number of images fed to the CNN per session run
+    :param pooling: Pooling applied to the features of conv layers ('max', 'avg' or 'none')
+    :param pooling_grid: (rows, columns) of the pooled conv features
+    :param reductions: Reduction method of every layer, from the lowest explored layer (-n_layers) to the top (-1).
+                       None, 'random' or 'pca' (see cost_model.get_reduction_method). None reduces no layer
+    :param reduced_dim: Output dimensionality of the feature reduction
+    :param reg_param: L2 regularization of the logistic regression
+    :param weights_path: HDF5 weights file of the CNN. None uses the trained weights in cnn/resources
+    :return: Dictionary of layer index to accuracy
+    """
+    ids, struct_features, labels = read_struct_csv(struct_input)
+    image_paths = list_images(image_input)
+
+    # the join happens before the inference, so that images without a structured record are never decoded
+    rows = [i for i, record_id in enumerate(ids) if record_id in image_paths]
+    struct_features, labels = struct_features[rows], labels[rows]
+
+    layer_indices = [-1 * i for i in reversed(range(1, n_layers + 1))]
+    layers_features = transfer_features(model, inf, layer_indices, [image_paths[ids[i]] for i in rows], n_workers,
+                                        n_threads, batch_size, pooling, pooling_grid, weights_path)
+
+    evaluation_results = {}
+    for layer_index, features, method in zip(layer_indices, layers_features, reductions or [None] * n_layers):
+        features = reduce_features(features, method, reduced_dim)
+        evaluation_results[layer_index] = evaluate_layer(np.hstack([features, struct_features]), labels, reg_param)
+    return evaluation_results
+
+
+def read_struct_csv(path):
+    """
+        Reads the {ID, X_str, y} structured data csv file (or dir. of csv part files)
+    :param path: Local csv path
+    :return: (list of IDs, float32 array [N, dS] of features, int array of labels)
+    """
+    ids, features, labels = [], [], []
+    for file_path in _list_files(path):
+        with open(file_path) as f:
+            for line in f:
+                values = line.rstrip('\n').split(',')
+                if len(values) < 2:
+                    continue
+                ids.append(values[0])
+                features.append([float(x) for x in values[1:-1]])
+                labels.append(int(float(values[-1])))
+    return ids, np.array(features, dtype=np.float32).reshape(len(ids), -1), np.array(labels, dtype=np.int64)
+
+
+def list_images(path):
+    """
+        Lists the images of a dir.
+    :param path: Local images dir. path
+    :return: Dictionary of image ID to file path. The ID is the file name up to its first '.' (as in
+             VistaUDFs.getIdFromPath)
+    """
+    return dict((os.path.basename(f).split('.')[0], f) for f in _list_files(path))
+
+
+def transfer_features(model, inf, layer_indices, image_paths, n_workers=1, n_threads=None, batch_size=32,
+                      pooling='max', pooling_grid=(2, 2), weights_path=None):
+    """
+        Transfers and pools the CNN features of a list of images in a pool of worker processes
+    :param model: CNN model name (alexnet, vgg16, resnet50)
+    :param inf: 'staged' or 'bulk'
+    :param layer_indices: Layer indices from the top of the CNN, from the lowest
+    :param image_paths: Image file paths
+    :param n_workers: Number of worker processes
+    :param n_threads: Number of TensorFlow threads per worker. None uses all the cores
+    :param batch_size: Number of images fed to the CNN per session run
+    :param pooling: Pooling applied to the features of conv layers ('max', 'avg' or 'none')
+    :param pooling_grid: (rows, columns) of the pooled conv features
+    :param weights_path: HDF5 weights file of the CNN. None uses the trained weights in cnn/resources
+    :return: List of float32 arrays of shape [N, pooled layer size], one per layer
+    """
+    chunk_size = int(max(1, min(batch_size * chunk_batches,
+                                math.ceil(len(image_paths) / (tasks_per_worker * n_workers)))))
+    tasks = [(model, inf, layer_indices, image_paths[i:i + chunk_size], batch_size, pooling, pooling_grid, n_threads,
+              weights_path) for i in range(0, len(image_paths), chunk_size)]
+    if len(tasks) == 0:
+        return [np.zeros((0, 0), dtype=np.float32) for _ in layer_indices]
+
+    n_workers = max(1, min(n_workers, len(tasks)))
+    if n_workers == 1:
+        results = [_transfer_chunk(task) for task in tasks]
+    else:
+        # the workers are forked before any CNN session is created, and build their own
+        pool = Pool(n_workers)
+        try:
+            results = pool.map(_transfer_chunk, tasks, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+    return [np.vstack([result[i] for result in results]) for i in range(len(layer_indices))]
+
+
+def _transfer_chunk(args):
+    # imported by the workers, so that the features are pooled and evaluated without TensorFlow
+    from cnn.model_cache import get_cached_cnn, cnn_models
+
+    model, inf, layer_indices, image_paths, batch_size, pooling, pooling_grid, n_threads, weights_path = args
+    shapes = cnn_models[model].transfer_layers_shapes
+    outputs = [[] for _ in layer_indices]
+    for start in range(0, len(image_paths), batch_size):
+        inputs = np.vstack([decode_image(_read_file(path)) for path in image_paths[start:start + batch_size]])
+        if inf == 'bulk':
+            features = get_cached_cnn(model, 0, layer_indices, n_threads, weights_path).run(inputs)
+        else:
+            features = []
+            input_layer_index = 0
+            for layer_index in layer_indices:
+                inputs = get_cached_cnn(model, input_layer_index, [layer_index], n_threads, weights_path).run(inputs)[0]
+                features.append(inputs)
+                input_layer_index = layer_index
+
+        for i, layer_index in enumerate(layer_indices):
+            outputs[i].append(pool_features(features[i], shapes[layer_index], pooling, pooling_grid)
+                              .astype(np.float32))
+    return [np.vstack(output) for output in outputs]
+
+
+def reduce_features(features, method, reduced_dim, sample_fraction=pca_sample_fraction, seed=reduction_seed):
+    """
+        Reduces the dimensionality of the CNN features of a layer. 'pca' projects onto the top principal components of
+        a sample of the rows (uncentered, as the MLlib PCA model), 'random' onto a sparse random projection matrix with
+        1/sqrt(d) density (see VistaUDFs.randomProjection).
+    :param features: float32 array [N, d]
+    :param method: None, 'random' or 'pca'
+    :param reduced_dim: Output dimensionality
+    :param sample_fraction: Fraction of the rows PCA is fitted on
+    :param seed: Seed of the projection matrix and of the sample
+    :return: float32 array [N, reduced_dim]
+    """
+    if method is None:
+        return features
+    rng = np.random.RandomState(seed)
+    d = features.shape[1]
+    if method == 'pca':
+        sample = features[rng.rand(len(features)) < sample_fraction]
+        if len(sample) < 2:
+            sample = features
+        _, eigenvectors = np.linalg.eigh(np.cov(sample, rowvar=False))
+        components = eigenvectors[:, ::-1][:, :reduced_dim].astype(np.float32)
+    else:
+        s = math.sqrt(d)
+        components = rng.choice([-1, 0, 1], size=(d, reduced_dim), p=[0.5 / s, 1 - 1 / s, 0.5 / s]) \
+            .astype(np.float32) * np.float32(math.sqrt(s / reduced_dim))
+    return features.dot(components)
+
+
+def evaluate_layer(features, labels, reg_param=0.1):
+    """
+        Fits a logistic regression on a random 80% of the records and evaluates it on the rest
+    :param features: Merged (CNN + structured) features [N, d]
+    :param labels: int array of labels
+    :param reg_param: L2 regularization
+    :return: Test accuracy
+    """
+    train = np.random.RandomState(split_seed).rand(len(labels)) < 0.8
+    predict = fit_logistic_regression(features[train], labels[train], int(labels.max()) + 1, reg_param)
+    return float(np.mean(predict(features[~train]) == labels[~train]))
+
+
+def fit_logistic_regression(features, labels, n_classes, reg_param=0.1, n_iter=max_iter):
+    """
+        Fits a multinomial logistic regression with an L2 penalty on the standardized features (as MLlib
+        LogisticRegression with standardization), by gradient descent with a backtracking line search
+    :param features: float32 array [N, d]
+    :param labels: int array of labels in [0, n_classes)
+    :param n_classes: Number of classes
+    :param reg_param: L2 regularization
+    :param n_iter: Maximum number of iterations
+    :return: Function predicting the labels of a feature array
+    """
+    mean = features.mean(axis=0)
+    std = features.std(axis=0)
+    std[std == 0] = 1
+    x = (features - mean) / std
+    y = np.eye(n_classes, dtype=np.float32)[labels]
+
+    def loss_and_gradients(w, b):
+        logits = x.dot(w) + b
+        logits -= logits.max(axis=1, keepdims=True)
+        log_p = logits - np.log(np.exp(logits).sum(axis=1, keepdims=True))
+        residuals = (np.exp(log_p) - y) / len(x)
+        loss = -(y * log_p).sum() / len(x) + 0.5 * reg_param * (w ** 2).sum()
+        return loss, x.T.dot(residuals) + reg_param * w, residuals.sum(axis=0)
+
+    w = np.zeros((x.shape[1], n_classes), dtype=np.float32)
+    b = np.zeros(n_classes, dtype=np.float32)
+    loss, grad_w, grad_b = loss_and_gradients(w, b)
+    step = 1.0
+    for _ in range(n_iter):
+        grad_norm = (grad_w ** 2).sum() + (grad_b ** 2).sum()
+        if grad_norm < 1e-10:
+            break
+        while True:
+            new_w, new_b = w - step * grad_w, b - step * grad_b
+            new_loss, new_grad_w, new_grad_b = loss_and_gradients(new_w, new_b)
+            if new_loss <= loss - 0.5 * step * grad_norm or step < 1e-8:
+                break
+            step /= 2
+        w, b, loss, grad_w, grad_b = new_w, new_b, new_loss, new_grad_w, new_grad_b
+        step *= 2
+
+    return lambda f: np.argmax(((f - mean) / std).dot(w) + b, axis=1)
+
+
+def _list_files(path):
+    path = path.replace('file://', '')
+    if os.path.isfile(path):
+        return [path]
+    files = []
+    for root, _, names in os.walk(path):
+        files.extend(os.path.join(root, name) for name in names if not name.startswith(('.', '_')))
+    return sorted(files)
+
+
+def _read_file(path):
+    with open(path, 'rb') as f:
+        return f.read()
@@ -0,0 +1,206 @@
+# coding=utf-8
+'''
+Copyright 2018 Supun Nakandala and Arun Kumar
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+    http://www.apache.org/licenses/LICENSE-2.0
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+'''
+import math
+from functools import reduce
+
+from pyspark.sql import SQLContext
+from pyspark.sql.functions import col, lit
+
+from cnn.model_cache import cnn_models, get_weights_path
+from cost_model import plan_materialization
+from feature_store import get_layer_key
+from image_shards import is_image_shards
+from input_stats import get_file_system
+from vista_utils import get_decoded_images_df, get_decoded_image_files_df, get_image_files_df, \
+    get_image_features_for_layer, encode_layer_features, decode_layer_features, image_to_byte_arr_udf
+
+# Parquet file size targeted by the compaction
+target_file_size = 128 * 1024 * 1024
+# A table is compacted once it has this many times more files than needed at target_file_size
+compaction_factor = 4
+# Largest delta whose ids are pushed into the Parquet scan of a shard table, as at most max_id_ranges id ranges
+max_pushed_ids = 100000
+max_id_ranges = 32
+
+
+def materialize_layer(sc, model, layer_index, images_input, output_path, incremental=True, batch_size=1,
+                      backend='tensorframes', codec='float32'):
+    """
+        Materializes the CNN features of a layer into a Parquet table of (id, input_layer, size, mtime, codec), where
+        size and mtime are the ones of the source image file. In incremental mode only the images that are new or whose
+        size or mtime changed since the last run go through the CNN. They are appended to the table when no image was
+        changed or removed, otherwise the table is rewritten without the stale rows. Tables that accumulate small files
+        are compacted.
+    :param sc: SparkContext
+    :param model: CNN model name (alexnet, vgg16, resnet50)
+    :param layer_index: Layer index from the top of the CNN
+    :param images_input: Images dir. path, or shard table path (see image_shards.py)
+    :param output_path: Parquet table path
+    :param incremental: Whether to update an existing table instead of overwriting it
+    :param batch_size: Number of images fed to the CNN per session run
+    :param backend: CNN inference backend ('tensorframes', 'python' or 'arrow')
+    :param codec: Encoding of the features ('float32', 'float16', 'int8' or 'sparse', see
+                  vista_utils.feature_codecs). Vista has to be given the same feature_codec to read the table
+    :return: Dictionary with the number of computed ('computed') and removed ('removed') images and whether the table
+             was compacted ('compacted')
+    """
+    fs = get_file_system(output_path)
+    files_df = get_image_files_df(sc, images_input)
+
+    # tables written before the source file versions and the codec were recorded, or with another codec, are rebuilt
+    if not incremental or not fs.exists(output_path) or not _has_codec(SQLContext(sc).read.parquet(output_path), codec):
+        _get_layer_features(sc, model, layer_index, get_decoded_images_df(sc, images_input), files_df, batch_size,
+                            backend, codec) \
+            .write.mode('overwrite').parquet(output_path)
+        return {'computed': files_df.count(), 'removed': 0, 'compacted': False}
+
+    materialized_df = SQLContext(sc).read.parquet(output_path)
+    versions_df = materialized_df.select('id', 'size', 'mtime')
+    file_versions_df = files_df.select('id', 'size', 'mtime')
+    # new or changed images, and the rows of the changed or removed ones
+    delta_df = files_df.join(versions_df, ['id', 'size', 'mtime'], 'left_anti')
+    stale_df = versions_df.join(file_versions_df, ['id', 'size', 'mtime'], 'left_anti').select('id')
+
+    n_delta = delta_df.count()
+    n_stale = stale_df.count()
+
+    new_features_df = None
+    if n_delta > 0:
+        delta_images_df = _get_delta_images_df(sc, images_input, delta_df, n_delta)
+        new_features_df = _get_layer_features(sc, model, layer_index, delta_images_df, delta_df, batch_size, backend,
+                                              codec)
+
+    if n_stale > 0:
+        updated_df = materialized_df.join(stale_df, 'id', 'left_anti')
+        if new_features_df is not None:
+            updated_df = updated_df.union(new_features_df.select(*updated_df.columns))
+        _rewrite(updated_df, output_path, fs)
+    elif new_features_df is not None:
+        new_features_df.write.mode('append').parquet(output_path)
+
+    summary = fs.get_content_summary(output_path)
+    num_files = max(1, int(math.ceil(1.0 * summary['size'] / target_file_size)))
+    compacted = summary['count'] > compaction_factor * num_files
+    if compacted:
+        _rewrite(SQLContext(sc).read.parquet(output_path).repartition(num_files), output_path, fs)
+    return {'computed': n_delta, 'removed': n_stale, 'compacted': compacted}
+
+
+def _get_delta_images_df(sc, images_input, delta_df, n_delta):
+    """
+        Reads and decodes the new or changed images only. From an images dir. only their files are opened. From a shard
+        table the rows are picked by a join, with the id ranges of the delta pushed into the Parquet scan, so that the
+        row groups (sorted by id, see image_shards.pack_images) without a changed image are skipped.
+    :return: DataFrame of (id, input_layer)
+    """
+    if not is_image_shards(images_input):
+        return get_decoded_image_files_df(sc, delta_df)
+
+    images_df = SQLContext(sc).read.parquet(images_input)
+    if n_delta <= max_pushed_ids:
+        ids = sorted(row.id for row in delta_df.select('id').collect())
+        step = int(math.ceil(1.0 * len(ids) / max_id_ranges))
+        id_ranges = [col('id').between(ids[i], ids[min(i + step, len(ids)) - 1]) for i in range(0, len(ids), step)]
+        images_df = images_df.filter(reduce(lambda a, b: a | b, id_ranges))
+    return images_df.join(delta_df.select('id'), 'id') \
+        .select('id', image_to_byte_arr_udf(sc, col('image_buffer')).alias('input_layer'))
+
+
+def plan_layers(runs, n_records, storage_budget_gb):
+    """
+        Recommends the layers to materialize for a set of expected exploration runs (see
+        cost_model.plan_materialization)
+    :param runs: Expected exploration runs as a list of (model, n_layers, number of runs)
+    :param n_records: Number of images
+    :param storage_budget_gb: Storage budget in GB
+    :return: (Dict of model name to the sorted layer indices to materialize, expected GFLOPs, storage in GB)
+    """
+    model_layers = dict((model, (cnn_models[model].transfer_layer_flattened_sizes,
+                                 cnn_models[model].transfer_layer_gflops)) for model in set(run[0] for run in runs))
+    return plan_materialization(model_layers, runs, n_records, storage_budget_gb)
+
+
+def materialize_planned_layers(sc, plan, images_input, feature_store, batch_size=1, backend='tensorframes',
+                               codec='float32', weights_path=None):
+    """
+        Stores the planned layers in a feature store. The layers of a model are computed bottom-up, each one from the
+        previous planned layer. Vista runs given the same feature store then start from the highest stored layer below
+        the explored ones.
+    :param sc: SparkContext
+    :param plan: Dict of model name to layer indices to materialize (see plan_layers)
+    :param images_input: Images dir. path, or shard table path (see image_shards.py)
+    :param feature_store: feature_store.FeatureStore
+    :param batch_size: Number of images fed to the CNN per session run
+    :param backend: CNN inference backend ('tensorframes', 'python' or 'arrow')
+    :param codec: Encoding of the stored features (see vista_utils.feature_codecs). The Vista runs have to be given
+                  the same feature_codec to find them
+    :param weights_path: HDF5 weights file of the CNN, or dict of model name to weights file for a plan of several
+                         models. None uses the trained weights in cnn/resources. The Vista runs have to be given the
+                         same weights_path to find the stored layers
+    :return: Dict of model name to the stored table paths, in the order of the plan layers
+    """
+    sql_context = SQLContext(sc)
+    weights_paths = dict((model, weights_path.get(model) if isinstance(weights_path, dict) else weights_path)
+                         for model in plan)
+    keys = dict(((model, i), get_layer_key(model, cnn_models[model].get_transfer_learning_layer_names()[i],
+                                           get_weights_path(model, weights_paths[model]), images_input, codec))
+                for model in plan for i in plan[model])
+    # the planned tables are not evicted in favor of each other
+    keep = list(keys.values())
+
+    paths = {}
+    for model in sorted(plan):
+        layer_names = cnn_models[model].get_transfer_learning_layer_names()
+        shapes = cnn_models[model].transfer_layers_shapes
+        input_df = None
+        starting_layer = 0
+        paths[model] = []
+        for i in sorted(plan[model]):
+            path = feature_store.get(keys[(model, i)])
+            if path is None:
+                if input_df is None:
+                    input_df = get_decoded_images_df(sc, images_input)
+                features_df = get_image_features_for_layer(model, i, input_df, starting_layer, False, batch_size,
+                                                           backend, weights_paths[model])[0]
+                path = feature_store.put(keys[(model, i)], features_df,
+                                         {'model': model, 'layer': layer_names[i], 'image_input': images_input}, keep,
+                                         codec, shapes[i])
+            paths[model].append(path)
+            input_df = sql_context.read.parquet(path).select(
+                'id', decode_layer_features(sc, col('image_features'), shapes[i], codec).alias('input_layer'))
+            starting_layer = i
+    return paths
+
+
+def _has_codec(materialized_df, codec):
+    if 'mtime' not in materialized_df.columns or 'codec' not in materialized_df.columns:
+        return False
+    return materialized_df.filter(col('codec') != codec).limit(1).count() == 0
+
+
+def _get_layer_features(sc, model, layer_index, images_df, files_df, batch_size, backend, codec):
+    features_df, shape = get_image_features_for_layer(model, layer_index, images_df, 0, False, batch_size, backend)
+    features_df = encode_layer_features(sc, features_df, ['image_features'], [shape], codec)
+    return features_df.join(files_df.select('id', 'size', 'mtime'), 'id') \
+        .select('id', col('image_features').alias('input_layer'), 'size', 'mtime', lit(codec).alias('codec'))
+
+
+def _rewrite(df, output_path, fs):
+    # Spark cannot overwrite the table it reads, so the new version is written next to it and swapped in
+    tmp_path = output_path.rstrip('/') + '.tmp'
+    if fs.exists(tmp_path):
+        fs.delete(tmp_path)
+    df.write.parquet(tmp_path)
+    fs.delete(output_path)
+    fs.rename(tmp_path, output_path)
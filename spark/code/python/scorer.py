@@ -0,0 +1,404 @@
+# coding=utf-8
+'''
+Copyright 2018 Supun Nakandala and Arun Kumar
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+    http://www.apache.org/licenses/LICENSE-2.0
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+'''
+from __future__ import print_function, division
+
+import argparse
+import base64
+import io
+import json
+import os
+import random
+import threading
+import time
+
+import numpy as np
+
+from cost_model import get_image_feature_size, get_reduction_method
+from input_stats import get_file_checksum
+
+try:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+    import Queue as queue
+except ImportError:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+    import queue
+
+"""Scores new records with the layer and downstream model picked by a Vista exploration, without Spark. The truncated
+CNN, the pooling of mergeFeatures and the coefficients of the fitted MLlib model (see export_scoring_model) are loaded
+once, and concurrent requests are grouped into micro-batches of at most max_batch_size records, waiting at most
+max_wait_ms for a batch to fill. Usage:
+
+    $ python scorer.py --model-path model.json serve --port 8080
+    $ python scorer.py --model-path model.json benchmark --images-dir ./images --concurrency 16 --requests 2000
+"""
+default_max_batch_size = 32
+default_max_wait_ms = 5.0
+
+image_size = 227
+
+
+def export_scoring_model(path, ml_model, model, layer_index, pooling='max', pooling_grid=(2, 2), weights_path=None,
+                         feature_reduction=None, reduced_dim=256, dS=None):
+    """
+        Exports a downstream model fitted on the merged features of a layer (see vista_utils.get_feature_projections)
+        for the Scorer. Supports LogisticRegressionModel (binomial and multinomial) and LinearSVCModel, also as the
+        last stage of a PipelineModel or as the best model of a CrossValidatorModel (as fitted by Vista with
+        extra_config, see Vista.best_model). The path and checksum of the CNN weights, the feature reduction and the
+        feature dims are recorded, so that the Scorer refuses to score with other weights or features.
+    :param path: Output JSON file path
+    :param ml_model: Fitted pyspark.ml model
+    :param model: CNN model name (alexnet, vgg16, resnet50)
+    :param layer_index: Layer index from the top of the CNN
+    :param pooling: Pooling the model was trained with ('max', 'avg' or 'none')
+    :param pooling_grid: (rows, columns) of the pooled conv features
+    :param weights_path: HDF5 weights file the model was trained with (Vista.weights_path). None uses the trained
+                         weights in cnn/resources
+    :param feature_reduction: Feature reduction the model was trained with (Vista.feature_reduction)
+    :param reduced_dim: Output dimensionality of the feature reduction (Vista.reduced_dim)
+    :param dS: Number of structured features. None infers it from the number of coefficients
+    """
+    from cnn.model_cache import cnn_models, get_weights_path
+
+    if type(ml_model).__name__ == 'CrossValidatorModel':
+        ml_model = ml_model.bestModel
+    if type(ml_model).__name__ == 'PipelineModel':
+        ml_model = ml_model.stages[-1]
+
+    kind = type(ml_model).__name__
+    if kind == 'LogisticRegressionModel':
+        coefficients = ml_model.coefficientMatrix.toArray().tolist()
+        intercepts = ml_model.interceptVector.toArray().tolist()
+    elif kind == 'LinearSVCModel':
+        coefficients = [ml_model.coefficients.toArray().tolist()]
+        intercepts = [ml_model.intercept]
+    else:
+        raise ValueError('unsupported downstream model: ' + kind)
+
+    image_features_size = get_image_feature_size(cnn_models[model].transfer_layers_shapes[layer_index], pooling,
+                                                 pooling_grid)
+    reduction = get_reduction_method(feature_reduction, image_features_size, reduced_dim)
+    if reduction is not None:
+        image_features_size = reduced_dim
+    if dS is None:
+        dS = len(coefficients[0]) - image_features_size
+    if dS < 0 or len(coefficients[0]) != image_features_size + dS:
+        raise ValueError('the model has ' + str(len(coefficients[0])) + ' coefficients, expected ' +
+                         str(image_features_size) + ' image features and ' + str(dS) + ' structured features')
+
+    weights_path = os.path.abspath(get_weights_path(model, weights_path))
+    with open(path, 'w') as f:
+        json.dump({'kind': kind, 'model': model, 'layer_index': layer_index, 'pooling': pooling,
+                   'pooling_grid': list(pooling_grid), 'weights_path': weights_path,
+                   'weights_md5': get_file_checksum(weights_path), 'reduction': reduction, 'reduced_dim': reduced_dim,
+                   'image_features_size': image_features_size, 'dS': dS, 'coefficients': coefficients,
+                   'intercepts': intercepts}, f)
+
+
+def decode_image(jpeg_bytes):
+    """
+        Decodes a JPEG image into the raw CNN input, resized to 227*227 with the nearest neighbour sampling of
+        VistaUDFs.decodeImage. YCbCr JPEGs are color converted with the float conversion of VistaUDFs.decodeImage.
+    :param jpeg_bytes: JPEG encoded image
+    :return: float32 array of 227*227*3 BGR values in (height, width, channel) order
+    """
+    from PIL import Image
+
+    image = Image.open(io.BytesIO(jpeg_bytes))
+    if image.mode == 'RGB' and image.info.get('adobe_transform', 1) != 0:
+        # the YCbCr samples before the color conversion of the JPEG decoder, as read by ImageIO
+        image.draft('YCbCr', image.size)
+    h, w = image.size[1], image.size[0]
+    rows = np.minimum(((np.arange(image_size) + 0.5) * h / image_size).astype(np.int64), h - 1)
+    cols = np.minimum(((np.arange(image_size) + 0.5) * w / image_size).astype(np.int64), w - 1)
+    if image.mode == 'YCbCr':
+        ycc = np.asarray(image)[rows][:, cols].astype(np.float32)
+        return _ycbcr_to_bgr(ycc[..., 0], ycc[..., 1], ycc[..., 2]).reshape(-1)
+    pixels = np.asarray(image.convert('RGB'))[rows][:, cols]
+    return pixels[..., ::-1].astype(np.float32).reshape(-1)
+
+
+def _ycbcr_to_bgr(y, cb, cr):
+    # the float32 operations of VistaUDFs.toRGB, in the same order, so that the values are the same
+    y = y / np.float32(255)
+    cb, cr = (cr - np.float32(128)) / np.float32(255), (cb - np.float32(128)) / np.float32(255)
+    channels = [y + np.float32(1.4) * cr, y - np.float32(0.343) * cb - np.float32(0.711) * cr,
+                y + np.float32(1.765) * cb]
+    return np.stack([np.floor(np.clip(c, 0, 1) * np.float32(255)) for c in channels], axis=-1).astype(np.float32)
+
+
+def pool_features(features, shape, pooling, pooling_grid):
+    """
+        Pools a batch of conv layer features into a grid as VistaUDFs.pool does. Other layers are returned as is.
+    :param features: float32 array of shape [N, x*y*z]
+    :param shape: Layer shape (x, y, z)
+    :param pooling: 'max', 'avg' or 'none'
+    :param pooling_grid: (rows, columns) of the pooled features
+    :return: Array of shape [N, pooled size]
+    """
+    x, y, z = shape
+    if x <= 1 or pooling == 'none':
+        return features
+    grid_x, grid_y = pooling_grid
+    volume = features.reshape(-1, x, y, z)
+    pooled = np.empty((volume.shape[0], grid_x, grid_y, z), dtype=np.float64)
+    for gi in range(grid_x):
+        i0, i1 = gi * x // grid_x, ((gi + 1) * x + grid_x - 1) // grid_x
+        for gj in range(grid_y):
+            j0, j1 = gj * y // grid_y, ((gj + 1) * y + grid_y - 1) // grid_y
+            cell = volume[:, i0:i1, j0:j1, :]
+            pooled[:, gi, gj, :] = cell.max(axis=(1, 2)) if pooling == 'max' else cell.mean(axis=(1, 2))
+    return pooled.reshape(volume.shape[0], -1)
+
+
+class Scorer(object):
+    """
+        The truncated CNN and the downstream model exported by export_scoring_model. Raises a ValueError when the
+        weights differ from the ones the model was trained with, or when the model was trained on reduced features.
+    """
+
+    def __init__(self, model_path, weights_path=None):
+        """
+        :param model_path: JSON file written by export_scoring_model
+        :param weights_path: Local copy of the CNN weights. None reads the weights path recorded by the export
+        """
+        from cnn.model_cache import CachedCNN, cnn_models
+
+        with open(model_path) as f:
+            config = json.load(f)
+        if 'weights_md5' not in config:
+            raise ValueError(model_path + ' does not record the CNN weights it was trained with, export it again')
+        if config['reduction'] is not None:
+            raise ValueError('the model was trained on ' + config['reduction'] + ' reduced features, which the Scorer '
+                             'does not reproduce')
+        weights_path = weights_path or config['weights_path']
+        if not os.path.exists(weights_path):
+            raise ValueError('CNN weights not found: ' + weights_path)
+        if get_file_checksum(weights_path) != config['weights_md5']:
+            raise ValueError(weights_path + ' differs from the CNN weights the model was trained with (' +
+                             config['weights_path'] + ')')
+
+        self.kind = config['kind']
+        self.pooling = config['pooling']
+        self.pooling_grid = tuple(config['pooling_grid'])
+        self.shape = cnn_models[config['model']].transfer_layers_shapes[config['layer_index']]
+        self.coefficients = np.array(config['coefficients'], dtype=np.float64)
+        self.intercepts = np.array(config['intercepts'], dtype=np.float64)
+        self.image_features_size = get_image_feature_size(self.shape, self.pooling, self.pooling_grid)
+        self.dS = config['dS']
+        if self.image_features_size != config['image_features_size'] or \
+                self.coefficients.shape[1] != self.image_features_size + self.dS:
+            raise ValueError('the model has ' + str(self.coefficients.shape[1]) + ' coefficients, expected ' +
+                             str(self.image_features_size) + ' image features and ' + str(self.dS) +
+                             ' structured features')
+        self.cnn = CachedCNN(config['model'], 0, [config['layer_index']], weights_path=weights_path)
+
+    def prepare(self, image, struct_features):
+        """
+            Decodes and validates a record
+        :param image: JPEG encoded image
+        :param struct_features: Structured features
+        :return: (float32 CNN input, float64 array of the structured features)
+        """
+        features = np.array(struct_features, dtype=np.float64).reshape(-1)
+        if len(features) != self.dS:
+            raise ValueError('expected ' + str(self.dS) + ' structured features, got ' + str(len(features)))
+        return decode_image(image), features
+
+    def score(self, images, struct_features):
+        """
+            Scores a batch of records
+        :param images: List of JPEG encoded images
+        :param struct_features: List of structured feature lists
+        :return: List of (prediction, class probabilities or None for LinearSVC) pairs
+        """
+        records = [self.prepare(image, features) for image, features in zip(images, struct_features)]
+        return self.score_prepared([r[0] for r in records], [r[1] for r in records])
+
+    def score_prepared(self, inputs, struct_features):
+        """
+            Scores a batch of records decoded by prepare
+        :param inputs: List of CNN inputs
+        :param struct_features: List of structured feature arrays
+        :return: List of (prediction, class probabilities or None for LinearSVC) pairs
+        """
+        image_features = pool_features(self.cnn.run(np.vstack(inputs))[0], self.shape, self.pooling, self.pooling_grid)
+        features = np.hstack([image_features, np.vstack(struct_features)])
+        margins = features.dot(self.coefficients.T) + self.intercepts
+
+        if self.kind == 'LinearSVCModel':
+            return [(int(m[0] > 0), None) for m in margins]
+        if margins.shape[1] == 1:
+            p = 1.0 / (1.0 + np.exp(-margins[:, 0]))
+            probabilities = np.vstack([1 - p, p]).T
+        else:
+            e = np.exp(margins - margins.max(axis=1, keepdims=True))
+            probabilities = e / e.sum(axis=1, keepdims=True)
+        return [(int(np.argmax(p)), p.tolist()) for p in probabilities]
+
+
+class MicroBatcher(object):
+    """
+        Groups concurrent score requests into batches scored by one thread. Every request is decoded and validated by
+        its own caller before it is batched, so that a bad request fails alone.
+    """
+
+    def __init__(self, scorer, max_batch_size=default_max_batch_size, max_wait_ms=default_max_wait_ms):
+        self.scorer = scorer
+        self.max_batch_size = max_batch_size
+        self.max_wait_ms = max_wait_ms
+        self.requests = queue.Queue()
+        self.thread = threading.Thread(target=self.__run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def submit(self, image, struct_features):
+        """
+            Scores a record, blocking until its batch is scored
+        :param image: JPEG encoded image
+        :param struct_features: Structured features
+        :return: (prediction, class probabilities)
+        """
+        inputs, features = self.scorer.prepare(image, struct_features)
+        request = {'inputs': inputs, 'features': features, 'done': threading.Event()}
+        self.requests.put(request)
+        request['done'].wait()
+        if 'error' in request:
+            raise request['error']
+        return request['result']
+
+    def __run(self):
+        while True:
+            batch = [self.requests.get()]
+            deadline = time.time() + self.max_wait_ms / 1000.0
+            while len(batch) < self.max_batch_size:
+                timeout = deadline - time.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(self.requests.get(timeout=timeout))
+                except queue.Empty:
+                    break
+
+            try:
+                results = self.scorer.score_prepared([r['inputs'] for r in batch], [r['features'] for r in batch])
+                for request, result in zip(batch, results):
+                    request['result'] = result
+            except Exception as e:
+                for request in batch:
+                    request['error'] = e
+            for request in batch:
+                request['done'].set()
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+def serve(batcher, host='0.0.0.0', port=8080):
+    """
+        Serves POST /score requests with a JSON body {"image": base64 JPEG, "features": [structured features]} and
+        responds {"prediction": label, "probability": [class probabilities]}
+    :param batcher: MicroBatcher
+    :param host: Host to bind
+    :param port: Port to bind
+    """
+    class Handler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            if self.path != '/score':
+                self.send_error(404)
+                return
+            try:
+                body = json.loads(self.rfile.read(int(self.headers['Content-Length'])).decode('utf-8'))
+                prediction, probability = batcher.submit(base64.b64decode(body['image']), body['features'])
+                response, status = {'prediction': prediction, 'probability': probability}, 200
+            except Exception as e:
+                response, status = {'error': str(e)}, 400
+            output = json.dumps(response).encode('utf-8')
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(output)))
+            self.end_headers()
+            self.wfile.write(output)
+
+        def log_message(self, format, *args):
+            pass
+
+    _ThreadingHTTPServer((host, port), Handler).serve_forever()
+
+
+def run_load_test(submit, records, concurrency, n_requests):
+    """
+        Sends score requests from concurrent clients, each waiting for its response before sending the next one
+    :param submit: Function scoring one record, e.g. MicroBatcher.submit
+    :param records: List of (image, structured features) records picked at random
+    :param concurrency: Number of concurrent clients
+    :param n_requests: Total number of requests
+    :return: Dict with the p50 and p99 latencies in ms and the throughput in requests/s
+    """
+    latencies = []
+    lock = threading.Lock()
+
+    def client(index, n):
+        # seeded with the client index, so that the clients sending the same number of requests differ
+        rng = random.Random(index)
+        for _ in range(n):
+            image, features = records[rng.randrange(len(records))]
+            start = time.time()
+            submit(image, features)
+            with lock:
+                latencies.append((time.time() - start) * 1000)
+
+    start = time.time()
+    clients = [threading.Thread(target=client, args=(i, n_requests // concurrency + (1 if i < n_requests % concurrency
+                                                                                    else 0)))
+               for i in range(concurrency)]
+    for c in clients:
+        c.start()
+    for c in clients:
+        c.join()
+    elapsed = time.time() - start
+    return {'p50_ms': float(np.percentile(latencies, 50)), 'p99_ms': float(np.percentile(latencies, 99)),
+            'throughput': len(latencies) / elapsed}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Scores records with a CNN layer and an exported downstream model')
+    parser.add_argument('--model-path', required=True)
+    parser.add_argument('--weights-path', default=None, help='local copy of the CNN weights the model was trained with')
+    parser.add_argument('--max-batch-size', type=int, default=default_max_batch_size)
+    parser.add_argument('--max-wait-ms', type=float, default=default_max_wait_ms)
+    subparsers = parser.add_subparsers(dest='command')
+    serve_parser = subparsers.add_parser('serve')
+    serve_parser.add_argument('--host', default='0.0.0.0')
+    serve_parser.add_argument('--port', type=int, default=8080)
+    benchmark_parser = subparsers.add_parser('benchmark')
+    benchmark_parser.add_argument('--images-dir', required=True)
+    benchmark_parser.add_argument('--concurrency', type=int, default=16)
+    benchmark_parser.add_argument('--requests', type=int, default=1000)
+    args = parser.parse_args()
+
+    batcher = MicroBatcher(Scorer(args.model_path, args.weights_path), args.max_batch_size, args.max_wait_ms)
+    if args.command == 'serve':
+        serve(batcher, args.host, args.port)
+    else:
+        records = []
+        rng = np.random.RandomState(0)
+        for name in sorted(os.listdir(args.images_dir))[:100]:
+            with open(os.path.join(args.images_dir, name), 'rb') as f:
+                records.append((f.read(), rng.normal(0, 1, batcher.scorer.dS).tolist()))
+        # warm up the session
+        batcher.submit(*records[0])
+        print(json.dumps(run_load_test(batcher.submit, records, args.concurrency, args.requests)))
@@ -0,0 +1,175 @@
+# coding=utf-8
+'''
+Copyright 2018 Supun Nakandala and Arun Kumar
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+    http://www.apache.org/licenses/LICENSE-2.0
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+'''
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from cost_model import GB, get_plans, get_best_plan, get_storage_footprint, get_run_gflops, plan_materialization
+
+"""Tests of the plan costing and selection, and of the pre-materialization planning of cost_model. Run from
+code/python with:
+
+    $ python -m pytest tests
+"""
+# (transfer_layer_flattened_sizes, transfer_layer_gflops, explored layers) of the CNN classes, copied here because the
+# cnn modules import TensorFlow
+models = {
+    'alexnet': ([227 * 227 * 3, 13 * 13 * 384, 13 * 13 * 256, 4096, 4096, 1000], [0, 1.18, 0.15, 0.075, 0.034, 0.008],
+                4),
+    'vgg16': ([227 * 227 * 3, 14 * 14 * 512, 4096, 4096, 1000], [0, 30.6, 0.206, 0.034, 0.008], 3),
+    'resnet50': ([227 * 227 * 3, 14 * 14 * 1024, 7 * 7 * 2048, 7 * 7 * 2048, 7 * 7 * 2048, 1000],
+                 [0, 5.8, 0.54, 0.54, 0.54, 0.004], 5)
+}
+
+n_records = 100000
+dS = 100
+n_nodes = 8
+cpu = 5
+max_broadcast = 0.1
+
+
+def get_model_plans(model, storage_memory, n_layers=None):
+    sizes, gflops, default_n_layers = models[model]
+    return get_plans(sizes, gflops, n_layers or default_n_layers, 0, n_records, dS, n_nodes, cpu, storage_memory,
+                     max_broadcast)
+
+
+class TestPlanSelection(unittest.TestCase):
+
+    def test_generous_memory_picks_bulk(self):
+        for model in models:
+            plan = get_best_plan(get_model_plans(model, 1000.0))
+            self.assertEqual((plan.inf, plan.operator, plan.join, plan.fits), ('bulk', 'after-join', 'b', True),
+                             model)
+
+    def test_tight_memory_picks_staged(self):
+        # room for the two adjacent layers persisted by staged inference, but not for all the bulk layers
+        for model in models:
+            sizes, _, n_layers = models[model]
+            bulk = get_storage_footprint('bulk', sizes, n_layers, dS, n_records)
+            staged = get_storage_footprint('staged', sizes, n_layers, dS, n_records)
+            self.assertLess(staged, bulk, model)
+            plan = get_best_plan(get_model_plans(model, (bulk + staged) / 2))
+            self.assertEqual((plan.inf, plan.fits), ('staged', True), model)
+
+    def test_plan_that_does_not_fit_is_never_picked(self):
+        for model in models:
+            sizes, _, n_layers = models[model]
+            staged = get_storage_footprint('staged', sizes, n_layers, dS, n_records)
+            for storage_memory in [staged * f for f in [0.5, 0.99, 1.0, 1.05, 1.2, 2.0, 10.0]]:
+                plans = get_model_plans(model, storage_memory)
+                plan = get_best_plan(plans)
+                if any(p.fits for p in plans):
+                    self.assertTrue(plan.fits, (model, storage_memory))
+                    self.assertLessEqual(plan.storage_gb, storage_memory, (model, storage_memory))
+                else:
+                    # nothing fits: the smallest footprint is picked
+                    self.assertEqual(plan.storage_gb, min(p.storage_gb for p in plans), (model, storage_memory))
+
+    def test_struct_table_too_large_to_broadcast(self):
+        sizes, gflops, n_layers = models['alexnet']
+        plans = get_plans(sizes, gflops, n_layers, 0, n_records, 10000, n_nodes, cpu, 1000.0, max_broadcast)
+        self.assertTrue(all(p.join == 's' for p in plans))
+
+    def test_small_struct_table_is_broadcast_with_one_layer(self):
+        # the broadcast (0.094 GB to 8 nodes) moves a few more bytes than the before-join shuffle (0.087 GB), but the
+        # shuffle is also written to and read from disk
+        sizes, gflops, _ = models['alexnet']
+        plans = get_plans(sizes, gflops, 1, 0, 20000, 132, 8, 5, 1000.0, max_broadcast)
+        shuffle_gb = dict(((p.operator, p.join), p.shuffle_gb) for p in plans if p.inf == 'bulk')
+        self.assertLess(shuffle_gb[('before-join', 's')], shuffle_gb[('before-join', 'b')])
+        self.assertEqual(get_best_plan(plans).join, 'b')
+
+
+class TestStorageFootprint(unittest.TestCase):
+
+    def test_known_layer_sizes(self):
+        sizes = [100, 10, 20, 30]
+        # bulk: all the 3 explored layers, staged: the largest pair of adjacent layers (20 + 30), with the structured
+        # features once per persisted layer
+        self.assertAlmostEqual(get_storage_footprint('bulk', sizes, 3, 5, GB), 2.0 * (60 * 4 + 5 * 4))
+        self.assertAlmostEqual(get_storage_footprint('staged', sizes, 3, 5, GB), 2.0 * (50 * 4 + 2 * 5 * 4))
+        # a single layer is persisted alone by both
+        self.assertAlmostEqual(get_storage_footprint('staged', sizes, 1, 5, GB), 2.0 * (30 * 4 + 5 * 4))
+        # float16 features
+        self.assertAlmostEqual(get_storage_footprint('bulk', sizes, 3, 5, GB, feature_width=2), 2.0 * (60 * 2 + 5 * 4))
+        # the train/test splits of a layer with 16 merged features, as doubles
+        self.assertAlmostEqual(get_storage_footprint('bulk', sizes, 3, 5, GB, split_width=16),
+                               2.0 * (60 * 4 + 5 * 4 + 16 * 8))
+
+    def test_models(self):
+        for model, (sizes, _, n_layers) in models.items():
+            expected = 2.0 * (sum(sizes[-n_layers:]) * 4 + dS * 4) * n_records / GB
+            self.assertAlmostEqual(get_storage_footprint('bulk', sizes, n_layers, dS, n_records), expected,
+                                   msg=model)
+        # alexnet staged: conv5 (13*13*256) and fc6 (4096)
+        self.assertAlmostEqual(get_storage_footprint('staged', models['alexnet'][0], 4, dS, n_records),
+                               2.0 * ((13 * 13 * 256 + 4096) * 4 + 2 * dS * 4) * n_records / GB)
+
+
+class TestMaterializationPlanning(unittest.TestCase):
+
+    model_layers = dict((model, (sizes, gflops)) for model, (sizes, gflops, _) in models.items())
+
+    def get_layers_storage_gb(self, model, layers):
+        return sum(models[model][0][i] * 4 for i in layers) * n_records / GB
+
+    def test_run_gflops(self):
+        sizes, gflops, _ = models['alexnet']
+        self.assertAlmostEqual(get_run_gflops(gflops, [], 4, 1), sum(gflops))
+        # conv5 materialized: only fc6, fc7 and fc8 are computed
+        self.assertAlmostEqual(get_run_gflops(gflops, [-4], 4, 1), 0.075 + 0.034 + 0.008)
+        # every explored layer materialized
+        self.assertAlmostEqual(get_run_gflops(gflops, [-4, -3, -2, -1], 4, 1), 0.0)
+        # fc7 is not below the explored layers, so it is read from the store instead of computed but the run still
+        # starts from the images
+        self.assertAlmostEqual(get_run_gflops(gflops, [-2], 4, 1), sum(gflops) - 0.034)
+
+    def test_zero_budget(self):
+        runs = [('alexnet', 4, 5), ('resnet50', 5, 1)]
+        plan, gflops, storage_gb = plan_materialization(self.model_layers, runs, n_records, 0)
+        self.assertEqual(plan, {'alexnet': [], 'resnet50': []})
+        self.assertEqual(storage_gb, 0)
+        self.assertAlmostEqual(gflops, (5 * sum(models['alexnet'][1]) + sum(models['resnet50'][1])) * n_records)
+
+    def test_full_budget(self):
+        runs = [('alexnet', 5, 2), ('vgg16', 4, 1)]
+        budget = self.get_layers_storage_gb('alexnet', range(-5, 0)) + self.get_layers_storage_gb('vgg16', range(-4, 0))
+        plan, gflops, storage_gb = plan_materialization(self.model_layers, runs, n_records, budget)
+        self.assertEqual(plan, {'alexnet': [-5, -4, -3, -2, -1], 'vgg16': [-4, -3, -2, -1]})
+        self.assertAlmostEqual(gflops, 0.0)
+        self.assertAlmostEqual(storage_gb, budget)
+
+    def test_budget_of_one_layer(self):
+        # conv5 saves conv1-conv5 (1.33 GFLOPs per image), more than any layer or set of fc layers that fits
+        runs = [('alexnet', 4, 5)]
+        budget = self.get_layers_storage_gb('alexnet', [-4])
+        plan, gflops, storage_gb = plan_materialization(self.model_layers, runs, n_records, budget)
+        self.assertEqual(plan, {'alexnet': [-4]})
+        self.assertAlmostEqual(gflops, 5 * (0.075 + 0.034 + 0.008) * n_records)
+        self.assertLessEqual(storage_gb, budget)
+
+    def test_budget_of_one_layer_across_models(self):
+        # vgg16 conv5_3 saves 30.6 GFLOPs per image of every vgg16 run, more than any alexnet or resnet50 layer
+        runs = [('alexnet', 2, 3), ('vgg16', 3, 1), ('resnet50', 2, 1)]
+        budget = self.get_layers_storage_gb('vgg16', [-3])
+        plan, _, _ = plan_materialization(self.model_layers, runs, n_records, budget)
+        self.assertEqual(plan['vgg16'], [-3])
+        self.assertEqual(plan['resnet50'], [])
+
+
+if __name__ == '__main__':
+    unittest.main()
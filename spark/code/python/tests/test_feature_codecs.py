@@ -0,0 +1,101 @@
+# coding=utf-8
+'''
+Copyright 2018 Supun Nakandala and Arun Kumar
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+    http://www.apache.org/licenses/LICENSE-2.0
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+'''
+import os
+import sys
+import unittest
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from feature_encoding import encode_features, decode_features
+from local_engine import evaluate_layer
+
+"""Tests of the round-trip error of the compact feature codecs, and of their downstream accuracy delta against float32
+on synthetic post-ReLU features (with the logistic regression of the local engine, without Spark)."""
+# Largest accuracy drop allowed for a compact codec
+max_accuracy_delta = 0.02
+
+
+def get_synthetic_features(n_records=1000, n_classes=4, shape=(4, 4, 16), seed=0):
+    """
+        Post-ReLU conv features whose mean depends on the class, with a channel scale spanning two orders of magnitude
+    :return: (float32 array [N, x*y*z], int array of labels)
+    """
+    rng = np.random.RandomState(seed)
+    labels = np.arange(n_records) % n_classes
+    d = shape[0] * shape[1] * shape[2]
+    channel_scales = np.tile(np.logspace(-1, 1, shape[2]), shape[0] * shape[1])
+    class_means = rng.normal(0, 1, (n_classes, d))
+    features = np.maximum(0, class_means[labels] + rng.normal(0, 6, (n_records, d))) * channel_scales
+    return features.astype(np.float32), labels
+
+
+def round_trip(features, codec, channels):
+    return np.vstack([decode_features(encode_features(f, codec, channels), codec, channels) for f in features])
+
+
+class TestFeatureCodecs(unittest.TestCase):
+
+    def test_float32_and_sparse_are_lossless(self):
+        features, _ = get_synthetic_features(n_records=20)
+        for codec in ['float32', 'sparse']:
+            np.testing.assert_array_equal(round_trip(features, codec, 16), features)
+
+    def test_float16_error(self):
+        features, _ = get_synthetic_features(n_records=50)
+        decoded = round_trip(features, 'float16', 16)
+        self.assertEqual(len(encode_features(features[0], 'float16', 16)), 2 * features.shape[1])
+        # 11 significant bits: the relative rounding error is at most 2^-11 above the smallest normal half
+        normal = np.abs(features) >= 2 ** -14
+        self.assertTrue(np.all(np.abs(decoded - features)[normal] <= np.abs(features)[normal] * 2 ** -11))
+        self.assertTrue(np.all(np.abs(decoded - features)[~normal] <= 2 ** -25))
+
+    def test_int8_error(self):
+        features, _ = get_synthetic_features(n_records=50)
+        decoded = round_trip(features, 'int8', 16)
+        self.assertEqual(len(encode_features(features[0], 'int8', 16)), 4 * 16 + features.shape[1])
+        # at most half a quantization step of the channel of the record
+        steps = np.abs(features.reshape(len(features), -1, 16)).max(axis=1) / 127
+        errors = np.abs(decoded - features).reshape(len(features), -1, 16)
+        self.assertTrue(np.all(errors <= steps[:, None, :] * (0.5 + 1e-5)))
+
+    def test_int8_bytes(self):
+        # the scale, then the rounded values with halves rounded up as Scala math.round
+        encoded = encode_features(np.array([1.0, -0.5, 0.0], dtype=np.float32), 'int8', 1)
+        self.assertEqual(np.frombuffer(encoded[:4], dtype='<f4')[0], np.float32(1.0) / np.float32(127))
+        self.assertEqual(np.frombuffer(encoded[4:], dtype=np.int8).tolist(), [127, -63, 0])
+        # an all zero channel has a zero scale
+        np.testing.assert_array_equal(round_trip(np.zeros((1, 8), dtype=np.float32), 'int8', 2), np.zeros((1, 8)))
+
+    def test_sparse_bytes(self):
+        encoded = encode_features(np.array([0, 2.5, 0, 0, 0, 0, 0, 0, 1.0], dtype=np.float32), 'sparse', 1)
+        self.assertEqual(np.frombuffer(encoded[:4], dtype='<i4')[0], 9)
+        self.assertEqual(bytearray(encoded[4:6]), bytearray([2, 1]))
+        self.assertEqual(np.frombuffer(encoded[6:], dtype='<f4').tolist(), [2.5, 1.0])
+
+    def test_accuracy_delta(self):
+        features, labels = get_synthetic_features()
+        struct_features = np.random.RandomState(1).normal(0, 1, (len(labels), 5)).astype(np.float32)
+        float32_accuracy = evaluate_layer(np.hstack([features, struct_features]), labels)
+        # the synthetic task is neither trivial nor hopeless, so that a lossy codec could move the accuracy
+        self.assertGreater(float32_accuracy, 0.5)
+        self.assertLess(float32_accuracy, 0.95)
+        for codec in ['float16', 'int8']:
+            accuracy = evaluate_layer(np.hstack([round_trip(features, codec, 16), struct_features]), labels)
+            self.assertLessEqual(abs(accuracy - float32_accuracy), max_accuracy_delta, codec)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -11,19 +11,29 @@ WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 See the License for the specific language governing permissions and
 limitations under the License.
 '''
-import math, time
+import math, os, threading, time
+from multiprocessing.pool import ThreadPool
 
 from pyspark import SparkConf, SparkContext, StorageLevel
 from pyspark.sql import SQLContext
-from pyspark.sql.functions import col, lit, array
+from pyspark.sql.functions import col
 
 from cnn.alexnet import AlexNet
 from cnn.resnet50 import ResNet50
 from cnn.vgg16 import VGG16
-
-from vista_utils import get_dir_size, get_struct_df, get_images_df, get_joined_features, image_to_byte_arr_udf, \
-    get_image_features_for_layer, get_feature_projections, serialize_cnn_features_udf, \
-    get_all_image_features, slice_layers_udf
+from cnn.model_cache import get_weights_path, cnn_models
+
+from vista_utils import get_dir_size, get_struct_df, get_images_df, get_decoded_images_df, get_joined_features, \
+    image_to_byte_arr_udf, get_image_features_for_layer, get_feature_projections, get_all_image_features, \
+    get_layer_features_cols, encode_layer_features, decode_layer_features, feature_codecs, pca_sample_fraction, \
+    check_spark_version, arrow_min_spark_version
+from cost_model import get_plans, get_best_plan, get_storage_footprint, get_image_feature_size, \
+    get_reduction_method, get_reduction_gflops
+from footprint_profiler import load_model_footprints, default_profile_path
+from input_stats import get_image_dir_stats, get_struct_file_stats, is_local_path
+from image_shards import is_image_shards, get_image_shards_count
+from feature_store import get_layer_key
+from local_engine import run_local
 
 import sys
 sys.path.append('../code/python')
@@ -35,7 +45,21 @@ from pyspark.ml.evaluation import MulticlassClassificationEvaluator
 from pyspark.ml.feature import StringIndexer
 from pyspark.ml.tuning import CrossValidator, ParamGridBuilder
 
-def downstream_ml_func(features_df, results_dict, layer_index, model_name='LogisticRegression', extra_config={}):
+def downstream_ml_func(features_df, results_dict, layer_index, model_name='LogisticRegression', extra_config={},
+                       storage_level=StorageLevel.MEMORY_AND_DISK, parallelism=1, models_dict=None):
+    """
+        Trains and evaluates the downstream model on the merged features of a layer. The train/test splits are
+        persisted once and reused by every estimator, cross-validation fold and the evaluation, and released at the end.
+    :param features_df: Merged (struct+cnn) feature DataFrame
+    :param results_dict: Dictionary object which is used to store downstream ML model performance details such as accuracy.
+    :param layer_index: Layer index of the CNN of which the current features_df correspond to
+    :param model_name: Name of the (PySpark MLLib) downstream ML model
+    :param extra_config: Hyperparameter values to be explored with k-fold cross validation
+    :param storage_level: Storage level of the train/test splits
+    :param parallelism: Maximum number of hyperparameter grid points fitted in parallel (Spark 2.3+)
+    :param models_dict: Dictionary the fitted model is stored into under the layer index. None keeps no model
+    :return: Dictionary
+    """
 
     def hyperparameter_tuned_model(clf, train_df):
 	pipeline = Pipeline(stages=[clf])
@@ -57,52 +81,64 @@ def downstream_ml_func(features_df, results_dict, layer_index, model_name='Logis
                       estimatorParamMaps=paramGrid,
                       evaluator=MulticlassClassificationEvaluator(),
                       numFolds=numFolds)
+        if min(parallelism, len(paramGrid)) > 1:
+            crossval.setParallelism(min(parallelism, len(paramGrid)))
         # Run cross-validation, and choose the best set of parameters.
         return crossval.fit(train_df)
 
     train_df, test_df = features_df.randomSplit([0.8, 0.2], seed=2019)
+    # the merge projection is computed once per split instead of once per pass of the estimators
+    train_df.persist(storage_level)
+    test_df.persist(storage_level)
+    split_dfs = [train_df, test_df]
+    try:
+        if model_name == 'LogisticRegression':
+            clf = LogisticRegression(labelCol="label", featuresCol="features", maxIter=10, regParam=0.1)
+
+        if model_name == 'LinearSVC':
+            clf = LinearSVC(maxIter=5, regParam=0.01)
+
+        if model_name == 'DecisionTreeClassifier':
+            stringIndexer = StringIndexer(inputCol="label", outputCol="indexed")
+            si_model = stringIndexer.fit(train_df)
+            train_df = si_model.transform(train_df)
+
+            clf = DecisionTreeClassifier(maxDepth=2, labelCol="indexed")
+
+        if model_name == 'GBTClassifier':
+            stringIndexer = StringIndexer(inputCol="label", outputCol="indexed")
+            si_model = stringIndexer.fit(train_df)
+            train_df = si_model.transform(train_df)
+
+            clf = GBTClassifier(labelCol="label", featuresCol="features", maxIter=50, maxDepth=5)
+
+        if model_name == 'RandomForestClassifier':
+            stringIndexer = StringIndexer(inputCol="label", outputCol="indexed")
+            si_model = stringIndexer.fit(train_df)
+            td = si_model.transform(train_df)
 
-    if model_name == 'LogisticRegression':
-        clf = LogisticRegression(labelCol="label", featuresCol="features", maxIter=10, regParam=0.1)
-
-    if model_name == 'LinearSVC':
-        clf = LinearSVC(maxIter=5, regParam=0.01)
-    
-    if model_name == 'DecisionTreeClassifier':
-        stringIndexer = StringIndexer(inputCol="label", outputCol="indexed")
-        si_model = stringIndexer.fit(train_df)
-        train_df = si_model.transform(train_df)
-        
-	clf = DecisionTreeClassifier(maxDepth=2, labelCol="indexed")
-
-    if model_name == 'GBTClassifier':
-        stringIndexer = StringIndexer(inputCol="label", outputCol="indexed")
-        si_model = stringIndexer.fit(train_df)
-        train_df = si_model.transform(train_df)
-        
-	clf = GBTClassifier(labelCol="label", featuresCol="features", maxIter=50, maxDepth=5)
-    
-    if model_name == 'RandomForestClassifier':
-        stringIndexer = StringIndexer(inputCol="label", outputCol="indexed")
-        si_model = stringIndexer.fit(train_df)
-        td = si_model.transform(train_df)
-        
-	clf = RandomForestClassifier(labelCol="label", featuresCol="features")
-    
-    if model_name == 'OneVsRest':
-        lr = LogisticRegression(labelCol="label", featuresCol="features", maxIter=50, regParam=0.5)
-        clf = OneVsRest(labelCol="label", featuresCol="features", predictionCol="prediction", classifier=lr)
-    
-    if extra_config != {}:
-        model = hyperparameter_tuned_model(clf, train_df)
-    else:
-        model = clf.fit(train_df)
-
-    predictions = model.transform(test_df)
-
-    evaluator = MulticlassClassificationEvaluator(labelCol="label", predictionCol="prediction",
-                metricName="accuracy")
-    results_dict[layer_index] = evaluator.evaluate(predictions)
+            clf = RandomForestClassifier(labelCol="label", featuresCol="features")
+
+        if model_name == 'OneVsRest':
+            lr = LogisticRegression(labelCol="label", featuresCol="features", maxIter=50, regParam=0.5)
+            clf = OneVsRest(labelCol="label", featuresCol="features", predictionCol="prediction", classifier=lr)
+
+        if extra_config != {}:
+            model = hyperparameter_tuned_model(clf, train_df)
+        else:
+            model = clf.fit(train_df)
+
+        predictions = model.transform(test_df)
+
+        evaluator = MulticlassClassificationEvaluator(labelCol="label", predictionCol="prediction",
+                    metricName="accuracy")
+        results_dict[layer_index] = evaluator.evaluate(predictions)
+        if models_dict is not None:
+            models_dict[layer_index] = model
+    finally:
+        # released even when a fit fails, e.g. with an invalid extra_config
+        for split_df in split_dfs:
+            split_df.unpersist()
     return results_dict
 
 class Vista(object):
@@ -123,6 +159,14 @@ class Vista(object):
     mem_spark_core_min = 2.4
     mem_spark_user_ml_model = 0.5
 
+    max_inference_batch_size = 256
+    max_concurrent_layer_evals = 4
+    max_cv_parallelism = 4
+
+    # Datasets of at most this many records on the local file system run on the local engine (see local_engine.py)
+    local_engine_max_records = 50000
+
+    # Used for the models missing from the footprint profile (see footprint_profiler.py)
     model_footprints = {
         'alexnet': {'ser': 0.3, 'runtime': 2},
         'vgg16': {'ser': 0.6, 'runtime': 3},
@@ -130,7 +174,12 @@ class Vista(object):
     }
 
     def __init__(self, name, mem_sys, cpu_sys, n_nodes, model, n_layers, start_layer, struct_input,
-                 image_input, n_records, dS, mem_sys_rsv=3, enable_sys_config_optzs=True, gpu=False, tot_gpu_mem=0, model_name='LogisticRegression', extra_config={}):
+                 image_input, n_records=None, dS=None, mem_sys_rsv=3, enable_sys_config_optzs=True, gpu=False, tot_gpu_mem=0, model_name='LogisticRegression', extra_config={},
+                 inference_batch_size=None, inference_backend='tensorframes', feature_pooling='max',
+                 pooling_grid=(2, 2), footprint_profile=default_profile_path, concurrent_layer_eval=False,
+                 feature_store=None, feature_codec='float32', max_sparse_density=0.0, feature_reduction=None,
+                 reduced_dim=256, cache_struct_input=False, engine='spark', weights_path=None,
+                 keep_best_model=False):
         """
             Initializing the Vista Optimizer
         :param name: Name for the Spark job
@@ -142,14 +191,47 @@ class Vista(object):
         :param start_layer: Layer index of the CNN input. Zero means input is raw images
         :param struct_input: HDFS path to the structured input file
         :param image_input: HDFS path to the image data dir on HDFS
-        :param n_records: Number of records in the dataset
-        :param dS:  Number of structured features
+        :param n_records: Number of records in the dataset. None estimates it from the inputs (see input_stats.py)
+        :param dS:  Number of structured features. None reads it from the structured input file
         :param mem_sys_rsv: Amount of memory to be reserved as system reserved memory
         :param enable_sys_config_optzs: Whether to enable system configurations optimizations (spark configurations and physical plan operators)
         :param gpu: GPU available
         :param tot_gpu_mem: If GPU availabel total GPU memory
 	:param ml_model: Name of the (PySpark MLLib) Downstream ML Model to run in the Vista optimizer
 	:param extra_config: Extra configuration settings for hyperparameter tuning with the downstream model
+        :param inference_batch_size: Number of images fed to the CNN per session run. None picks it from the layer sizes
+                                     and the executor memory. 1 runs the CNN row at a time
+        :param inference_backend: 'tensorframes' ships the CNN graph with every query. 'python' runs the CNN in the Python
+                                  workers using graphs and sessions cached once per executor. 'arrow' does the same
+                                  on Arrow record batches through a pandas_udf (requires Spark 2.4+ and pyarrow)
+        :param feature_pooling: Pooling applied to the features of conv layers ('max', 'avg' or 'none')
+        :param pooling_grid: (rows, columns) of the pooled conv features
+        :param footprint_profile: Path to the model footprints measured by footprint_profiler.py. The built-in
+                                  footprints are used for models missing from it
+        :param concurrent_layer_eval: Whether to evaluate the downstream models of the layers concurrently (bulk
+                                      inference) in FAIR scheduler pools
+        :param feature_store: feature_store.FeatureStore. CNN features of the explored layers are read from it when
+                              stored by an earlier run with the same feature_codec, and recorded in it otherwise
+                              (raw image inputs only)
+        :param feature_codec: Encoding of the persisted CNN features ('float32', 'float16', 'int8' or 'sparse', see
+                              vista_utils.feature_codecs). With a non-zero start_layer it must also be the encoding the
+                              layer was pre-materialized with
+        :param max_sparse_density: Merged feature vectors with at most this fraction of non-zero values are fed to the
+                                   downstream model as SparseVectors. 0 always uses DenseVectors
+        :param feature_reduction: Dimensionality reduction of the CNN features of every layer before the structured
+                                  features are appended. None, 'random' (sparse random projection) or 'pca' (fitted on
+                                  a sample). Layers no wider than reduced_dim are not reduced and PCA falls back to
+                                  random projection on very wide layers (see cost_model.get_reduction_method)
+        :param reduced_dim: Output dimensionality of the feature reduction
+        :param cache_struct_input: Whether to cache the parsed structured input as Parquet next to the csv (which needs
+                                   a writable input dir.). Later runs skip the csv parsing until the csv is modified
+        :param engine: 'spark' (default), 'local' (one process without Spark, see local_engine.py) or 'auto', which
+                       picks the local engine for at most local_engine_max_records records when the local engine
+                       supports the workload and its features fit in memory
+        :param weights_path: HDF5 weights file of the CNN. None uses the trained weights in cnn/resources
+        :param keep_best_model: Whether run keeps the downstream model fitted on the most accurate layer in best_model,
+                                as a (layer index, fitted model) pair, e.g. to export it with
+                                scorer.export_scoring_model
         """
         self.name = name
         self.mem_sys = math.floor(mem_sys)
@@ -162,38 +244,58 @@ class Vista(object):
         self.image_input = image_input
         self.n_records = n_records
         self.dS = dS
+        if self.n_records is None or self.dS is None:
+            self.__collect_input_stats()
         self.mem_sys_rsv = mem_sys_rsv
         self.enable_sys_config_optzs = enable_sys_config_optzs
         self.gpu = gpu
         self.tot_gpu_mem = tot_gpu_mem
 	self.model_name = model_name
 	self.extra_config = extra_config
-
-        self.inf = 'staged'
-        self.operator = 'after-join'
-        self.join = self.__get_join()
-
+        self.inference_batch_size = inference_batch_size
+        self.inference_backend = inference_backend
+        self.feature_pooling = feature_pooling
+        self.pooling_grid = pooling_grid
+        self.concurrent_layer_eval = concurrent_layer_eval
+        self.feature_store = feature_store
+        self.feature_codec = feature_codec
+        self.max_sparse_density = max_sparse_density
+        self.feature_reduction = feature_reduction
+        self.reduced_dim = reduced_dim
+        self.cache_struct_input = cache_struct_input
+        self.engine = engine
+        self.weights_path = weights_path
+        self.keep_best_model = keep_best_model
+        self.best_model = None
+        self.__best_accuracy = None
+        self.__best_model_lock = threading.Lock()
+        self.model_footprints = load_model_footprints(Vista.model_footprints, footprint_profile)
 
         if(self.enable_sys_config_optzs):
             self.cpu_spark = self.__get_cpu_spark()
             self.num_partitions = self.__get_num_partitions(self.cpu_spark)
             self.heap = int(self.__get_heap_size())
             self.core_memory_fraction = self.__get_spark_core_memory_fraction()
+        else:
+            self.cpu_spark = cpu_sys
+            self.num_partitions = -1
+            self.heap = mem_sys - mem_sys_rsv
+            self.core_memory_fraction = 0.6
+
+        self.inf, self.operator, self.join = self.__get_plan()
+
+        if(self.enable_sys_config_optzs):
             self.persistence = self.__get_persistence_format()
             if self.persistence == 'ser':
                 self.storage_level = StorageLevel(True, True, False, False)
             else:
                 self.storage_level = StorageLevel(True, True, False, True)
         else:
-            self.cpu_spark = cpu_sys
-            self.num_partitions = -1
-            self.heap = mem_sys - mem_sys_rsv
-            self.core_memory_fraction = 0.6
             self.persistence = self.__get_persistence_format()
             self.storage_level = StorageLevel(True, True, False, True)
 
 
-    def __config_spark(self):
+    def __config_spark(self, batch_size=1):
         conf = SparkConf()
         conf.setAppName(self.name)
         conf.set("spark.executor.memory", str(self.heap) + "g")
@@ -203,8 +305,15 @@ class Vista(object):
 
         conf.set("spark.serializer", "org.apache.spark.serializer.KryoSerializer")
         conf.set("spark.shuffle.reduceLocality.enabled", "false")
-
-        if self.enable_sys_config_optzs and self.num_partitions > 0:
+        # the python and arrow inference backends keep the CNN graphs cached in the Python workers
+        conf.set("spark.python.worker.reuse", "true")
+        if self.concurrent_layer_eval:
+            conf.set("spark.scheduler.mode", "FAIR")
+        if self.inference_backend == 'arrow':
+            conf.set("spark.sql.execution.arrow.maxRecordsPerBatch", str(batch_size))
+
+        # the partition count is set by the optimizer, by batched inference or by override_num_partitions
+        if self.num_partitions > 0:
             image_dir_size = get_dir_size(self.image_input)
             if self.num_partitions > image_dir_size / 10485760:
                 conf.set("spark.files.maxPartitionBytes", str(int(math.ceil(image_dir_size / self.num_partitions))))
@@ -212,13 +321,23 @@ class Vista(object):
                 conf.set("spark.files.maxPartitionBytes", "10485760")  # 10MB
         else:
             conf.set("spark.files.maxPartitionBytes", "10485760")  # 10MB
+        # packed image shards are Parquet tables, split by the SQL file source (see image_shards.py)
+        if is_image_shards(self.image_input):
+            conf.set("spark.sql.files.maxPartitionBytes", conf.get("spark.files.maxPartitionBytes"))
 
         sc = SparkContext.getOrCreate(conf=conf)
         sql_context = SQLContext(sc)
 
+        if self.inference_backend == 'arrow':
+            check_spark_version(sc, arrow_min_spark_version, "the 'arrow' inference backend")
+        if self.inference_backend in ['python', 'arrow']:
+            weights_path = get_weights_path(self.model, self.weights_path)
+            if os.path.exists(weights_path):
+                sc.addFile(weights_path)
+
         if self.enable_sys_config_optzs:
             sql_context.sql("SET spark.sql.autoBroadcastJoinThreshold = -1")
-        if self.enable_sys_config_optzs and self.num_partitions > 0:
+        if self.num_partitions > 0:
             sql_context.sql("SET spark.sql.shuffle.partitions = " + str(self.num_partitions))
 
 
@@ -242,50 +361,74 @@ class Vista(object):
             Launch the CNN feature transfer workload
         :return:
         """
-        sc, sql_context = self.__config_spark()
+        self.best_model = None
+        self.__best_accuracy = None
+        engine = self.__get_engine()
+        if self.engine == 'auto':
+            print('Vista engine (auto): ' + engine)
+        if engine == 'local':
+            return self.__run_local()
+
+        batch_size = self.__get_inference_batch_size()
+        if batch_size > 1:
+            self.num_partitions = self.__get_num_partitions_for_batch(batch_size)
+
+        sc, sql_context = self.__config_spark(batch_size)
 
 	print(
-        'Vista Configs(join, cpu, np, heap, f_core, pers): ' + ", ".join([str(x) for x in [self.join, self.cpu_spark,
-                                                                                           self.num_partitions,
-                                                                                           self.heap,
-                                                                                           self.core_memory_fraction,
-                                                                                           self.persistence]]))
+        'Vista Configs(inf, operator, join, cpu, np, heap, f_core, pers, batch): ' + ", ".join([str(x) for x in [
+                                                                                                  self.inf,
+                                                                                                  self.operator,
+                                                                                                  self.join,
+                                                                                                  self.cpu_spark,
+                                                                                                  self.num_partitions,
+                                                                                                  self.heap,
+                                                                                                  self.core_memory_fraction,
+                                                                                                  self.persistence,
+                                                                                                  batch_size]]))
 
         # using a pre-materialized layer
         if (self.start_layer != 0):
-            return self.__run_with_pre_mat(sc, sql_context)
+            return self.__run_with_pre_mat(sc, sql_context, batch_size)
 
-        struct_df = get_struct_df(sc, self.struct_input)
+        # reusing and recording layers in the feature store
+        if self.feature_store is not None:
+            return self.__run_with_feature_store(sc, sql_context, batch_size)
+
+        struct_df = get_struct_df(sc, self.struct_input, cache=self.cache_struct_input)
         images_df = get_images_df(sc, self.image_input)
         evaluation_results = {}
 
         if self.inf == 'bulk':
+            layer_cols = get_layer_features_cols(self.n_layers)
             if self.operator == 'before-join':
-                images_df = images_df.select(col('id'),
-                                             image_to_byte_arr_udf(sc, col('image_buffer')).alias('input_layer'))
-                image_features_df, cum_sizes, shapes = get_all_image_features(self.model, images_df,
-                                                                              self.n_layers)
-                features_df = get_joined_features(image_features_df, struct_df, self.join == 'b')
+                images_df = get_decoded_images_df(sc, self.image_input)
+                image_features_df, shapes = get_all_image_features(self.model, images_df, self.n_layers,
+                                                                   batch_size=batch_size,
+                                                                   backend=self.inference_backend,
+                                                                   weights_path=self.weights_path)
+                features_df = get_joined_features(image_features_df, struct_df, self.join == 'b', layer_cols)
             elif self.operator == 'after-join':
                 joined_df = get_joined_features(
                     images_df.select("id", col("image_buffer").alias("image_features")), struct_df, self.join == 'b') \
                     .select("id", "features", image_to_byte_arr_udf(sc, col('image_features')).alias('input_layer'),
                             "label")
-                features_df, cum_sizes, shapes = get_all_image_features(self.model, joined_df, self.n_layers)
+                features_df, shapes = get_all_image_features(self.model, joined_df, self.n_layers,
+                                                             batch_size=batch_size, backend=self.inference_backend,
+                                                             weights_path=self.weights_path)
 
-            features_df = features_df.select("id", "features", "image_features", "label")
+            features_df = encode_layer_features(sc, features_df.select(*(["id", "features"] + layer_cols + ["label"])),
+                                                layer_cols, shapes, self.feature_codec)
             features_df._jdf.persist(sc._getJavaStorageLevel(self.storage_level))
 
-            sliced_features_df = features_df.withColumn("cumulative_sizes", array([lit(x) for x in cum_sizes]))
-            sliced_features_df = sliced_features_df.withColumn(
-                "image_features", slice_layers_udf(sc, col('image_features'), col('cumulative_sizes')))
-
             # evaluate the models
-            shapes.reverse()
-            for merged_features_df, layer_index in zip(
-                    get_feature_projections(sc, sliced_features_df, self.n_layers, shapes),
-                    range(1, 1 + self.n_layers)):
-                evaluation_results = downstream_ml_func(merged_features_df, evaluation_results, -1 * layer_index, model_name=self.model_name, extra_config=self.extra_config)
+            evaluation_results = self.__evaluate_layers(
+                sc, get_feature_projections(sc, features_df, self.n_layers, shapes, self.feature_pooling,
+                                            self.pooling_grid, layer_cols, self.feature_codec,
+                                            self.max_sparse_density,
+                                            self.__get_layer_reductions([-1 * i for i in range(1, 1 + self.n_layers)]),
+                                            self.reduced_dim),
+                [-1 * i for i in range(1, 1 + self.n_layers)], shapes, evaluation_results)
 
             features_df._jdf.unpersist()
         elif self.inf == 'staged':
@@ -297,10 +440,11 @@ class Vista(object):
                 if not joined:
                     joined = True
                     if self.operator == 'before-join':
-                        images_df = images_df.select(col('id'), image_to_byte_arr_udf(sc, col('image_buffer')).alias(
-                            'input_layer'))
+                        images_df = get_decoded_images_df(sc, self.image_input)
                         image_features_df, shape = get_image_features_for_layer(self.model, layer_index, images_df,
-                                                                                starting_layer, False)
+                                                                                starting_layer, False, batch_size,
+                                                                                self.inference_backend,
+                                                                                self.weights_path)
                         features_df = get_joined_features(image_features_df, struct_df, self.join == 'b')
                     elif self.operator == 'after-join':
                         joined_df = get_joined_features(
@@ -309,29 +453,122 @@ class Vista(object):
                             .select("id", "features",
                                     image_to_byte_arr_udf(sc, col('image_features')).alias('input_layer'), "label")
                         features_df, shape = get_image_features_for_layer(self.model, layer_index, joined_df,
-                                                                          starting_layer)
+                                                                          starting_layer, batch_size=batch_size,
+                                                                          backend=self.inference_backend,
+                                                                          weights_path=self.weights_path)
                 else:
-                    features_df, shape = get_image_features_for_layer(self.model, layer_index, input_df, starting_layer)
+                    features_df, shape = get_image_features_for_layer(self.model, layer_index, input_df, starting_layer,
+                                                                      batch_size=batch_size,
+                                                                      backend=self.inference_backend,
+                                                                      weights_path=self.weights_path)
 
-                features_df = features_df.select("id", "features", "image_features", "label")
+                features_df = encode_layer_features(sc, features_df.select("id", "features", "image_features", "label"),
+                                                    ['image_features'], [shape], self.feature_codec)
                 features_df._jdf.persist(sc._getJavaStorageLevel(self.storage_level))
 
-                merged_features_df = get_feature_projections(sc, features_df, 1, [shape])[0]
+                merged_features_df = get_feature_projections(sc, features_df, 1, [shape], self.feature_pooling,
+                                                             self.pooling_grid, codec=self.feature_codec,
+                                                             max_sparse_density=self.max_sparse_density,
+                                                             reductions=self.__get_layer_reductions([layer_index]),
+                                                             reduced_dim=self.reduced_dim)[0]
 
-                evaluation_results = downstream_ml_func(merged_features_df, evaluation_results, layer_index, model_name=self.model_name, extra_config=self.extra_config)
+                evaluation_results = self.__evaluate_layer(merged_features_df, evaluation_results, layer_index)
 
                 if features_df_prev is not None: features_df_prev._jdf.unpersist()
                 features_df_prev = features_df
 
-                input_df = features_df.select(col('id'), serialize_cnn_features_udf(sc, col('image_features'))
-                                              .alias('input_layer'), col('features'), col('label'))
+                # float32 features are fed to the next stage as is, the others are decoded back to float32
+                input_df = features_df.select(
+                    col('id'), decode_layer_features(sc, col('image_features'), shape, self.feature_codec)
+                    .alias('input_layer'), col('features'), col('label'))
                 starting_layer = layer_index
 
         return evaluation_results
 
+    # using the feature store. Missing layers are computed from the highest stored layer below them and recorded, then
+    # every layer is read back from the store, joined and evaluated. The inference type of the plan is followed: bulk
+    # computes the missing layers in one pass of the CNN, staged one layer per pass reading the previous one back from
+    # the store. The operator placement is always before-join: a stored table holds the features of every image of
+    # the dataset, as its key says, while after-join would only compute the images of the structured table
+    def __run_with_feature_store(self, sc, sql_context, batch_size=1):
+        model_class = cnn_models[self.model]
+        layer_names = model_class.get_transfer_learning_layer_names()
+        weights_path = get_weights_path(self.model, self.weights_path)
+        shapes = model_class.transfer_layers_shapes
+        keys = dict((i, get_layer_key(self.model, layer_names[i], weights_path, self.image_input, self.feature_codec))
+                    for i in range(-1 * (len(layer_names) - 1), 0))
+        explored_layers = [-1 * i for i in range(1, 1 + self.n_layers)]
+        stored = dict((i, self.feature_store.get(keys[i])) for i in explored_layers)
+
+        missing_layers = sorted(i for i in explored_layers if stored[i] is None)
+        if len(missing_layers) > 0:
+            starting_layer = 0
+            input_df = None
+            for i in reversed(range(-1 * (len(layer_names) - 1), missing_layers[0])):
+                path = self.feature_store.get(keys[i])
+                if path is not None:
+                    starting_layer = i
+                    input_df = sql_context.read.parquet(path).select('id', decode_layer_features(
+                        sc, col('image_features'), shapes[i], self.feature_codec).alias('input_layer'))
+                    break
+            if input_df is None:
+                input_df = get_decoded_images_df(sc, self.image_input)
+
+            keep = [keys[i] for i in explored_layers]
+            if self.inf == 'bulk':
+                # every layer from the lowest missing one to the top is an output of the same pass, persisted while
+                # the missing ones are written
+                n_outputs = -1 * missing_layers[0]
+                features_df, _ = get_all_image_features(self.model, input_df, n_outputs, starting_layer, batch_size,
+                                                        self.inference_backend, self.weights_path)
+                features_df._jdf.persist(sc._getJavaStorageLevel(self.storage_level))
+                try:
+                    for i, layer_col in zip(range(1, n_outputs + 1), get_layer_features_cols(n_outputs)):
+                        if stored.get(-1 * i) is None:
+                            stored[-1 * i] = self.feature_store.put(
+                                keys[-1 * i], features_df.select('id', col(layer_col).alias('image_features')),
+                                {'model': self.model, 'layer': layer_names[-1 * i], 'image_input': self.image_input},
+                                keep, self.feature_codec, shapes[-1 * i])
+                finally:
+                    features_df._jdf.unpersist()
+            else:
+                for layer_index in range(missing_layers[0], missing_layers[-1] + 1):
+                    if stored.get(layer_index) is None:
+                        features_df, _ = get_image_features_for_layer(self.model, layer_index, input_df, starting_layer,
+                                                                      False, batch_size, self.inference_backend,
+                                                                      self.weights_path)
+                        stored[layer_index] = self.feature_store.put(
+                            keys[layer_index], features_df,
+                            {'model': self.model, 'layer': layer_names[layer_index], 'image_input': self.image_input},
+                            keep, self.feature_codec, shapes[layer_index])
+                    input_df = sql_context.read.parquet(stored[layer_index]).select('id', decode_layer_features(
+                        sc, col('image_features'), shapes[layer_index], self.feature_codec).alias('input_layer'))
+                    starting_layer = layer_index
+
+        struct_df = get_struct_df(sc, self.struct_input, cache=self.cache_struct_input)
+        explored_shapes = [shapes[i] for i in explored_layers]
+        features_dfs = []
+        merged_features_dfs = []
+        for layer_index, shape in zip(explored_layers, explored_shapes):
+            # persisted as the joined features of the other plans, and read by every pass of the downstream model
+            features_df = get_joined_features(sql_context.read.parquet(stored[layer_index]), struct_df,
+                                              self.join == 'b')
+            features_df._jdf.persist(sc._getJavaStorageLevel(self.storage_level))
+            features_dfs.append(features_df)
+            merged_features_dfs.append(get_feature_projections(sc, features_df, 1, [shape], self.feature_pooling,
+                                                               self.pooling_grid, codec=self.feature_codec,
+                                                               max_sparse_density=self.max_sparse_density,
+                                                               reductions=self.__get_layer_reductions([layer_index]),
+                                                               reduced_dim=self.reduced_dim)[0])
+        try:
+            return self.__evaluate_layers(sc, merged_features_dfs, explored_layers, explored_shapes, {})
+        finally:
+            for features_df in features_dfs:
+                features_df._jdf.unpersist()
+
     # using a pre-materialized layer
-    def __run_with_pre_mat(self, sc, sql_context):
-        struct_df = get_struct_df(sc, self.struct_input)
+    def __run_with_pre_mat(self, sc, sql_context, batch_size=1):
+        struct_df = get_struct_df(sc, self.struct_input, cache=self.cache_struct_input)
         images_df = sql_context.read.parquet(self.image_input)
 
         features_df = images_df.alias('x') \
@@ -339,87 +576,297 @@ class Vista(object):
             .select('x.id', col('x.input_layer').alias('image_features'), 'y.features', 'y.label')
 
         evaluation_results = {}
+        if self.model == 'alexnet':
+            start_shape = AlexNet.transfer_layers_shapes[self.start_layer]
+        elif self.model == 'vgg16':
+            start_shape = VGG16.transfer_layers_shapes[self.start_layer]
+        elif self.model == 'resnet50':
+            start_shape = ResNet50.transfer_layers_shapes[self.start_layer]
+
         if self.start_layer == -1 * self.n_layers:
             features_df._jdf.persist(sc._getJavaStorageLevel(self.storage_level))
-            if self.model == 'alexnet':
-                shape = AlexNet.transfer_layers_shapes[self.start_layer]
-            elif self.model == 'vgg16':
-                shape = VGG16.transfer_layers_shapes[self.start_layer]
-            elif self.model == 'resnet50':
-                shape = ResNet50.transfer_layers_shapes[self.start_layer]
-
-            merged_features_df = get_feature_projections(sc, features_df, 1, [shape])[0]
-            evaluation_results = downstream_ml_func(merged_features_df, evaluation_results, self.start_layer, model_name=self.model_name, extra_config=self.extra_config)
+            merged_features_df = get_feature_projections(sc, features_df, 1, [start_shape], self.feature_pooling,
+                                                         self.pooling_grid, codec=self.feature_codec,
+                                                         max_sparse_density=self.max_sparse_density,
+                                                         reductions=self.__get_layer_reductions([self.start_layer]),
+                                                         reduced_dim=self.reduced_dim)[0]
+            evaluation_results = self.__evaluate_layer(merged_features_df, evaluation_results, self.start_layer)
 
         input_df = features_df.select(col('id'), col('features'), col('label'),
-                                      serialize_cnn_features_udf(sc, col('image_features')).alias('input_layer'))
+                                      decode_layer_features(sc, col('image_features'), start_shape,
+                                                            self.feature_codec).alias('input_layer'))
 
         num_layers_to_explore = self.n_layers - 1
         prev_features_df = features_df
         if self.inf == 'bulk':
-            features_df, cum_sizes, shapes = get_all_image_features(self.model, input_df, num_layers_to_explore,
-                                                                    self.start_layer)
-            features_df = features_df.select("id", "features", "image_features", "label")
+            layer_cols = get_layer_features_cols(num_layers_to_explore)
+            features_df, shapes = get_all_image_features(self.model, input_df, num_layers_to_explore,
+                                                         self.start_layer, batch_size, self.inference_backend,
+                                                         self.weights_path)
+            features_df = encode_layer_features(sc, features_df.select(*(["id", "features"] + layer_cols + ["label"])),
+                                                layer_cols, shapes, self.feature_codec)
             features_df._jdf.persist(sc._getJavaStorageLevel(self.storage_level))
 
-            sliced_features_df = features_df.withColumn("cumulative_sizes", array([lit(x) for x in cum_sizes]))
-            sliced_features_df = sliced_features_df.withColumn(
-                "image_features", slice_layers_udf(sc, col('image_features'), col('cumulative_sizes')))
-
             # evaluate the models
-            shapes.reverse()
-            for merged_features_df, layer_index in zip(
-                    get_feature_projections(sc, sliced_features_df, num_layers_to_explore, shapes),
-                    range(1, 1 + self.n_layers)):
-                evaluation_results = downstream_ml_func(merged_features_df, evaluation_results, -1 * layer_index, model_name=self.model_name, extra_config=self.extra_config)
-                prev_features_df._jdf.unpersist()
+            evaluation_results = self.__evaluate_layers(
+                sc, get_feature_projections(sc, features_df, num_layers_to_explore, shapes,
+                                            self.feature_pooling, self.pooling_grid, layer_cols,
+                                            self.feature_codec, self.max_sparse_density,
+                                            self.__get_layer_reductions(
+                                                [-1 * i for i in range(1, 1 + num_layers_to_explore)]),
+                                            self.reduced_dim),
+                [-1 * i for i in range(1, 1 + num_layers_to_explore)], shapes, evaluation_results)
+            prev_features_df._jdf.unpersist()
 
             features_df._jdf.unpersist()
         elif self.inf == 'staged':
             for i in reversed(range(1, num_layers_to_explore + 1)):
                 layer_index = -1 * i
                 features_df, shape = get_image_features_for_layer(self.model, layer_index, input_df, layer_index - 1,
-                                                                  True)
-                features_df = features_df.select("id", "features", "image_features", "label")
+                                                                  True, batch_size, self.inference_backend,
+                                                                  self.weights_path)
+                features_df = encode_layer_features(sc, features_df.select("id", "features", "image_features", "label"),
+                                                    ['image_features'], [shape], self.feature_codec)
                 features_df._jdf.persist(sc._getJavaStorageLevel(self.storage_level))
 
-                merged_features_df = get_feature_projections(sc, features_df, 1, [shape])[0]
-                evaluation_results = downstream_ml_func(merged_features_df, evaluation_results, layer_index, model_name=self.model_name, extra_config=self.extra_config)
+                merged_features_df = get_feature_projections(sc, features_df, 1, [shape], self.feature_pooling,
+                                                             self.pooling_grid, codec=self.feature_codec,
+                                                             max_sparse_density=self.max_sparse_density,
+                                                             reductions=self.__get_layer_reductions([layer_index]),
+                                                             reduced_dim=self.reduced_dim)[0]
+                evaluation_results = self.__evaluate_layer(merged_features_df, evaluation_results, layer_index)
 
                 prev_features_df._jdf.unpersist()
                 prev_features_df = features_df
-                input_df = features_df.select(col('id'), serialize_cnn_features_udf(sc, col('image_features'))
-                                              .alias('input_layer'), col('features'), col('label'))
+                # float32 features are fed to the next stage as is, the others are decoded back to float32
+                input_df = features_df.select(
+                    col('id'), decode_layer_features(sc, col('image_features'), shape, self.feature_codec)
+                    .alias('input_layer'), col('features'), col('label'))
+
+        return evaluation_results
+
+    # running the whole workload on this machine without Spark (see local_engine.py)
+    def __run_local(self):
+        layer_indices = [-1 * i for i in reversed(range(1, self.n_layers + 1))]
+        n_workers = self.__get_local_workers()
+        batch_size = self.__get_local_inference_batch_size()
+        print('Vista Configs(engine, inf, workers, threads, batch): ' + ", ".join(
+            [str(x) for x in ['local', self.inf, n_workers, max(1, self.cpu_sys // n_workers), batch_size]]))
+        return run_local(self.model, self.n_layers, self.struct_input, self.image_input, self.inf, n_workers,
+                         max(1, self.cpu_sys // n_workers), batch_size, self.feature_pooling, self.pooling_grid,
+                         self.__get_layer_reductions(layer_indices), self.reduced_dim,
+                         weights_path=self.weights_path)
+
+    def __evaluate_layers(self, sc, merged_features_dfs, layer_indices, shapes, evaluation_results):
+        """
+            Runs the downstream ML function on the merged features of every layer. With concurrent_layer_eval the
+            layers are submitted from a pool of driver threads, each into its own FAIR scheduler pool, so that the
+            cluster is kept busy during the driver-side iterations of the small layers.
+        :param sc: SparkContext
+        :param merged_features_dfs: Merged features DataFrame of every layer
+        :param layer_indices: Layer index of every DataFrame
+        :param shapes: Shape of every layer
+        :param evaluation_results: Dictionary the results are merged into
+        :return: Dictionary
+        """
+        concurrency = self.__get_layer_eval_concurrency(layer_indices) if self.concurrent_layer_eval else 1
+        if concurrency == 1:
+            for merged_features_df, layer_index in zip(merged_features_dfs, layer_indices):
+                evaluation_results = self.__evaluate_layer(merged_features_df, evaluation_results, layer_index)
+            return evaluation_results
+
+        def evaluate(args):
+            merged_features_df, layer_index = args
+            # local properties are per thread. Spark 2.x shares py4j threads across Python threads, so the pool is
+            # only reliably isolated with the pinned thread mode of Spark 3 (PYSPARK_PIN_THREAD=true)
+            sc.setLocalProperty("spark.scheduler.pool", "vista-layer" + str(-1 * layer_index))
+            try:
+                return self.__evaluate_layer(merged_features_df, {}, layer_index)
+            finally:
+                sc.setLocalProperty("spark.scheduler.pool", None)
+
+        pool = ThreadPool(concurrency)
+        try:
+            for results in pool.map(evaluate, zip(merged_features_dfs, layer_indices)):
+                evaluation_results.update(results)
+        finally:
+            pool.close()
+        return evaluation_results
 
+    def __evaluate_layer(self, merged_features_df, evaluation_results, layer_index):
+        models = {} if self.keep_best_model else None
+        evaluation_results = downstream_ml_func(merged_features_df, evaluation_results, layer_index,
+                                                model_name=self.model_name, extra_config=self.extra_config,
+                                                storage_level=self.storage_level,
+                                                parallelism=min(Vista.max_cv_parallelism,
+                                                                self.cpu_spark * self.n_nodes),
+                                                models_dict=models)
+        if models is not None:
+            # the layers may be evaluated from a pool of driver threads, see __evaluate_layers
+            with self.__best_model_lock:
+                if self.__best_accuracy is None or evaluation_results[layer_index] > self.__best_accuracy:
+                    self.__best_accuracy = evaluation_results[layer_index]
+                    self.best_model = (layer_index, models[layer_index])
         return evaluation_results
 
+    def __get_layer_eval_concurrency(self, layer_indices):
+        # MLlib caches the training instances of every layer being evaluated (as doubles) in the execution memory, and
+        # downstream_ml_func persists the train/test splits of the layer (the same doubles) in the storage memory
+        memory = self.heap * self.core_memory_fraction * self.n_nodes - \
+                 self.__get_stored_intermediate_table_size(splits=False)
+        layer_memory = 2 * Vista.alpha_2 * self.__get_merged_features_width(layer_indices) * 8 * self.n_records / \
+                       1024 / 1024 / 1024
+        concurrency = int(min(memory / layer_memory, Vista.max_concurrent_layer_evals, len(layer_indices)))
+        return max(concurrency, 1)
+
+    def __get_merged_features_width(self, layer_indices):
+        # widest merged (pooled, optionally reduced, CNN + structured) features fed to the downstream model
+        shapes = cnn_models[self.model].transfer_layers_shapes
+        widths = [get_image_feature_size(shapes[i], self.feature_pooling, self.pooling_grid) if method is None
+                  else self.reduced_dim
+                  for i, method in zip(layer_indices, self.__get_layer_reductions(layer_indices))]
+        return max(widths) + self.dS
+
+    def override_concurrent_layer_eval(self, concurrent_layer_eval):
+        self.concurrent_layer_eval = concurrent_layer_eval
+
     def override_inference_type(self, inf):
         self.inf = inf
 
     def overrdide_operator_placement(self, operator):
         self.operator = operator
 
-    def __get_join(self):
-        size = Vista.alpha_1 * self.dS * 4 * 1 * self.n_records / 1024 / 1024 / 1024
-        if size < Vista.max_broadcast:
-            return 'b'
-        else:
-            return 's'
+    def __collect_input_stats(self):
+        struct_stats = get_struct_file_stats(self.struct_input)
+        if self.dS is None:
+            self.dS = struct_stats['dS']
+        if self.n_records is None:
+            self.n_records = struct_stats['n_records']
+            # records without an image are dropped by the join. A pre-materialized input is a Parquet table, and the
+            # files of a shard table hold many images each (their count is recorded by pack_images)
+            if self.start_layer == 0 and is_image_shards(self.image_input):
+                n_images = get_image_shards_count(self.image_input)
+                if n_images is not None:
+                    self.n_records = min(self.n_records, n_images)
+            elif self.start_layer == 0:
+                self.n_records = min(self.n_records, get_image_dir_stats(self.image_input)['count'])
+
+    def __get_plan(self):
+        plan = get_best_plan(self.get_plans())
+        return plan.inf, plan.operator, plan.join
+
+    def get_plans(self):
+        """
+            Costs every (inference type, operator placement, join) plan. See cost_model.get_plans
+        :return: List of cost_model.Plan
+        """
+        return get_plans(self.__get_transfer_layer_flattened_sizes(), self.__get_transfer_layer_gflops(),
+                         self.n_layers, self.start_layer, self.n_records, self.dS, self.n_nodes, self.cpu_spark,
+                         self.__get_storage_memory(), Vista.max_broadcast, Vista.alpha_1, Vista.alpha_2,
+                         feature_codecs[self.feature_codec], self.__get_reduction_gflops(),
+                         self.__get_merged_features_width([-1 * i for i in range(1, 1 + self.n_layers)]))
 
     def override_join(self, join):
         self.join = join
 
+    def __get_inference_batch_size(self):
+        if self.inference_batch_size is not None:
+            return self.inference_batch_size
+
+        sizes = self.__get_transfer_layer_flattened_sizes()
+        input_index = len(sizes) + self.start_layer if self.start_layer < 0 else 0
+        explored_sizes = sizes[-self.n_layers:]
+        if self.inf == 'bulk':
+            output_size = sum(explored_sizes)
+        else:
+            output_size = max(explored_sizes)
+
+        # TF working memory of a core left after the model itself. The whole remaining CNN is held per image.
+        tf_mem = (self.model_footprints[self.model]['runtime'] - self.model_footprints[self.model]['ser'])
+        tf_image_size = Vista.alpha_2 * sum(sizes[input_index:]) * 4 / 1024.0 / 1024 / 1024
+
+        # Spark user memory of a core holds the input and output blocks of an inference task.
+        user_mem = (self.heap * (1 - self.core_memory_fraction) - Vista.mem_spark_user_rsv) / self.cpu_spark
+        block_image_size = Vista.alpha_2 * (sizes[input_index] + output_size) * 4 / 1024.0 / 1024 / 1024
+
+        batch_size = int(min(tf_mem / tf_image_size, user_mem / block_image_size, Vista.max_inference_batch_size))
+        return max(batch_size, 1)
+
+    def override_inference_batch_size(self, batch_size):
+        self.inference_batch_size = batch_size
+
+    def override_inference_backend(self, backend):
+        self.inference_backend = backend
+
+    def __get_engine(self):
+        if self.engine != 'auto':
+            if self.engine == 'local' and self.__get_local_engine_limitation() is not None:
+                raise ValueError('the local engine does not support ' + self.__get_local_engine_limitation())
+            return self.engine
+        if self.__get_local_engine_limitation() is None and self.n_records <= Vista.local_engine_max_records and \
+                self.__get_local_features_size() + self.model_footprints[self.model]['runtime'] <= \
+                self.mem_sys - self.mem_sys_rsv:
+            return 'local'
+        return 'spark'
+
+    def __get_local_engine_limitation(self):
+        if self.start_layer != 0:
+            return 'pre-materialized layers'
+        if self.feature_store is not None:
+            return 'the feature store'
+        if self.model_name != 'LogisticRegression' or self.extra_config != {}:
+            return 'downstream models other than LogisticRegression without extra_config'
+        if self.keep_best_model:
+            return 'keeping the fitted MLlib model'
+        if not is_local_path(self.struct_input) or not is_local_path(self.image_input) or \
+                is_image_shards(self.image_input):
+            return 'inputs other than a csv file and an images dir. on the local file system'
+        return None
+
+    def override_engine(self, engine):
+        self.engine = engine
+
+    def override_keep_best_model(self, keep_best_model):
+        self.keep_best_model = keep_best_model
+
+    def __get_local_features_size(self):
+        # the pooled (and unreduced) features of every explored layer and the structured features, as float32
+        shapes = cnn_models[self.model].transfer_layers_shapes
+        width = sum(get_image_feature_size(shapes[-1 * i], self.feature_pooling, self.pooling_grid)
+                    for i in range(1, 1 + self.n_layers)) + self.dS
+        return Vista.alpha_2 * width * 4 * self.n_records / 1024.0 / 1024 / 1024
+
+    def __get_local_workers(self):
+        # every worker process holds its own CNN, next to the features collected in this process
+        mem = self.mem_sys - self.mem_sys_rsv - self.__get_local_features_size()
+        return int(max(1, min(self.cpu_sys, math.floor(mem / self.model_footprints[self.model]['runtime']))))
+
+    def __get_local_inference_batch_size(self):
+        if self.inference_batch_size is not None:
+            return self.inference_batch_size
+        sizes = self.__get_transfer_layer_flattened_sizes()
+        tf_mem = (self.model_footprints[self.model]['runtime'] - self.model_footprints[self.model]['ser'])
+        tf_image_size = Vista.alpha_2 * sum(sizes) * 4 / 1024.0 / 1024 / 1024
+        return int(max(1, min(tf_mem / tf_image_size, Vista.max_inference_batch_size)))
+
+    def __get_num_partitions_for_batch(self, batch_size):
+        # map_blocks feeds a whole partition per session run, so the partitions are bounded by the batch size even when
+        # the optimizations are disabled. Partitions are kept a multiple of the total cores.
+        total_cores = self.cpu_spark * self.n_nodes
+        num_partitions = int(math.ceil(1.0 * self.n_records / batch_size / total_cores) * total_cores)
+        return max(self.num_partitions, num_partitions)
+
     def __get_cpu_spark(self):
         if self.gpu:
             #TODO Here the same CPU runtime footprint is taken as the GPU footprint. This is a conservative estimate and if
             #TODO a better estimate can be obtained by profiling
-            cpu_max = int(min(math.floor(self.tot_gpu_mem/Vista.model_footprints[self.model]['runtime']), self.cpu_sys))
+            cpu_max = int(min(math.floor(self.tot_gpu_mem/self.model_footprints[self.model]['runtime']), self.cpu_sys))
         else:
             cpu_max = self.cpu_sys
 
         for i in reversed(range(1, cpu_max)):
-            heap = self.mem_sys - Vista.mem_sys_rsv - i * Vista.model_footprints[self.model]['runtime']
-            user = i * max((Vista.model_footprints[self.model]['ser'] + Vista.alpha_2 * Vista.max_partition_size),
+            heap = self.mem_sys - Vista.mem_sys_rsv - i * self.model_footprints[self.model]['runtime']
+            user = i * max((self.model_footprints[self.model]['ser'] + Vista.alpha_2 * Vista.max_partition_size),
                            Vista.mem_spark_user_ml_model) + Vista.mem_spark_user_rsv
             core = heap - 0.3 - user
             if core >= Vista.mem_spark_core_min:
@@ -437,14 +884,14 @@ class Vista(object):
         self.num_partitions = np
 
     def __get_heap_size(self):
-        return self.mem_sys - Vista.mem_sys_rsv - self.cpu_spark * Vista.model_footprints[self.model]['runtime']
+        return self.mem_sys - Vista.mem_sys_rsv - self.cpu_spark * self.model_footprints[self.model]['runtime']
 
     def override_heap_size(self, heap):
         self.heap = heap
 
     def __get_spark_core_memory_fraction(self):
         user = self.cpu_spark * max(
-            (Vista.model_footprints[self.model]['ser'] + Vista.alpha_2 * Vista.max_partition_size),
+            (self.model_footprints[self.model]['ser'] + Vista.alpha_2 * Vista.max_partition_size),
             Vista.mem_spark_user_ml_model) + Vista.mem_spark_user_rsv
         core = self.heap - 0.3 - user
         return (1.0 * core) / (core + user)
@@ -452,14 +899,45 @@ class Vista(object):
     def override_spark_core_memory_fraction(self, core_mem_fraction):
         self.core_memory_fraction = core_mem_fraction
 
+    def __get_storage_memory(self):
+        return self.heap * self.core_memory_fraction * 0.5 * self.n_nodes
+
     def __get_persistence_format(self):
-        size = self.__get_two_largest_stored_intermediate_table_sizes()
-        total_storage = self.heap * self.core_memory_fraction * 0.5 * self.n_nodes
+        size = self.__get_stored_intermediate_table_size()
+        total_storage = self.__get_storage_memory()
         if size > total_storage:
             return 'ser'
         else:
             return 'deser'
 
+    def override_feature_codec(self, codec):
+        self.feature_codec = codec
+
+    def override_max_sparse_density(self, density):
+        self.max_sparse_density = density
+
+    def override_cache_struct_input(self, cache):
+        self.cache_struct_input = cache
+
+    def override_feature_reduction(self, reduction, reduced_dim=None):
+        self.feature_reduction = reduction
+        if reduced_dim is not None:
+            self.reduced_dim = reduced_dim
+
+    def __get_layer_reductions(self, layer_indices):
+        shapes = cnn_models[self.model].transfer_layers_shapes
+        return [get_reduction_method(self.feature_reduction,
+                                     get_image_feature_size(shapes[i], self.feature_pooling, self.pooling_grid),
+                                     self.reduced_dim) for i in layer_indices]
+
+    def __get_reduction_gflops(self):
+        shapes = cnn_models[self.model].transfer_layers_shapes
+        layer_indices = [-1 * i for i in range(1, 1 + self.n_layers)]
+        return sum(get_reduction_gflops(method,
+                                        get_image_feature_size(shapes[i], self.feature_pooling, self.pooling_grid),
+                                        self.reduced_dim, self.n_records, pca_sample_fraction)
+                   for i, method in zip(layer_indices, self.__get_layer_reductions(layer_indices)))
+
     def override_persistence_format(self, pers):
         self.persistence = pers
         if self.persistence == 'ser':
@@ -467,23 +945,34 @@ class Vista(object):
         else:
             self.storage_level = StorageLevel(True, True, False, True)
 
-    def __get_largest_intermediate_table_size(self):
+    def __get_transfer_layer_flattened_sizes(self):
         if self.model == 'resnet50':
-            n_features = ResNet50.transfer_layer_flattened_sizes[self.n_layers - 1]
+            return ResNet50.transfer_layer_flattened_sizes
         elif self.model == 'alexnet':
-            n_features = AlexNet.transfer_layer_flattened_sizes[self.n_layers - 1]
+            return AlexNet.transfer_layer_flattened_sizes
         elif self.model == 'vgg16':
-            n_features = VGG16.transfer_layer_flattened_sizes[self.n_layers - 1]
-        return Vista.alpha_2 * (max(n_features, 227 * 227 * 3) + self.dS) * 4 * self.n_records / 1024 / 1024 / 1024
+            return VGG16.transfer_layer_flattened_sizes
 
-    def __get_two_largest_stored_intermediate_table_sizes(self):
+    def __get_transfer_layer_gflops(self):
         if self.model == 'resnet50':
-            n_features = sum(ResNet50.transfer_layer_flattened_sizes[self.n_layers - 1: self.n_layers - 2])
+            return ResNet50.transfer_layer_gflops
         elif self.model == 'alexnet':
-            n_features = sum(AlexNet.transfer_layer_flattened_sizes[self.n_layers - 1: self.n_layers - 2])
+            return AlexNet.transfer_layer_gflops
         elif self.model == 'vgg16':
-            n_features = sum(VGG16.transfer_layer_flattened_sizes[self.n_layers - 1: self.n_layers - 2])
-        return Vista.alpha_2 * max(n_features + self.dS, 227 * 227 * 3) * 4 * self.n_records / 1024 / 1024 / 1024
+            return VGG16.transfer_layer_gflops
+
+    def __get_largest_intermediate_table_size(self):
+        sizes = self.__get_transfer_layer_flattened_sizes()
+        n_features = max(sizes[-self.n_layers:])
+        return Vista.alpha_2 * (max(n_features, sizes[0]) + self.dS) * 4 * self.n_records / 1024 / 1024 / 1024
+
+    def __get_stored_intermediate_table_size(self, splits=True):
+        # splits: whether to count the train/test splits of the downstream model of one layer
+        sizes = self.__get_transfer_layer_flattened_sizes()
+        split_width = self.__get_merged_features_width([-1 * i for i in range(1, 1 + self.n_layers)]) if splits else 0
+        size = get_storage_footprint(self.inf, sizes, self.n_layers, self.dS, self.n_records, Vista.alpha_2,
+                                     feature_codecs[self.feature_codec], split_width)
+        return max(size, Vista.alpha_2 * sizes[0] * 4 * self.n_records / 1024 / 1024 / 1024)
 
 
 if __name__ == "__main__":
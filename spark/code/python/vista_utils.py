@@ -11,12 +11,14 @@ WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 See the License for the specific language governing permissions and
 limitations under the License.
 '''
-import os
+
+import re
 
 from pyspark import SQLContext
 from pyspark.ml.classification import LogisticRegression
 from pyspark.ml.evaluation import MulticlassClassificationEvaluator
-from pyspark.sql.types import StructField, StringType, StructType, BinaryType, IntegerType, FloatType
+from pyspark.ml.feature import PCA
+from pyspark.sql.types import StructField, StringType, StructType, BinaryType, IntegerType, FloatType, ArrayType
 from pyspark.sql.functions import col, array, broadcast, lit
 from pyspark.sql.column import _to_java_column, _to_seq, Column
 from pyspark.sql import DataFrame
@@ -24,39 +26,140 @@ from pyspark.sql import DataFrame
 from cnn.alexnet import AlexNet
 from cnn.resnet50 import ResNet50
 from cnn.vgg16 import VGG16
+from cnn.model_cache import cnn_models, get_cached_cnn
+from input_stats import get_image_dir_stats, get_struct_file_stats, get_file_system
+from image_shards import is_image_shards
+from cost_model import pca_sample_fraction, reduction_seed
 
+import numpy as np
 import tensorflow as tf
 import tensorframes as tfs
 
+# Expected fraction of non-zero (post-ReLU) CNN features, used to cost the sparse codec
+sparse_feature_density = 0.3
+
+# Encodings of the persisted CNN features (see VistaUDFs.encodeFeatures) and their bytes per feature
+# Oldest (major, minor) Spark version of the 'arrow' inference backend, whose pandas_udf returns array<binary>
+arrow_min_spark_version = (2, 4)
+
+feature_codecs = {'float32': 4, 'float16': 2, 'int8': 1, 'sparse': 4 * sparse_feature_density + 0.125}
+
 
-def get_struct_df(sc, data_file_path):
+def get_struct_df(sc, data_file_path, schema=None, cache=False):
     """
-        Reads the structured data csv file from HDFS and returns a DataFrame.
+        Reads the structured data csv file from HDFS and returns a DataFrame of (id, features, label). The csv is
+        parsed with an explicit schema, so the features are read as floats directly. With cache the parsed table is
+        also written next to the csv as Parquet (see get_struct_cache_path) and later calls read it instead of the csv
+        until the csv is modified.
     :param sc: SparkContext
     :param data_file_path: HDFS csv file path
+    :param schema: Schema of the csv columns. Defaults to get_struct_schema with the number of features of the file
+    :param cache: Whether to read and write the Parquet cache of the parsed table
     :return: DataFrame
     """
     sql_context = SQLContext(sc)
-    struct_df = sql_context.read.format('csv').options(header='false').load(data_file_path)
+    if cache:
+        fs = get_file_system(data_file_path)
+        cache_path = get_struct_cache_path(data_file_path)
+        mtime = str(fs.get_modification_time(data_file_path))
+        if fs.exists(cache_path + '/_source_mtime') and fs.read_text(cache_path + '/_source_mtime') == mtime:
+            return sql_context.read.parquet(cache_path)
+
+    if schema is None:
+        schema = get_struct_schema(get_struct_file_stats(data_file_path)['dS'])
+    struct_df = sql_context.read.csv(data_file_path, schema=schema, header=False)
     col_names = struct_df.schema.names
-    struct_df = struct_df.withColumn("id", struct_df[col_names[0]].cast(StringType())) \
-        .withColumn("features", array([col(x).cast(FloatType()) for x in col_names[1:-1]])) \
-        .withColumn("label", struct_df[col_names[-1]].cast(IntegerType())) \
-        .select("id", "features", "label")
-    return struct_df
+    struct_df = struct_df.select(col(col_names[0]).cast(StringType()).alias('id'),
+                                 array([col(x) for x in col_names[1:-1]]).cast(ArrayType(FloatType())).alias('features'),
+                                 col(col_names[-1]).cast(IntegerType()).alias('label'))
+    if not cache:
+        return struct_df
+
+    # written next to the cache and swapped in, with the csv mtime it was parsed from
+    tmp_path = cache_path + '.tmp'
+    if fs.exists(tmp_path):
+        fs.delete(tmp_path)
+    struct_df.write.parquet(tmp_path)
+    fs.write_text(tmp_path + '/_source_mtime', mtime)
+    if fs.exists(cache_path):
+        fs.delete(cache_path)
+    fs.rename(tmp_path, cache_path)
+    return sql_context.read.parquet(cache_path)
+
+
+def get_struct_schema(dS):
+    """
+        Schema of the structured data csv: a string ID, dS float features and an integer label
+    :param dS: Number of structured features
+    :return: StructType
+    """
+    return StructType([StructField('id', StringType())] +
+                      [StructField('x' + str(i), FloatType()) for i in range(dS)] +
+                      [StructField('label', IntegerType())])
+
+
+def get_struct_cache_path(data_file_path):
+    """
+        Path of the Parquet cache of a structured data csv (see get_struct_df)
+    :param data_file_path: HDFS csv file path
+    :return: Path
+    """
+    return data_file_path.rstrip('/') + '.parquet'
 
 
 def get_images_df(sc, image_dir_path):
     """
-        Reads images from HDFS and returns a DataFrame.
+        Reads images from HDFS and returns a DataFrame of (id, image_buffer).
     :param sc: SparkContext
-    :param image_dir_path: HDFS image dir. path
+    :param image_dir_path: HDFS image dir. path, or shard table path (see image_shards.py)
     :return: DataFrame
     """
     sql_context = SQLContext(sc)
+    if is_image_shards(image_dir_path):
+        return sql_context.read.parquet(image_dir_path).select('id', 'image_buffer')
     return DataFrame(sc._jvm.vista.udf.VistaUDFs.getImagesDF(sc._jsc, image_dir_path), sql_context)
 
 
+def get_decoded_images_df(sc, image_dir_path):
+    """
+        Reads images from HDFS and decodes them to the raw CNN input format in the same pass. Returns a DataFrame of
+        (id, input_layer).
+    :param sc: SparkContext
+    :param image_dir_path: HDFS image dir. path, or shard table path (see image_shards.py)
+    :return: DataFrame
+    """
+    sql_context = SQLContext(sc)
+    if is_image_shards(image_dir_path):
+        return sql_context.read.parquet(image_dir_path) \
+            .select('id', image_to_byte_arr_udf(sc, col('image_buffer')).alias('input_layer'))
+    return DataFrame(sc._jvm.vista.udf.VistaUDFs.getDecodedImagesDF(sc._jsc, image_dir_path), sql_context)
+
+
+def get_decoded_image_files_df(sc, files_df):
+    """
+        Reads and decodes the image files listed in a DataFrame of (id, path, ...) (see get_image_files_df). Only the
+        listed files are read. Returns a DataFrame of (id, input_layer).
+    :param sc: SparkContext
+    :param files_df: DataFrame of image files
+    :return: DataFrame
+    """
+    return DataFrame(sc._jvm.vista.udf.VistaUDFs.getDecodedImageFilesDF(files_df._jdf), files_df.sql_ctx)
+
+
+def get_image_files_df(sc, image_dir_path):
+    """
+        Lists the image files without reading them. Returns a DataFrame of (id, path, size, mtime). The images of a
+        shard table have the shard table path and the size and mtime of their source files.
+    :param sc: SparkContext
+    :param image_dir_path: HDFS image dir. path, or shard table path (see image_shards.py)
+    :return: DataFrame
+    """
+    sql_context = SQLContext(sc)
+    if is_image_shards(image_dir_path):
+        return sql_context.read.parquet(image_dir_path).select('id', lit(image_dir_path).alias('path'), 'size', 'mtime')
+    return DataFrame(sc._jvm.vista.udf.VistaUDFs.getImageFilesDF(sc._jsc, image_dir_path), sql_context)
+
+
 def downstream_ml_func(features_df, results_dict, layer_index):
     """
         Sample implementation fo the downstream ML function
@@ -74,16 +177,14 @@ def downstream_ml_func(features_df, results_dict, layer_index):
     return results_dict
 
 
-def slice_layers_udf(sc, image_features, cum_sums):
+def get_layer_features_cols(num_layers):
     """
-        Slice bulk inference cnn features into multiple layers
-    :param sc: SparkContext
-    :param image_features: Bulk inference CNN image features
-    :param cum_sums: List containing cumulative sizes of the CNN layer feature sizes
-    :return: DataFrame
+        Names of the image feature columns produced by bulk inference. 'image_features_i' holds the float32 bytes of
+        the i-th layer from the top of the CNN.
+    :param num_layers: Number of layers from the top of the CNN
+    :return: List of column names
     """
-    _slice_layers = sc._jvm.vista.udf.VistaUDFs.sliceLayersUDF()
-    return Column(_slice_layers.apply(_to_seq(sc, [image_features, cum_sums], _to_java_column)))
+    return ['image_features_' + str(i) for i in range(1, num_layers + 1)]
 
 
 def image_to_byte_arr_udf(sc, image_buffer):
@@ -97,104 +198,254 @@ def image_to_byte_arr_udf(sc, image_buffer):
     return Column(_image_to_byte_arr.apply(_to_seq(sc, [image_buffer], _to_java_column)))
 
 
-def merge_features_udf(sc, layer, x, y, z, image_features, structured_features):
+def merge_features_udf(sc, x, y, z, image_features, structured_features, pooling, grid_x, grid_y, codec,
+                       max_sparse_density):
     """
         Merge structured and cnn features into one array
     :param sc:
-    :param layer:
     :param x:
     :param y:
     :param z:
-    :param image_features:
+    :param image_features: CNN features encoded with codec
     :param structured_features:
+    :param pooling: Pooling applied to conv layers ('max', 'avg' or 'none')
+    :param grid_x: Number of output rows of the pooling grid
+    :param grid_y: Number of output columns of the pooling grid
+    :param codec: Encoding of the CNN features (see feature_codecs)
+    :param max_sparse_density: Merged vectors with at most this fraction of non-zero values are SparseVectors
     :return:
     """
     _merge_features = sc._jvm.vista.udf.VistaUDFs.mergeFeaturesUDF()
     return Column(
-        _merge_features.apply(_to_seq(sc, [layer, image_features, structured_features, x, y, z], _to_java_column)))
+        _merge_features.apply(_to_seq(sc, [image_features, structured_features, x, y, z, pooling, grid_x, grid_y,
+                                           codec, max_sparse_density], _to_java_column)))
+
+
+def encode_features_udf(sc, image_features, codec, channels):
+    """
+        Encodes little-endian float32 CNN features with a compact codec. 'float16' halves the size, 'int8' quarters it
+        using one scale per channel and record, and 'sparse' keeps only the non-zero features and a bitmap of them.
+    :param sc: SparkContext
+    :param image_features: CNN features as little-endian float32 bytes
+    :param codec: Encoding (see feature_codecs)
+    :param channels: Number of channels of the layer (see get_feature_channels)
+    :return: Column
+    """
+    _encode_features = sc._jvm.vista.udf.VistaUDFs.encodeFeaturesUDF()
+    return Column(_encode_features.apply(_to_seq(sc, [image_features, lit(codec), lit(channels)], _to_java_column)))
 
 
-def serialize_cnn_features_udf(sc, arr):
+def decode_features_udf(sc, image_features, codec, channels):
     """
-        Serialize CNN features
+        Decodes encoded CNN features back into little-endian float32 bytes, the CNN input format
     :param sc: SparkContext
-    :param arr: CNN features DataFrame
+    :param image_features: Encoded CNN features
+    :param codec: Encoding (see feature_codecs)
+    :param channels: Number of channels of the layer (see get_feature_channels)
+    :return: Column
+    """
+    _decode_features = sc._jvm.vista.udf.VistaUDFs.decodeFeaturesUDF()
+    return Column(_decode_features.apply(_to_seq(sc, [image_features, lit(codec), lit(channels)], _to_java_column)))
+
+
+def get_feature_channels(shape):
+    """
+        Number of channels the int8 codec keeps a scale for. Conv layers have one per filter, fully connected layers
+        a single one.
+    :param shape: Layer shape
+    :return: Number of channels
+    """
+    if shape[0] > 1:
+        return shape[2]
+    return 1
+
+
+def encode_layer_features(sc, features_df, cols, shapes, codec):
+    """
+        Encodes the CNN feature columns of a DataFrame, e.g. before persisting it. A no-op for float32.
+    :param sc: SparkContext
+    :param features_df: DataFrame
+    :param cols: CNN feature columns
+    :param shapes: Layer shape of each column
+    :param codec: Encoding (see feature_codecs)
     :return: DataFrame
     """
-    _serialize_array = sc._jvm.vista.udf.VistaUDFs.serializeCNNFeaturesArrUDF()
-    return Column(_serialize_array.apply(_to_seq(sc, [arr], _to_java_column)))
+    if codec == 'float32':
+        return features_df
+    encoded = dict((c, encode_features_udf(sc, col(c), codec, get_feature_channels(shape)).alias(c))
+                   for c, shape in zip(cols, shapes))
+    return features_df.select(*[encoded.get(c, col(c)) for c in features_df.columns])
 
 
-def get_joined_features(image_features_df, struct_df, broadcast_hash_join):
+def get_joined_features(image_features_df, struct_df, broadcast_hash_join, image_features_cols=None):
     """
         Joins the structured DataFrame and cnn features DataFrame
     :param image_features_df: DataFrame containing image features
     :param struct_df: DataFrame containing structured features
     :param broadcast_hash_join: Boolean. Whether to use broadcast join or hash join
+    :param image_features_cols: Image feature columns to keep. Defaults to ['image_features']
     :return: DataFrame
     """
+    if image_features_cols is None:
+        image_features_cols = ['image_features']
+
     if broadcast_hash_join:
         features_df = image_features_df.alias('x').join(broadcast(struct_df.alias('y')), col('x.id') == col('y.id'))
     else:
         features_df = image_features_df.alias('x').join(struct_df.alias('y'), col('x.id') == col('y.id'))
 
-    features_df = features_df.select('x.id', 'x.image_features', 'y.features', 'y.label')
+    features_df = features_df.select(*(['x.id'] + ['x.' + c for c in image_features_cols] + ['y.features', 'y.label']))
     return features_df
 
 
-def get_feature_projections(sc, features_df, num_layers_to_explore, shapes):
+def decode_layer_features(sc, image_features, shape, codec):
+    """
+        Decodes a CNN feature column into the float32 CNN input format. A no-op for float32.
+    :param sc: SparkContext
+    :param image_features: Encoded CNN features
+    :param shape: Layer shape
+    :param codec: Encoding (see feature_codecs)
+    :return: Column
+    """
+    if codec == 'float32':
+        return image_features
+    return decode_features_udf(sc, image_features, codec, get_feature_channels(shape))
+
+
+def random_projection_udf(sc, image_features, reduced_dim, seed):
+    """
+        Sparse random projection of CNN feature vectors (see VistaUDFs.randomProjection)
+    :param sc: SparkContext
+    :param image_features: CNN feature vectors
+    :param reduced_dim: Output dimensionality
+    :param seed: Seed of the projection matrix
+    :return: Column
+    """
+    _random_projection = sc._jvm.vista.udf.VistaUDFs.randomProjectionUDF()
+    return Column(_random_projection.apply(_to_seq(sc, [image_features, lit(reduced_dim), lit(seed).cast('long')],
+                                                   _to_java_column)))
+
+
+def append_features_udf(sc, image_features, structured_features, max_sparse_density):
+    """
+        Appends the structured features to CNN feature vectors
+    :param sc: SparkContext
+    :param image_features: CNN feature vectors
+    :param structured_features: Structured features
+    :param max_sparse_density: Vectors with at most this fraction of non-zero values are SparseVectors
+    :return: Column
+    """
+    _append_features = sc._jvm.vista.udf.VistaUDFs.appendFeaturesUDF()
+    return Column(_append_features.apply(_to_seq(sc, [image_features, structured_features,
+                                                      lit(float(max_sparse_density))], _to_java_column)))
+
+
+def get_feature_projections(sc, features_df, num_layers_to_explore, shapes, pooling='max', pooling_grid=(2, 2),
+                            image_features_cols=None, codec='float32', max_sparse_density=0.0, reductions=None,
+                            reduced_dim=256):
     """
         Projects CNN features for each layer in the bulk CNN inference approach.
     :param sc: SparkContext
     :param features_df: DataFrame of merged features
     :param num_layers_to_explore: number of layers to be explored
     :param shapes: The shapes of CNN feature layers
+    :param pooling: Pooling applied to conv layers ('max', 'avg' or 'none')
+    :param pooling_grid: (rows, columns) of the pooled conv features
+    :param image_features_cols: Image feature column of each layer. Defaults to the 'image_features' column
+    :param codec: Encoding of the CNN features (see feature_codecs)
+    :param max_sparse_density: Merged vectors with at most this fraction of non-zero values are emitted as
+                               SparseVectors. 0 always emits DenseVectors
+    :param reductions: Dimensionality reduction of each layer (None, 'random' or 'pca', see
+                       cost_model.get_reduction_method), applied to the CNN features before the structured features are
+                       appended. Defaults to no reduction
+    :param reduced_dim: Output dimensionality of the reductions
     :return: DataFrame
     """
-    return [features_df.select('label', merge_features_udf(sc, lit(layer), lit(shapes[layer][0]), lit(shapes[layer][1]),
-                                                           lit(shapes[layer][2]), col('image_features'),
-                                                           col('features'))
-                               .alias('features')) for layer in range(num_layers_to_explore)]
+    if image_features_cols is None:
+        image_features_cols = ['image_features'] * num_layers_to_explore
+    if reductions is None:
+        reductions = [None] * num_layers_to_explore
+
+    projections = []
+    for layer in range(num_layers_to_explore):
+        if reductions[layer] is None:
+            struct_features, density = col('features'), max_sparse_density
+        else:
+            # the CNN features alone, reduced and then merged with the structured features
+            struct_features, density = array().cast(ArrayType(FloatType())), 0.0
+        merged = merge_features_udf(sc, lit(shapes[layer][0]), lit(shapes[layer][1]), lit(shapes[layer][2]),
+                                    col(image_features_cols[layer]), struct_features, lit(pooling),
+                                    lit(pooling_grid[0]), lit(pooling_grid[1]), lit(codec), lit(float(density)))
+        if reductions[layer] is None:
+            projections.append(features_df.select('label', merged.alias('features')))
+            continue
+
+        image_df = features_df.select('label', 'features', merged.alias('image_features'))
+        if reductions[layer] == 'pca':
+            pca = PCA(k=reduced_dim, inputCol='image_features', outputCol='reduced_features')
+            reduced_df = pca.fit(image_df.sample(False, pca_sample_fraction, reduction_seed)).transform(image_df)
+        else:
+            reduced_df = image_df.withColumn('reduced_features', random_projection_udf(sc, col('image_features'),
+                                                                                       reduced_dim, reduction_seed))
+        projections.append(reduced_df.select('label', append_features_udf(sc, col('reduced_features'),
+                                                                          col('features'), max_sparse_density)
+                                             .alias('features')))
+    return projections
 
 
-def get_all_image_features(model_name, joined_df, num_layers_to_explore, cnn_input_layer_index=0):
+def get_all_image_features(model_name, joined_df, num_layers_to_explore, cnn_input_layer_index=0, batch_size=1,
+                           backend='tensorframes', weights_path=None):
     """
         Bulk cnn inference
     :param model_name: CNN model name (AlexNet, VGG16, ResNet50)
     :param joined_df: Input DataFrame containing structured features and raw images
     :param num_layers_to_explore: Number of layer from the top of the CNN to be explored
     :param cnn_input_layer_index: Starting layer index. Zero means raw images
-    :return: DataFrame
+    :param batch_size: Number of images fed to the CNN per session run
+    :param backend: 'tensorframes' ships the graph with the query. 'python' and 'arrow' run the graph cached in the
+                    executors, row by row through mapPartitions or on Arrow record batches through a pandas_udf
+    :param weights_path: HDF5 weights file of the CNN. None uses the trained weights in cnn/resources
+    :return: DataFrame with one binary column per layer (see get_layer_features_cols), and the layer shapes in the
+             same order
     """
+    output_layer_indices = [-1 * i for i in range(1, num_layers_to_explore + 1)]
+    output_cols = get_layer_features_cols(num_layers_to_explore)
+    if backend in ['python', 'arrow']:
+        if backend == 'python':
+            image_features_df = _get_cached_cnn_features(model_name, joined_df, cnn_input_layer_index,
+                                                         output_layer_indices, batch_size, output_cols, weights_path)
+        else:
+            image_features_df = _get_arrow_cnn_features(model_name, joined_df, cnn_input_layer_index,
+                                                        output_layer_indices, batch_size, output_cols, weights_path)
+        return image_features_df, [cnn_models[model_name].transfer_layers_shapes[i] for i in output_layer_indices]
+
+    batched = batch_size > 1
     g = tf.Graph()
     with g.as_default():
-        image_buffer = tf.placeholder(tf.string, [], 'input_layer')
+        image_buffer = _get_input_layer_placeholder(batched)
         image = tf.decode_raw(image_buffer, tf.float32)
 
         if model_name == 'alexnet':
             model = AlexNet(image, input_layer_name=AlexNet.get_transfer_learning_layer_names()[cnn_input_layer_index],
-                            model_name='alexnet')
+                            model_name='alexnet', weights_path=weights_path or 'DEFAULT')
         elif model_name == 'resnet50':
             model = ResNet50(image,
                              input_layer_name=ResNet50.get_transfer_learning_layer_names()[cnn_input_layer_index],
-                             model_name='resnet50')
+                             model_name='resnet50', weights_path=weights_path or 'DEFAULT')
         elif model_name == 'vgg16':
             model = VGG16(image, input_layer_name=VGG16.get_transfer_learning_layer_names()[cnn_input_layer_index],
-                          model_name='vgg16')
+                          model_name='vgg16', weights_path=weights_path or 'DEFAULT')
 
-        concat_layers = [tf.reshape(model.transfer_layers[-1 * i], [-1, model.transfer_layer_flattened_sizes[-1 * i]])
-                         for i in range(1, num_layers_to_explore + 1)]
-        output = tf.concat(concat_layers, 1, name='image_features')
+        # every layer is fetched as its own output column in a single pass over the graph
+        outputs = [_serialize_output(model.transfer_layers[i], model.transfer_layer_flattened_sizes[i], name, batched)
+                   for i, name in zip(output_layer_indices, output_cols)]
 
-        cumulative_sizes = [0]
-        for i in range(1, num_layers_to_explore + 1):
-            cumulative_sizes.append(cumulative_sizes[i - 1] + model.transfer_layer_flattened_sizes[-1 * i])
+        image_features_df = _map_cnn(outputs, joined_df, batched)
+    return image_features_df, [model.transfer_layers_shapes[i] for i in output_layer_indices]
 
-        image_features_df = tfs.map_rows(output, joined_df)
-    return image_features_df, cumulative_sizes, model.transfer_layers_shapes[-1 * num_layers_to_explore:]
 
-
-def get_image_features_for_layer(model_name, layer_num_from_top, starting_layer_df, starting_layer, joined=True):
+def get_image_features_for_layer(model_name, layer_num_from_top, starting_layer_df, starting_layer, joined=True,
+                                 batch_size=1, backend='tensorframes', weights_path=None):
     """
         Staged CNN inference.
     :param model_name: CNN model name (AlexNet, VGG16, ResNet50)
@@ -202,50 +453,219 @@ def get_image_features_for_layer(model_name, layer_num_from_top, starting_layer_
     :param starting_layer_df: Input DataFrame for the staged inference
     :param starting_layer: Starting layer index. Zero means raw images
     :param joined: Boolean. Whether the input DataFrame is already joined with structured features.
+    :param batch_size: Number of images fed to the CNN per session run
+    :param backend: 'tensorframes' ships the graph with the query. 'python' and 'arrow' run the graph cached in the
+                    executors, row by row through mapPartitions or on Arrow record batches through a pandas_udf
+    :param weights_path: HDF5 weights file of the CNN. None uses the trained weights in cnn/resources
     :return: DataFrame
     """
+    if backend in ['python', 'arrow']:
+        if backend == 'python':
+            image_features_df = _get_cached_cnn_features(model_name, starting_layer_df, starting_layer,
+                                                         [layer_num_from_top], batch_size, weights_path=weights_path)
+        else:
+            image_features_df = _get_arrow_cnn_features(model_name, starting_layer_df, starting_layer,
+                                                        [layer_num_from_top], batch_size, weights_path=weights_path)
+        if joined:
+            image_features_df = image_features_df.select(col('id'), col('image_features'), col('features'),
+                                                          col('label'))
+        else:
+            image_features_df = image_features_df.select(col('id'), col('image_features'))
+        return image_features_df, cnn_models[model_name].transfer_layers_shapes[layer_num_from_top]
+
+    batched = batch_size > 1
     g = tf.Graph()
     with g.as_default():
-        input_buffer = tf.placeholder(tf.string, [], 'input_layer')
+        input_buffer = _get_input_layer_placeholder(batched)
         input = tf.decode_raw(input_buffer, tf.float32)
 
         if model_name == 'alexnet':
             input_layer_name = AlexNet.get_transfer_learning_layer_names()[starting_layer]
-            model = AlexNet(input, input_layer_name=input_layer_name, model_name='alexnet')
+            model = AlexNet(input, input_layer_name=input_layer_name, model_name='alexnet',
+                            weights_path=weights_path or 'DEFAULT')
         elif model_name == 'resnet50':
             input_layer_name = ResNet50.get_transfer_learning_layer_names()[starting_layer]
-            model = ResNet50(input, input_layer_name=input_layer_name, model_name='resnet50')
+            model = ResNet50(input, input_layer_name=input_layer_name, model_name='resnet50',
+                             weights_path=weights_path or 'DEFAULT')
         elif model_name == 'vgg16':
             input_layer_name = VGG16.get_transfer_learning_layer_names()[starting_layer]
-            model = VGG16(input, input_layer_name=input_layer_name, model_name='vgg16')
+            model = VGG16(input, input_layer_name=input_layer_name, model_name='vgg16',
+                          weights_path=weights_path or 'DEFAULT')
 
-        output = tf.reshape(model.transfer_layers[layer_num_from_top],
-                            [-1, model.transfer_layer_flattened_sizes[layer_num_from_top]], name='image_features')
+        output = _serialize_output(model.transfer_layers[layer_num_from_top],
+                                   model.transfer_layer_flattened_sizes[layer_num_from_top], 'image_features', batched)
 
         if joined:
-            image_features_df = tfs.map_rows(output, starting_layer_df).select(col('id'), col('image_features'),
-                                                                               col('features'), col('label'))
+            image_features_df = _map_cnn([output], starting_layer_df, batched).select(col('id'), col('image_features'),
+                                                                                      col('features'), col('label'))
         else:
-            image_features_df = tfs.map_rows(output, starting_layer_df).select(col('id'), col('image_features'))
+            image_features_df = _map_cnn([output], starting_layer_df, batched).select(col('id'),
+                                                                                      col('image_features'))
 
     return image_features_df, model.transfer_layers_shapes[layer_num_from_top]
 
 
+def _get_input_layer_placeholder(batched):
+    """
+        Creates the serialized CNN input placeholder. A scalar string is fed per row with map_rows, while a vector of
+        strings (one per row of the block) is fed with map_blocks.
+    :param batched: Boolean. Whether the graph is executed with map_blocks
+    :return: Tensor
+    """
+    if batched:
+        return tf.placeholder(tf.string, [None], 'input_layer')
+    return tf.placeholder(tf.string, [], 'input_layer')
+
+
+def _serialize_output(features, size, name, batched):
+    """
+        Serializes the features of a CNN layer into little-endian float32 bytes in the graph, the representation of
+        all the CNN feature columns (persisted layers, inputs of the next stage and pre-materialized tables).
+        TensorFlow has no op writing the raw bytes of a tensor into a string, so the bytes of every row are mapped to
+        one byte strings and joined. TensorFrames then emits a binary column and no UDF boxes the features.
+    :param features: Layer output tensor
+    :param size: Flattened size of the layer
+    :param name: Name of the output tensor, and of the output column
+    :param batched: Boolean. Whether the graph is executed with map_blocks (one string per row of the block) instead
+                    of map_rows (a scalar string)
+    :return: Tensor
+    """
+    # x86 is little-endian
+    feature_bytes = tf.cast(tf.reshape(tf.bitcast(tf.reshape(features, [-1, size]), tf.uint8), [-1, 4 * size]),
+                            tf.int32)
+    byte_strings = tf.constant([bytes(bytearray([i])) for i in range(256)], dtype=tf.string)
+    serialized = tf.reduce_join(tf.gather(byte_strings, feature_bytes), axis=1)
+    if batched:
+        return tf.identity(serialized, name=name)
+    return tf.reshape(serialized, [], name=name)
+
+
+def _map_cnn(outputs, input_df, batched):
+    """
+        Executes the CNN graph over the input DataFrame. With map_blocks TensorFrames feeds every row of a partition
+        in a single session run, so the number of rows in a partition is the inference batch size. The outputs are
+        serialized in the graph (see _serialize_output), so that they are persisted and fed to the next stage as is.
+    :param outputs: Output tensors. The output columns are named after them
+    :param input_df: Input DataFrame containing the 'input_layer' column
+    :param batched: Boolean. Whether to use map_blocks instead of map_rows
+    :return: DataFrame
+    """
+    if batched:
+        return tfs.map_blocks(outputs, input_df)
+    return tfs.map_rows(outputs, input_df)
+
+
+def _get_cached_cnn_features(model_name, input_df, input_layer_index, output_layer_indices, batch_size,
+                             output_cols=None, weights_path=None):
+    """
+        CNN inference executed by the Python workers. Only the model name and the layer indices are shipped with the
+        tasks. The graph, the weights and the session are built once per Python worker (see cnn.model_cache) and
+        reused by every later task and stage. Each output layer is emitted as its own column of float32 bytes.
+    :param model_name: CNN model name (alexnet, vgg16, resnet50)
+    :param input_df: Input DataFrame containing the serialized 'input_layer' column
+    :param input_layer_index: Starting layer index. Zero means raw images
+    :param output_layer_indices: Layer indices from the top of the CNN to be fetched
+    :param batch_size: Number of rows fed to the CNN per session run
+    :param output_cols: Column name of each output layer. Defaults to ['image_features']
+    :param weights_path: HDF5 weights file, resolved in the executors (see cnn.model_cache.get_weights_path)
+    :return: DataFrame
+    """
+    if output_cols is None:
+        output_cols = ['image_features']
+    fields = [f for f in input_df.schema.fields if f.name != 'input_layer']
+    schema = StructType(fields + [StructField(c, BinaryType()) for c in output_cols])
+    field_names = [f.name for f in fields]
+
+    def run_cnn(rows):
+        cnn = get_cached_cnn(model_name, input_layer_index, output_layer_indices, weights_path=weights_path)
+
+        def run_batch(batch):
+            inputs = np.vstack([np.frombuffer(row['input_layer'], dtype=np.float32) for row in batch])
+            outputs = cnn.run(inputs)
+            for i, row in enumerate(batch):
+                # BinaryType values are bytearrays in Python 2
+                yield [row[name] for name in field_names] + [bytearray(_to_bytes(output[i])) for output in outputs]
+
+        batch = []
+        for row in rows:
+            batch.append(row)
+            if len(batch) == batch_size:
+                for output_row in run_batch(batch):
+                    yield output_row
+                batch = []
+        if len(batch) > 0:
+            for output_row in run_batch(batch):
+                yield output_row
+
+    return input_df.sql_ctx.createDataFrame(input_df.rdd.mapPartitions(run_cnn), schema)
+
+
+def check_spark_version(sc, min_version, feature):
+    """
+        Raises a ValueError when the Spark version is older than the one a feature requires
+    :param sc: SparkContext
+    :param min_version: Oldest (major, minor) Spark version of the feature
+    :param feature: Feature description used in the error message
+    """
+    version = tuple(int(v) for v in re.findall(r'\d+', sc.version)[:2])
+    if version < tuple(min_version):
+        raise ValueError(feature + ' requires Spark ' + '.'.join(str(v) for v in min_version) + '+, found Spark ' +
+                         sc.version)
+
+
+def _get_arrow_cnn_features(model_name, input_df, input_layer_index, output_layer_indices, batch_size,
+                            output_cols=None, weights_path=None):
+    """
+        Vectorized CNN inference (requires Spark 2.4+ for the array<binary> output of the pandas_udf, and pyarrow). Arrow record batches of the 'input_layer' column
+        are streamed into the Python workers, stacked into one float32 tensor and run through the CNN cached in the
+        worker (see cnn.model_cache) in chunks of batch_size rows. The outputs of all the layers are returned as one
+        array of float32 bytes per row and split into one binary column per layer.
+    :param model_name: CNN model name (alexnet, vgg16, resnet50)
+    :param input_df: Input DataFrame containing the serialized 'input_layer' column
+    :param input_layer_index: Starting layer index. Zero means raw images
+    :param output_layer_indices: Layer indices from the top of the CNN to be fetched
+    :param batch_size: Number of rows fed to the CNN per session run
+    :param output_cols: Column name of each output layer. Defaults to ['image_features']
+    :param weights_path: HDF5 weights file, resolved in the executors (see cnn.model_cache.get_weights_path)
+    :return: DataFrame
+    """
+    from pyspark.sql.functions import pandas_udf
+
+    check_spark_version(input_df.sql_ctx._sc, arrow_min_spark_version, "the 'arrow' inference backend")
+    if output_cols is None:
+        output_cols = ['image_features']
+
+    def run_cnn(input_layer):
+        import pandas as pd
+
+        if len(input_layer) == 0:
+            return pd.Series([])
+        cnn = get_cached_cnn(model_name, input_layer_index, output_layer_indices, weights_path=weights_path)
+        inputs = np.vstack([np.frombuffer(x, dtype=np.float32) for x in input_layer])
+        chunks = [cnn.run(inputs[i:i + batch_size]) for i in range(0, inputs.shape[0], batch_size)]
+        outputs = [np.vstack([chunk[j] for chunk in chunks]) for j in range(len(output_cols))]
+        return pd.Series([[_to_bytes(output[i]) for output in outputs] for i in range(inputs.shape[0])])
+
+    # non-deterministic so that the optimizer does not inline the udf once per extracted layer
+    cnn_udf = pandas_udf(run_cnn, ArrayType(BinaryType())).asNondeterministic()
+    outputs_df = input_df.withColumn('cnn_outputs', cnn_udf(col('input_layer'))).drop('input_layer')
+    other_cols = [c for c in outputs_df.columns if c != 'cnn_outputs']
+    return outputs_df.select(*(other_cols + [col('cnn_outputs')[i].alias(name) for i, name in enumerate(output_cols)]))
+
+
+def _to_bytes(features):
+    """
+        Serializes CNN features into little-endian float32 bytes
+    :param features: numpy array
+    :return: bytes
+    """
+    return features.astype('<f4').tobytes()
+
+
 def get_dir_size(dir_path):
     """
-        Read HDFS metadata and estimate the size of image files.
+        Read the file system metadata and estimate the size of image files.
     :param dir_path: Images dir. path on HDFS
     :return: Total size of images in Bytes
     """
-    size_in_bytes = 0
-    if dir_path.startswith("hdfs://"):
-        output = os.popen("hadoop fs -du /" + dir_path.split(":")[2].split("/")[1]).read().split("\n")
-        for line in output:
-            str = line.split(" ")[0].strip()
-            if len(str) != 0:
-                size_in_bytes += int(line.split(" ")[0])
-    else:#file://
-        dir_path = dir_path.replace('file://', '')
-        size_in_bytes = sum(os.path.getsize(dir_path+"/"+f) for f in os.listdir(dir_path) if os.path.isfile(dir_path+"/"+f))
-
-    return size_in_bytes
+    return get_image_dir_stats(dir_path)['size']
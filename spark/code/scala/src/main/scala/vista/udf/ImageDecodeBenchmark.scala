@@ -0,0 +1,129 @@
+/*
+Copyright 2018 Supun Nakandala and Arun Kumar
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+    http://www.apache.org/licenses/LICENSE-2.0
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+*/
+package vista.udf
+
+import java.awt.Color
+import java.awt.image.{BufferedImage, DataBufferInt}
+import java.io.{ByteArrayInputStream, File, InputStream}
+import java.nio.file.Files
+import java.util.Arrays
+import javax.imageio.ImageIO
+
+/**
+ * Compares the image decode throughput of VistaUDFs.imageToByteArray against the previous per-pixel implementation
+ * on a local image directory, and checks that both write the same bytes for every 3 band YCbCr JPEG (the only kind
+ * the previous implementation decoded correctly). Exits with status 1 on a mismatch.
+ *
+ * Usage: scala -cp vista-udfs_2.11-1.0.jar vista.udf.ImageDecodeBenchmark <image dir> [iterations]
+ */
+object ImageDecodeBenchmark {
+
+    def main(args: Array[String]): Unit = {
+        val files = new File(args(0)).listFiles.filter(_.isFile)
+        val iterations = if (args.length > 1) args(1).toInt else 3
+        val images = files.map(f => Files.readAllBytes(f.toPath))
+        val totalMB = images.map(_.length.toLong).sum / 1024.0 / 1024.0
+        println("images: " + images.length + ", size: " + "%.1f".format(totalMB) + "MB")
+
+        run("per-pixel (previous)", images, iterations, legacyImageToByteArray)
+        run("bulk", images, iterations, VistaUDFs.imageToByteArray)
+
+        val compared = files.zip(images).filter(x => isYCbCr(x._2))
+        val mismatches = compared.filter(x => !Arrays.equals(legacyImageToByteArray(x._2),
+            VistaUDFs.imageToByteArray(x._2)))
+        println("compared with the previous implementation: " + compared.length + " images (" +
+            (images.length - compared.length) + " skipped), mismatches: " + mismatches.length)
+        mismatches.take(10).foreach(x => println("  " + x._1.getName))
+        if (mismatches.nonEmpty) {
+            sys.exit(1)
+        }
+    }
+
+    private def isYCbCr(bytesArr: Array[Byte]): Boolean = {
+        val imageReader = ImageIO.getImageReadersBySuffix("jpg").next
+        val iis = ImageIO.createImageInputStream(new ByteArrayInputStream(bytesArr))
+        try {
+            imageReader.setInput(iis, true, false)
+            val numBands = imageReader.readRaster(0, null).getNumBands
+            numBands == 3 && VistaUDFs.getColorTransform(imageReader, numBands) == VistaUDFs.transformYCbCr
+        } finally {
+            imageReader.dispose()
+            iis.close()
+        }
+    }
+
+    private def run(name: String, images: Array[Array[Byte]], iterations: Int, decode: Array[Byte] => Array[Byte]) = {
+        //warm up the JIT
+        images.take(100).foreach(decode)
+
+        val start = System.nanoTime
+        for (_ <- 0 until iterations) {
+            images.foreach(decode)
+        }
+        val seconds = (System.nanoTime - start) / 1e9
+        println(name + ": " + "%.1f".format(images.length * iterations / seconds) + " images/s")
+    }
+
+    private def legacyImageToByteArray(bytesArr: Array[Byte]) = {
+        val image = legacyReadImage(new ByteArrayInputStream(bytesArr))
+        val resizedImage = new BufferedImage(227, 227, BufferedImage.TYPE_INT_RGB)
+        val g = resizedImage.createGraphics()
+        g.drawImage(image, 0, 0, 227, 227, null)
+        g.dispose()
+
+        val pixelData = resizedImage.getRaster().getDataBuffer().asInstanceOf[DataBufferInt].getData()
+        val rgbData = new Array[Float](pixelData.size*3)
+        for (i <- 0 to 226) {
+            for (j <- 0 to 226) {
+               val c =  new Color(pixelData(227 * i + j))
+               rgbData(227 * 3 * i + 3 * j) = c.getBlue().asInstanceOf[Float]
+               rgbData(227 * 3 * i + 3 * j + 1) = c.getGreen().asInstanceOf[Float]
+               rgbData(227 * 3 * i + 3 * j + 2) = c.getRed().asInstanceOf[Float]
+            }
+        }
+        VistaUDFs.floatArrToBytes(rgbData)
+    }
+
+    private def legacyReadImage(stream: InputStream): BufferedImage = {
+        val imageReader = ImageIO.getImageReadersBySuffix("jpg").next
+        val iis = ImageIO.createImageInputStream(stream)
+        imageReader.setInput(iis, true, true)
+        val raster = imageReader.readRaster(0, null)
+        val w = raster.getWidth
+        val h = raster.getHeight
+        val result = new BufferedImage(w, h, BufferedImage.TYPE_INT_RGB)
+        val rgb = new Array[Int](3)
+        val pixel = new Array[Int](3)
+        for (x <- 0 until w) {
+            for (y <- 0 until h) {
+                raster.getPixel(x, y, pixel)
+                legacyToRGB(pixel(0), pixel(2), pixel(1), rgb)
+                val bgr = ((rgb(2) & 0xFF) << 16) | ((rgb(1) & 0xFF) << 8) | (rgb(0) & 0xFF)
+                result.setRGB(x, y, bgr)
+            }
+        }
+        result
+    }
+
+    private def legacyToRGB(y: Int, cb: Int, cr: Int, rgb: Array[Int]): Unit = {
+        val Y = y / 255.0f
+        val Cb = (cb - 128) / 255.0f
+        val Cr = (cr - 128) / 255.0f
+        val R = Math.min(1.0f, Math.max(0.0f, Y + 1.4f * Cr))
+        val G = Math.min(1.0f, Math.max(0.0f, Y - 0.343f * Cb - 0.711f * Cr))
+        val B = Math.min(1.0f, Math.max(0.0f, Y + 1.765f * Cb))
+        rgb(0) = (R * 255).toInt
+        rgb(1) = (G * 255).toInt
+        rgb(2) = (B * 255).toInt
+    }
+}
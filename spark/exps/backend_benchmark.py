@@ -0,0 +1,83 @@
+# coding=utf-8
+'''
+Copyright 2018 Supun Nakandala and Arun Kumar
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+    http://www.apache.org/licenses/LICENSE-2.0
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+'''
+
+from __future__ import print_function, division
+
+import math
+import sys
+import time
+
+from pyspark import SparkConf, SparkContext, StorageLevel
+import pyspark.sql.functions as F
+
+sys.path.append('../code/python')
+
+from vista_utils import get_images_df, image_to_byte_arr_udf, get_image_features_for_layer
+
+# Compares the CNN inference backends (tensorframes map_rows/map_blocks, cached graphs through mapPartitions and
+# Arrow batches through a pandas_udf) on the same image dataset. The decoded images are persisted first so that
+# only the CNN inference is timed.
+if __name__ == '__main__':
+    ############################change appropriately###################################
+    model = 'alexnet'
+    layer_index = -4  # from the top
+    images_input = 'file:///home/snakanda/Work/Vista/data/foods/images'
+    batch_size = 64
+    heap_memory = 25
+    executor_cpu = 4
+    sp_core_memory_fraction = 0.6
+    # (backend, batch size) pairs to compare
+    runs = [('tensorframes', 1), ('tensorframes', batch_size), ('python', batch_size), ('arrow', batch_size)]
+    ###################################################################################
+
+    conf = SparkConf()
+    conf.setAppName('backend-benchmark-' + model + "-l:" + str(layer_index))
+    conf.set("spark.executor.memory", str(heap_memory) + "g")
+    conf.set("spark.memory.fraction", sp_core_memory_fraction)
+    conf.set("spark.executor.cores", executor_cpu)
+    conf.set("spark.serializer", "org.apache.spark.serializer.KryoSerializer")
+    conf.set("spark.files.maxPartitionBytes", "10485760")  # 10MB
+    conf.set("spark.python.worker.reuse", "true")
+    conf.set("spark.sql.execution.arrow.maxRecordsPerBatch", str(batch_size))
+
+    sc = SparkContext.getOrCreate(conf=conf)
+
+    images_df = get_images_df(sc, images_input)
+    images_df = images_df.select(F.col('id'), image_to_byte_arr_udf(sc, F.col('image_buffer')).alias('input_layer'))
+    images_df.persist(StorageLevel(True, True, False, False))
+    n_images = images_df.count()
+
+    results = []
+    for backend, run_batch_size in runs:
+        run_df = images_df
+        if backend == 'tensorframes' and run_batch_size > 1:
+            # map_blocks feeds a whole partition per session run, so the partitions are cut to the batch size. The
+            # repartitioned images are persisted first so that the shuffle is not timed
+            run_df = images_df.repartition(int(math.ceil(1.0 * n_images / run_batch_size)))
+            run_df.persist(StorageLevel(True, True, False, False))
+            run_df.count()
+        features_df = get_image_features_for_layer(model, layer_index, run_df, 0, False, run_batch_size,
+                                                   backend)[0]
+        prev_time = time.time()
+        # aggregating over the features makes sure that the CNN is evaluated for every row
+        features_df.select(F.sum(F.length(F.col('image_features')))).collect()
+        elapsed = time.time() - prev_time
+        results.append((backend, run_batch_size, elapsed, n_images / elapsed))
+        if run_df is not images_df:
+            run_df.unpersist()
+
+    sc.stop()
+    print('backend, batch size, runtime (s), images/s')
+    for result in results:
+        print(", ".join([str(x) for x in result]))
@@ -23,7 +23,7 @@ from pyspark.sql.functions import col
 sys.path.append('../code/python')
 
 from vista_utils import get_struct_df
-from vista_utils import get_joined_features, serialize_cnn_features_udf, downstream_ml_func
+from vista_utils import get_joined_features, downstream_ml_func
 from vista_utils import get_image_features_for_layer, get_feature_projections
 
 from cnn.alexnet import AlexNet
@@ -80,7 +80,6 @@ if __name__ == '__main__':
 
         merged_features_df = get_feature_projections(sc, features_df, 1, [initial_shape])[0]
     else:
-        images_df = images_df.select(col('id'), serialize_cnn_features_udf(sc, col('input_layer')).alias('input_layer'))
         image_features_df, shape = get_image_features_for_layer(model, explore_layer_index, images_df, pre_mat_layer_index, False)
         features_df = get_joined_features(image_features_df, struct_df, False)
         features_df = features_df.select("id", "features", "image_features", "label")
@@ -0,0 +1,214 @@
+# coding=utf-8
+'''
+Copyright 2018 Supun Nakandala and Arun Kumar
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+    http://www.apache.org/licenses/LICENSE-2.0
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+'''
+
+from __future__ import print_function, division
+
+import argparse
+import itertools
+import json
+import multiprocessing
+import resource
+import sys
+import time
+from datetime import datetime
+
+from pyspark import SparkContext
+
+try:
+    from urllib2 import urlopen
+except ImportError:
+    from urllib.request import urlopen
+
+sys.path.append('../code/python')
+
+from synthetic_data import make_synthetic_dataset, ensure_model_weights
+from vista import Vista
+
+"""End-to-end benchmark of Vista on a synthetic dataset in Spark local mode. Every (model, inference type, operator
+placement, join, persistence) plan of the sweep runs in its own SparkContext. The runtime, the per-stage throughput,
+spills and peak execution memory (from the Spark status API) and the peak memory of the driver and of the executor
+processes are written to a results file, and compared against a baseline results file to flag regressions. CNNs
+without trained weights in cnn/resources run with random weights written into <data-dir>/weights (see
+synthetic_data.py). Usage:
+
+    $ spark-submit --master local[4] --driver-memory 8g --conf spark.executor.processTreeMetrics.enabled=true \\
+        --jars ../code/scala/target/scala-2.11/vista-udfs_2.11-1.0.jar benchmark.py --models alexnet \\
+        --results results.json --baseline baseline.json
+"""
+# A run is a regression when a metric exceeds its baseline by more than this fraction
+default_tolerance = 0.2
+
+# Metrics compared against the baseline (lower is better)
+compared_metrics = ['runtime_s', 'memory_spilled_bytes', 'disk_spilled_bytes', 'peak_execution_memory_bytes',
+                    'peak_jvm_heap_bytes', 'peak_python_rss_bytes']
+
+
+def run_plan(args, model, inf, operator, join, persistence, struct_path, images_dir, weights_path):
+    """
+        Runs Vista with one plan and collects its metrics
+    :return: Dict of the plan, the downstream accuracies and the metrics
+    """
+    vista = Vista('vista-benchmark', args.mem_sys, args.cpu_sys, 1, model, args.n_layers, 0, 'file://' + struct_path,
+                  'file://' + images_dir, mem_sys_rsv=args.mem_sys_rsv, inference_backend=args.backend,
+                  inference_batch_size=args.batch_size, engine='spark', weights_path=weights_path)
+    vista.override_inference_type(inf)
+    vista.overrdide_operator_placement(operator)
+    vista.override_join(join)
+    vista.override_persistence_format(persistence)
+
+    start = time.time()
+    accuracies = vista.run()
+    runtime = time.time() - start
+
+    sc = SparkContext._active_spark_context
+    try:
+        metrics = get_spark_metrics(sc)
+    finally:
+        sc.stop()
+    metrics['runtime_s'] = runtime
+    metrics['records_per_s'] = args.n_images / runtime
+    # peak of this process over the sweep so far, not compared against the baseline
+    metrics['driver_python_max_rss_bytes'] = get_max_rss()
+    return {'model': model, 'inf': inf, 'operator': operator, 'join': join, 'persistence': persistence,
+            'n_images': args.n_images, 'dS': args.dS, 'n_layers': args.n_layers, 'backend': args.backend,
+            'accuracies': dict((str(k), v) for k, v in accuracies.items()), 'metrics': metrics}
+
+
+def get_spark_metrics(sc):
+    """
+        Reads the stage and executor metrics of the running application from the Spark status REST API
+    :param sc: SparkContext
+    :return: Dict of run level metrics, with the per-stage ones under 'stages'
+    """
+    api_url = sc.uiWebUrl + '/api/v1/applications/' + sc.applicationId
+    stages = json.loads(urlopen(api_url + '/stages?status=complete').read().decode('utf-8'))
+    executors = json.loads(urlopen(api_url + '/executors').read().decode('utf-8'))
+
+    stage_metrics = []
+    for stage in sorted(stages, key=lambda s: (s['stageId'], s['attemptId'])):
+        duration = (_parse_time(stage['completionTime']) - _parse_time(stage['submissionTime'])) \
+            if 'completionTime' in stage and 'submissionTime' in stage else 0.0
+        records = max(stage.get('inputRecords', 0), stage.get('shuffleReadRecords', 0))
+        stage_metrics.append({'stage_id': stage['stageId'], 'name': stage['name'], 'n_tasks': stage['numTasks'],
+                              'duration_s': duration, 'records': records,
+                              'records_per_s': records / duration if duration > 0 else 0.0,
+                              'executor_run_time_s': stage.get('executorRunTime', 0) / 1000.0,
+                              'shuffle_write_bytes': stage.get('shuffleWriteBytes', 0),
+                              'memory_spilled_bytes': stage.get('memoryBytesSpilled', 0),
+                              'disk_spilled_bytes': stage.get('diskBytesSpilled', 0),
+                              'peak_execution_memory_bytes': stage.get('peakExecutionMemory', 0)})
+
+    # executor peak metrics require Spark 3.0+, the Python ones spark.executor.processTreeMetrics.enabled
+    peak_metrics = [e.get('peakMemoryMetrics', {}) for e in executors]
+    return {'memory_spilled_bytes': sum(s['memory_spilled_bytes'] for s in stage_metrics),
+            'disk_spilled_bytes': sum(s['disk_spilled_bytes'] for s in stage_metrics),
+            'peak_execution_memory_bytes': max([s['peak_execution_memory_bytes'] for s in stage_metrics] + [0]),
+            'peak_jvm_heap_bytes': max([m.get('JVMHeapMemory', 0) for m in peak_metrics] + [0]),
+            'peak_python_rss_bytes': max([m.get('ProcessTreePythonRSSMemory', 0) for m in peak_metrics] + [0]),
+            'stages': stage_metrics}
+
+
+def get_max_rss():
+    # ru_maxrss is in KB on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def compare_with_baseline(results, baseline, tolerance=default_tolerance):
+    """
+        Compares the metrics of every run with the baseline run of the same plan and dataset
+    :param results: List of run results
+    :param baseline: List of baseline run results
+    :param tolerance: Allowed relative increase of a metric
+    :return: List of (plan key, metric, baseline value, value) regressions
+    """
+    baseline_runs = dict((_get_run_key(run), run) for run in baseline)
+    regressions = []
+    for run in results:
+        key = _get_run_key(run)
+        if key not in baseline_runs:
+            continue
+        for metric in compared_metrics:
+            base_value = baseline_runs[key]['metrics'].get(metric, 0)
+            value = run['metrics'].get(metric, 0)
+            # a metric that was zero (e.g. no spill) regresses as soon as it is non-zero
+            if value > base_value * (1 + tolerance):
+                regressions.append((key, metric, base_value, value))
+    return regressions
+
+
+def _get_run_key(run):
+    return '/'.join(str(run[k]) for k in ['model', 'inf', 'operator', 'join', 'persistence', 'n_images', 'dS',
+                                          'n_layers', 'backend'])
+
+
+def _parse_time(value):
+    epoch = datetime(1970, 1, 1)
+    return (datetime.strptime(value.replace('GMT', ''), '%Y-%m-%dT%H:%M:%S.%f') - epoch).total_seconds()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmarks the Vista plans on a synthetic dataset')
+    parser.add_argument('--data-dir', default='/tmp/vista_benchmark')
+    parser.add_argument('--n-images', type=int, default=1000)
+    parser.add_argument('--n-classes', type=int, default=4)
+    parser.add_argument('--dS', type=int, default=100)
+    parser.add_argument('--n-layers', type=int, default=2)
+    parser.add_argument('--models', nargs='+', default=['alexnet'])
+    parser.add_argument('--infs', nargs='+', default=['staged', 'bulk'])
+    parser.add_argument('--operators', nargs='+', default=['after-join', 'before-join'])
+    parser.add_argument('--joins', nargs='+', default=['b', 's'])
+    parser.add_argument('--persistences', nargs='+', default=['ser', 'deser'])
+    parser.add_argument('--backend', default='python')
+    parser.add_argument('--batch-size', type=int, default=32)
+    parser.add_argument('--mem-sys', type=int, default=16, help='memory (GB) given to Vista')
+    parser.add_argument('--mem-sys-rsv', type=int, default=3)
+    parser.add_argument('--cpu-sys', type=int, default=multiprocessing.cpu_count())
+    parser.add_argument('--results', default='benchmark_results.json')
+    parser.add_argument('--baseline', default=None, help='results file of an earlier run to compare against')
+    parser.add_argument('--tolerance', type=float, default=default_tolerance)
+    args = parser.parse_args()
+
+    images_dir, struct_path = make_synthetic_dataset(args.data_dir, args.n_images, args.n_classes, args.dS)
+    weights_paths = {}
+    for model in args.models:
+        weights_paths[model], random_weights = ensure_model_weights(model, args.data_dir)
+        if random_weights:
+            print('WARNING: no trained weights for ' + model + ', using random weights in ' + weights_paths[model])
+
+    results = []
+    for model, inf, operator, join, persistence in itertools.product(args.models, args.infs, args.operators,
+                                                                     args.joins, args.persistences):
+        print('running ' + ', '.join([model, inf, operator, join, persistence]))
+        results.append(run_plan(args, model, inf, operator, join, persistence, struct_path, images_dir,
+                                weights_paths[model]))
+        # written after every run, so that the finished runs survive a failing one
+        with open(args.results, 'w') as f:
+            json.dump(results, f, indent=2)
+
+    print('model, inf, operator, join, persistence, runtime (s), records/s, spilled (MB), peak exec. memory (MB)')
+    for run in results:
+        m = run['metrics']
+        print(", ".join([str(x) for x in [run['model'], run['inf'], run['operator'], run['join'], run['persistence'],
+                                          round(m['runtime_s'], 2), round(m['records_per_s'], 2),
+                                          (m['memory_spilled_bytes'] + m['disk_spilled_bytes']) // 2 ** 20,
+                                          m['peak_execution_memory_bytes'] // 2 ** 20]]))
+
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            regressions = compare_with_baseline(results, json.load(f), args.tolerance)
+        for key, metric, base_value, value in regressions:
+            print('REGRESSION ' + key + ' ' + metric + ': ' + str(base_value) + ' -> ' + str(value))
+        if len(regressions) > 0:
+            sys.exit(1)
+        print('no regressions against ' + args.baseline)
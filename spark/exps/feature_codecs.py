@@ -0,0 +1,81 @@
+# coding=utf-8
+'''
+Copyright 2018 Supun Nakandala and Arun Kumar
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+    http://www.apache.org/licenses/LICENSE-2.0
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+'''
+
+from __future__ import print_function, division
+
+import sys
+
+from pyspark import SparkConf, SparkContext, StorageLevel
+from pyspark.sql.functions import col, avg, length
+
+sys.path.append('../code/python')
+
+from vista_utils import get_struct_df, get_decoded_images_df, get_all_image_features, get_joined_features, \
+    get_feature_projections, get_layer_features_cols, encode_layer_features, downstream_ml_func
+from synthetic_data import make_synthetic_dataset
+
+
+# Reports the downstream accuracy delta of the compact feature codecs against float32 for every explored
+# layer, on a synthetic dataset. The CNN features are computed once and encoded with every codec.
+if __name__ == '__main__':
+    ############################change appropriately###################################
+    model = 'alexnet'
+    n_layers = 4
+    data_dir = '/tmp/vista_feature_codecs'
+    n_images = 500
+    n_classes = 4
+    dS = 10
+    batch_size = 32
+    backend = 'python'
+    codecs = ['float32', 'float16', 'int8', 'sparse']
+    ###################################################################################
+
+    images_dir, struct_path = make_synthetic_dataset(data_dir, n_images, n_classes, dS)
+
+    conf = SparkConf()
+    conf.setAppName('feature-codecs-' + model)
+    conf.set("spark.serializer", "org.apache.spark.serializer.KryoSerializer")
+    conf.set("spark.python.worker.reuse", "true")
+    sc = SparkContext.getOrCreate(conf=conf)
+
+    layer_cols = get_layer_features_cols(n_layers)
+    struct_df = get_struct_df(sc, 'file://' + struct_path)
+    images_df = get_decoded_images_df(sc, 'file://' + images_dir)
+    image_features_df, shapes = get_all_image_features(model, images_df, n_layers, batch_size=batch_size,
+                                                       backend=backend)
+    features_df = get_joined_features(image_features_df, struct_df, True, layer_cols)
+    features_df.persist(StorageLevel(True, True, False, False))
+
+    results = {}
+    for codec in codecs:
+        # float32 is the persisted features_df itself
+        encoded_df = encode_layer_features(sc, features_df, layer_cols, shapes, codec)
+        if codec != 'float32':
+            encoded_df.persist(StorageLevel(True, True, False, False))
+        widths = encoded_df.select(*[avg(length(col(c))).alias(c) for c in layer_cols]).first()
+        merged_dfs = get_feature_projections(sc, encoded_df, n_layers, shapes, image_features_cols=layer_cols,
+                                             codec=codec)
+        for i, merged_df in enumerate(merged_dfs):
+            accuracy = downstream_ml_func(merged_df, {}, -1 * (i + 1))[-1 * (i + 1)]
+            results[(codec, i)] = (accuracy, widths[layer_cols[i]])
+        if codec != 'float32':
+            encoded_df.unpersist()
+    sc.stop()
+
+    print('layer, codec, bytes per record, accuracy, accuracy delta vs float32')
+    for i in range(n_layers):
+        for codec in codecs:
+            accuracy, width = results[(codec, i)]
+            print(", ".join([str(x) for x in [-1 * (i + 1), codec, int(width), accuracy,
+                                              accuracy - results[('float32', i)][0]]]))
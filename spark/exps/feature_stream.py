@@ -0,0 +1,90 @@
+# coding=utf-8
+'''
+Copyright 2018 Supun Nakandala and Arun Kumar
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+    http://www.apache.org/licenses/LICENSE-2.0
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+'''
+
+from __future__ import print_function, division
+
+import os
+import shutil
+import sys
+import time
+
+from pyspark import SparkConf, SparkContext, SQLContext
+
+sys.path.append('../code/python')
+
+from feature_stream import start_feature_stream
+
+# Drives the streaming feature extraction against a local dir.: the images of source_images_dir are copied in
+# chunks into a staging dir. and moved into the watched dir., then the per micro-batch latencies and the number of
+# extracted rows are reported. Requires Spark 3.0+.
+if __name__ == '__main__':
+    ############################change appropriately###################################
+    model = 'alexnet'
+    layer_index = -4  # from the top
+    source_images_dir = '/home/snakanda/Work/Vista/data/foods/images'
+    struct_input = 'file:///home/snakanda/Work/Vista/data/foods/foods.csv'
+    work_dir = '/tmp/vista_feature_stream'
+    images_per_chunk = 200
+    n_chunks = 5
+    seconds_between_chunks = 5
+    max_files_per_trigger = 100
+    trigger_interval = '2 seconds'
+    batch_size = 32
+    ###################################################################################
+
+    if os.path.exists(work_dir):
+        shutil.rmtree(work_dir)
+    watched_dir = os.path.join(work_dir, 'images')
+    staging_dir = os.path.join(work_dir, 'staging')
+    os.makedirs(watched_dir)
+    os.makedirs(staging_dir)
+    output_path = 'file://' + os.path.join(work_dir, 'features.parquet')
+
+    conf = SparkConf()
+    conf.setAppName('feature-stream-' + model + "-l:" + str(layer_index))
+    conf.set("spark.serializer", "org.apache.spark.serializer.KryoSerializer")
+    conf.set("spark.python.worker.reuse", "true")
+    sc = SparkContext.getOrCreate(conf=conf)
+
+    query = start_feature_stream(sc, model, layer_index, 'file://' + watched_dir, struct_input, output_path,
+                                 'file://' + os.path.join(work_dir, 'checkpoint'), max_files_per_trigger,
+                                 trigger_interval, batch_size)
+
+    images = sorted(os.listdir(source_images_dir))[:images_per_chunk * n_chunks]
+    for i in range(0, len(images), images_per_chunk):
+        for name in images[i:i + images_per_chunk]:
+            # copied aside and renamed in, so that the file source never lists a partially written image
+            shutil.copy(os.path.join(source_images_dir, name), os.path.join(staging_dir, name))
+            os.rename(os.path.join(staging_dir, name), os.path.join(watched_dir, name))
+        time.sleep(seconds_between_chunks)
+
+    query.processAllAvailable()
+    progress = query.recentProgress
+    query.stop()
+
+    n_rows = SQLContext(sc).read.parquet(output_path).count()
+    # the unmatched table is only written by micro-batches with images missing from the structured csv. Its rows
+    # joined by a later micro-batch are in the output too, so only the ones still missing from it are counted
+    unmatched_path = os.path.join(work_dir, 'features.parquet_unmatched')
+    n_unmatched = SQLContext(sc).read.parquet('file://' + unmatched_path).select('id') \
+        .join(SQLContext(sc).read.parquet(output_path).select('id'), 'id', 'left_anti').count() \
+        if os.path.exists(unmatched_path) else 0
+    sc.stop()
+
+    print('batch id, input rows, latency (ms)')
+    for p in progress:
+        if p['numInputRows'] > 0:
+            print(", ".join([str(x) for x in [p['batchId'], p['numInputRows'], p['durationMs']['triggerExecution']]]))
+    print('images copied: ' + str(len(images)) + ', rows extracted: ' + str(n_rows) + ', unmatched: ' +
+          str(n_unmatched))
@@ -17,17 +17,16 @@ from __future__ import print_function, division
 import sys
 
 from pyspark import SparkConf, SparkContext, StorageLevel
-from pyspark.sql.functions import col
 
 sys.path.append('../code/python')
 
-from vista_utils import get_struct_df, get_images_df, get_dir_size
-from vista_utils import image_to_byte_arr_udf
-from vista_utils import get_image_features_for_layer
+from pre_materialization import materialize_layer
 import time
 
 # Script for pre-materializing the CNN features of a base layer. CNN features will be stored
-# in Parquet format on HDFS.
+# in Parquet format on HDFS as binary 'input_layer' column encoded with codec ('float32', 'float16', 'int8' or
+# 'sparse'; Vista has to be given the same feature_codec). With incremental = True a
+# re-run only computes the features of the images added or changed since the previous run.
 if __name__ == '__main__':
     ############################change appropriately###################################
     model = 'alexnet'
@@ -38,6 +37,8 @@ if __name__ == '__main__':
     num_executors = 1
     executor_cpu = 5
     sp_core_memory_fraction = 0.6
+    incremental = True
+    codec = 'float32'
     ###################################################################################
 
     prev_time = time.time()
@@ -55,10 +56,7 @@ if __name__ == '__main__':
 
     sc = SparkContext.getOrCreate(conf=conf)
 
-    images_df = get_images_df(sc, images_input)
-    images_df = images_df.select(col('id'), image_to_byte_arr_udf(sc, col('image_buffer')).alias('input_layer'))
-    images_df = get_image_features_for_layer(model, pre_mat_layer_index, images_df, 0, False)[0].select("id", col(
-        'image_features').alias('input_layer'))
-    images_df.write.mode("overwrite").parquet(pre_mat_name)
+    print(materialize_layer(sc, model, pre_mat_layer_index, images_input, pre_mat_name, incremental,
+                            codec=codec))
     sc.stop()
-    print("Runtime: " + str((time.time()-prev_time))/60.0)
\ No newline at end of file
+    print("Runtime: " + str((time.time()-prev_time)/60.0))
\ No newline at end of file
@@ -0,0 +1,180 @@
+# coding=utf-8
+'''
+Copyright 2018 Supun Nakandala and Arun Kumar
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+    http://www.apache.org/licenses/LICENSE-2.0
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+'''
+
+from __future__ import print_function, division
+
+import json
+import os
+import shutil
+import sys
+
+import numpy as np
+
+sys.path.append('../code/python')
+
+"""Synthetic inputs of the experiments: a dir. of JPEG images with a structured {ID, X_str, y} csv, and HDF5 files of
+random weights with the layer names and shapes the CNNs read, so that the experiments run without the trained weights
+(see download_convnet_weights.sh)."""
+
+
+def make_synthetic_dataset(data_dir, n_images, n_classes, dS, seed=0, image_size=(227, 227)):
+    """
+        Writes noisy JPEG images whose mean color depends on the class, and a structured csv of {ID, X_str, y} with
+        uninformative structured features, so that the accuracy depends on the CNN features. A dataset written
+        earlier with the same parameters is reused.
+    :param data_dir: Output dir.
+    :param n_images: Number of records
+    :param n_classes: Number of classes
+    :param dS: Number of structured features
+    :param seed: Random seed
+    :param image_size: (height, width) of the images
+    :return: (images dir. path, structured csv path)
+    """
+    from PIL import Image
+
+    images_dir = os.path.join(data_dir, 'images')
+    struct_path = os.path.join(data_dir, 'struct.csv')
+    params_path = os.path.join(data_dir, 'params.json')
+    params = {'n_images': n_images, 'n_classes': n_classes, 'dS': dS, 'seed': seed, 'image_size': list(image_size)}
+    if os.path.exists(params_path):
+        with open(params_path) as f:
+            if json.load(f) == params:
+                return images_dir, struct_path
+        shutil.rmtree(data_dir)
+    os.makedirs(images_dir)
+
+    rng = np.random.RandomState(seed)
+    class_colors = rng.uniform(0, 255, (n_classes, 3))
+    with open(struct_path, 'w') as f:
+        for i in range(n_images):
+            label = i % n_classes
+            pixels = np.clip(class_colors[label] + rng.normal(0, 60, (image_size[0], image_size[1], 3)), 0, 255)
+            Image.fromarray(pixels.astype(np.uint8)).save(os.path.join(images_dir, str(i) + '.jpg'), quality=90)
+            f.write(','.join([str(i)] + ['%.4f' % x for x in rng.normal(0, 1, dS)] + [str(label)]) + '\n')
+
+    # written last, so that an interrupted dataset is rewritten
+    with open(params_path, 'w') as f:
+        json.dump(params, f)
+    return images_dir, struct_path
+
+
+def make_random_weights(model, weights_path, seed=0):
+    """
+        Writes an HDF5 file of random weights ({layer: {layer_W:0, layer_b:0, ...}}) for a CNN. The layer names and
+        shapes are recorded by building the CNN graph on a stand-in of the weights file. Weights are He-normal, biases
+        and batch norm means and offsets zero, and batch norm variances and scales one.
+    :param model: CNN model name (alexnet, vgg16, resnet50)
+    :param weights_path: Output HDF5 file path
+    :param seed: Random seed
+    """
+    import tensorflow as tf
+    from cnn import cnn_utils
+    from cnn.model_cache import cnn_models
+
+    model_class = cnn_models[model]
+    graph = tf.Graph()
+    recorder = _WeightsRecorder(graph)
+    # the CNN reads its weights through the LazyWeights registered for its path
+    cnn_utils._lazy_weights[weights_path] = recorder
+    try:
+        with graph.as_default():
+            model_class(tf.placeholder(tf.float32, [None, model_class.transfer_layer_flattened_sizes[0]]),
+                        model_name=model, weights_path=weights_path)
+    finally:
+        del cnn_utils._lazy_weights[weights_path]
+
+    rng = np.random.RandomState(seed)
+    ops = graph.get_operations()
+    weights = {}
+    for layer, key, n_ops in recorder.accesses:
+        # the constant built from the value, and for the unshaped batch norm constants the conv output they normalize
+        shape = [op for op in ops[n_ops:] if op.type == 'Const'][0].outputs[0].shape.as_list()
+        if len(shape) == 0:
+            shape = [[op for op in ops[:n_ops] if op.type != 'Const'][-1].outputs[0].shape.as_list()[-1]]
+
+        if key.endswith('_W:0'):
+            value = rng.normal(0, np.sqrt(2.0 / np.prod(shape[:-1])), shape)
+        elif key.endswith(('_running_std:0', '_gamma:0')):
+            value = np.ones(shape)
+        else:
+            value = np.zeros(shape)
+        weights.setdefault(layer, {})[key] = value.astype(np.float32)
+
+    cnn_utils.save_dict_to_hdf5(weights, weights_path)
+
+
+def ensure_model_weights(model, data_dir, seed=0):
+    """
+        Resolves the weights file of a CNN. When the trained weights are missing from cnn/resources, random weights
+        are written into <data_dir>/weights (once), and that path is to be passed to the CNNs (see the weights_path
+        parameter of Vista). Nothing is written into cnn/resources.
+    :param model: CNN model name (alexnet, vgg16, resnet50)
+    :param data_dir: Dir. of the synthetic dataset
+    :param seed: Random seed
+    :return: (weights path, whether the weights are random)
+    """
+    trained_weights_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'code', 'python', 'cnn',
+                                        'resources', model + '_weights.h5')
+    if os.path.exists(trained_weights_path):
+        return os.path.abspath(trained_weights_path), False
+
+    weights_path = os.path.join(os.path.abspath(data_dir), 'weights', model + '_weights.h5')
+    if not os.path.exists(weights_path):
+        if not os.path.exists(os.path.dirname(weights_path)):
+            os.makedirs(os.path.dirname(weights_path))
+        # written next to its final path, so that an interrupted file is rewritten
+        make_random_weights(model, weights_path + '.tmp', seed)
+        os.rename(weights_path + '.tmp', weights_path)
+    return weights_path, True
+
+
+class _WeightsRecorder(object):
+    """
+        Stand-in of a LazyWeights file that records the (layer, key) pairs read by a CNN, with the number of graph
+        operations at the time of the read, and returns zeros (broadcast by tf.constant to the layer shape)
+    """
+
+    def __init__(self, graph):
+        self.graph = graph
+        self.accesses = []
+
+    def __getitem__(self, layer):
+        return _LayerRecorder(self, layer)
+
+
+class _LayerRecorder(object):
+
+    def __init__(self, recorder, layer):
+        self.recorder = recorder
+        self.layer = layer
+
+    def __getitem__(self, key):
+        self.recorder.accesses.append((self.layer, key, len(self.recorder.graph.get_operations())))
+        return np.float32(0)
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Writes a synthetic dataset and random CNN weights')
+    parser.add_argument('data_dir')
+    parser.add_argument('--n-images', type=int, default=1000)
+    parser.add_argument('--n-classes', type=int, default=4)
+    parser.add_argument('--dS', type=int, default=100)
+    parser.add_argument('--models', nargs='*', default=[])
+    args = parser.parse_args()
+
+    print(make_synthetic_dataset(args.data_dir, args.n_images, args.n_classes, args.dS))
+    for model in args.models:
+        print(ensure_model_weights(model, args.data_dir))